@@ -66,6 +66,11 @@ c = Bunch()
 c.dburl = None
 c.db_pool_size = 10
 c.db_pool_overflow = 10
+
+# number of username -> id/uuid/file_location entries to keep in the
+# process-level user cache (see bespin.database.UserCache). 0 turns
+# the cache off.
+c.user_cache_size = 1000
 c.secret = "This is the phrase that is used for secret stuff."
 c.pw_secret = "This phrase encrypts passwords."
 c.static_dir = path.getcwd() / ".." / "bespinclient" / "tmp" / "static"
@@ -107,6 +112,11 @@ c.static_override = None
 c.async_jobs = True
 # can be "" or False, "beanstalk" or True, or "restmq" for now
 
+# when true (and there is a job queue) file event notifications to
+# followers are delivered by the queue workers rather than during the
+# request that caused them
+c.async_notifications = False
+
 # queue host, port, and a polling interval in seconds (for now)
 c.queue_host = None
 c.queue_port = None
@@ -115,6 +125,31 @@ c.queue_timeout = 0.3
 # holds the actual queue object
 c.queue = None
 
+# The worker threads that bespin_worker runs for each of the queues in
+# bespin.queue.QUEUES, as a list of (queue name, count) or a
+# "name:count,name:count" string. No user gets more than queue_user_slots
+# of the workers of any one queue at once (0 for no limit); quick jobs,
+# given a priority ahead of their queue's, are not counted.
+c.queue_workers = "notify:1,files:1,vcs:2,deploy:1,clone:1"
+c.queue_user_slots = 1
+
+# If queue_processes is set, bespin_worker forks that many worker
+# processes, each with the threads above, and replaces any that exit, that
+# have run queue_max_jobs jobs (0 for no limit), that have not reported
+# their health for queue_health_timeout seconds or that have had a job
+# running for more than queue_job_timeout seconds (0 for no limit), and
+# shares queue_user_slots between them. The latest reports are
+# written to queue_health_file as JSON. When bespin_worker is stopped, the
+# jobs that are running get queue_shutdown_timeout seconds to finish.
+# Beanstalk gives every job queue_job_timeout seconds, and a minute more,
+# before it hands the job to another worker.
+c.queue_processes = 0
+c.queue_max_jobs = 0
+c.queue_health_timeout = 60
+c.queue_job_timeout = 3600
+c.queue_health_file = None
+c.queue_shutdown_timeout = 300
+
 # timeout for VCS jobs. Default is 5 minutes, which seems plenty generous.
 # expressed in seconds
 c.vcs_timeout = 300
@@ -127,6 +162,32 @@ c.stats_type = "none"
 c.redis_host = None
 c.redis_port = None
 
+# inbox type for the messages picked up at /messages/: db, redis
+# db keeps them in the messages table, redis keeps a list per user
+# in the redis server configured above
+c.inbox_type = "db"
+
+# how often (in seconds) a waiting /messages/ request rechecks the
+# database inbox for messages published by other processes
+c.inbox_poll_interval = 1.0
+
+# upper bound (in seconds) on the "wait" parameter a client can pass
+# to /messages/ to long poll for messages. 0 turns long polling off.
+c.messages_max_wait = 25
+
+# how long (in seconds) a /channel/ response stays open before the
+# client has to reconnect, and how often an idle channel sends an
+# empty frame so that dead connections are noticed
+c.channel_lifetime = 60
+c.channel_heartbeat = 15
+
+# how many /channel/ responses one user can hold open at a time, and how
+# many one process holds open in all. Each one ties up a server thread for
+# c.channel_lifetime, so channel_max_open is kept well below the size of
+# the thread pool (10 for paste); clients turned away poll /messages/.
+c.channel_max_per_user = 2
+c.channel_max_open = 4
+
 # login failure tracking: none, memory, redis
 # memory holds the login failure attempts in a dictionary and should
 # not be used in production
@@ -141,11 +202,102 @@ c.login_attempts = 10
 c.lockout_period = 600
 
 # The options for mobwrite_implementation are defined in controllers.py.
-# Currently: MobwriteInProcess, MobwriteTelnetProxy, or MobwriteHttpProxy
+# Currently: MobwriteInProcess, MobwriteTelnetProxy, MobwriteHttpProxy
+# or MobwriteShardedProxy
 c.mobwrite_implementation = "MobwriteHttpProxy"
 c.mobwrite_server_port = 3017
 c.mobwrite_server_address = "127.0.0.1"
 
+# The proxies keep up to mobwrite_pool_size connections to the mobwrite
+# server open. Connections idle for longer than mobwrite_pool_idle_timeout
+# seconds are not reused. mobwrite_timeout is the socket timeout.
+c.mobwrite_pool_size = 8
+c.mobwrite_pool_idle_timeout = 30
+c.mobwrite_timeout = 10
+
+# For MobwriteShardedProxy, the telnet addresses of the mobwrite daemons
+# as a list of (host, port) or a "host:port,host:port" string. Documents
+# are spread over them by name. Every web node must list the shards in
+# the same order. Start shard n with "telnet_mobwrite <mode> <config> n",
+# or all of the shards on this host with "... <config> all".
+c.mobwrite_shards = []
+
+# The mobwrite server holds saves in memory and writes each document out
+# once it has been dirty for mobwrite_save_interval seconds, or sooner if
+# more than mobwrite_save_max_pending bytes are waiting. 0 saves on every
+# change. Unless mobwrite_journal_dir is set (see below), a crash of the
+# mobwrite server loses up to mobwrite_save_interval seconds of edits,
+# where saving on every change loses none.
+c.mobwrite_save_interval = 5
+c.mobwrite_save_max_pending = 4000000
+
+# Where the mobwrite server keeps its documents: "bespin" (temp files in
+# the users' projects), "sqlite" (a database at mobwrite_storage_file,
+# mobwrite/texts.sqlite beside fsroot by default), "redis" (the server at redis_host and
+# redis_port, under keys starting with mobwrite_storage_prefix) or "memory".
+# The sqlite, redis and memory stores drop documents that have not been
+# saved for mobwrite_storage_expiry seconds. More kinds can be added to
+# bespin.mobwrite.storage.storages.
+c.mobwrite_storage = "bespin"
+c.mobwrite_storage_file = None
+c.mobwrite_storage_prefix = "mobwrite:"
+c.mobwrite_storage_expiry = 24 * 60 * 60
+
+# With the "bespin" storage, mobwrite keeps the edits to a file in a temp
+# copy beside the project. Once a project's temp copies have not been saved
+# for mobwrite_merge_idle seconds, a job on the queue merges them into the
+# real files and removes the ones nobody has open. 0 never merges them.
+c.mobwrite_merge_idle = 60
+
+# If set, every change to a mobwrite document is appended as a delta to a
+# per-document journal in this directory, which is folded into a snapshot
+# every mobwrite_journal_compact_every changes. Edits that had not been
+# saved when the mobwrite server stopped are recovered from it when the
+# document is next opened. The journals of documents that are not opened
+# again within mobwrite_journal_expiry seconds are removed (0 keeps them).
+c.mobwrite_journal_dir = None
+c.mobwrite_journal_compact_every = 100
+c.mobwrite_journal_expiry = 7 * 24 * 60 * 60
+
+# If set, the mobwrite server writes its open documents and views, with
+# their shadows and unacknowledged edits, to a file in this directory when
+# it is stopped (SIGTERM or Ctrl-C), and reloads them when it starts again.
+# Clients that were connected then carry on without a resync.
+c.mobwrite_state_dir = None
+
+# How the mobwrite server (telnet_mobwrite) handles connections: "threaded"
+# uses a thread per connection, "async" serves them all from one thread and
+# hands the questions to mobwrite_async_workers worker threads. Connections
+# are not read while mobwrite_async_max_pending questions are waiting.
+c.mobwrite_server_mode = "threaded"
+c.mobwrite_async_workers = 8
+c.mobwrite_async_max_pending = 256
+
+# If the texts and views held by a mobwrite server add up to more than
+# mobwrite_memory_budget bytes (0 for no limit), the least recently used
+# documents that nobody has touched for mobwrite_memory_min_idle seconds
+# are saved and unloaded. The mobwrite_texts, mobwrite_views and
+# mobwrite_memory_bytes stats gauge what the server holds. A view that has
+# not been used for two minutes is dropped anyway, so a shorter
+# mobwrite_memory_min_idle would unload documents that clients still have
+# open.
+c.mobwrite_memory_budget = 0
+c.mobwrite_memory_min_idle = 120
+
+# Partial mobwrite buffers (large requests sent in pieces) may hold up to
+# mobwrite_buffer_budget bytes in all (0 for no limit). Past that, the
+# least recently written ones are dropped.
+c.mobwrite_buffer_budget = 16 * 1024 * 1024
+
+# Responses to a mobwrite client repeat every edit it has not acknowledged.
+# Once those add up to more than mobwrite_edit_stack_budget bytes (0 for
+# no limit), the client is sent the whole text instead.
+c.mobwrite_edit_stack_budget = 256 * 1024
+
+# Which diff_match_patch implementation mobwrite uses: "python", "c" (the
+# optional compiled extension) or "auto" to use "c" when it is built.
+c.mobwrite_diff_backend = "auto"
+
 # if this is true, the user's UUID will be used as their
 # user directory name. If it's false, their username will
 # be used. Generally, you'll only want this to be false
@@ -304,7 +456,12 @@ def activate_profile():
         engine_options['pool_recycle'] = 14400
         
     c.dbengine = create_engine(c.dburl, **engine_options)
-    c.session_factory = scoped_session(sessionmaker(bind=c.dbengine))
+    from bespin import database
+    c.session_factory = scoped_session(sessionmaker(bind=c.dbengine,
+                            extension=database.AfterCommitExtension()))
+
+    c.user_cache_size = int(c.user_cache_size)
+    c.user_cache = database.UserCache(c.user_cache_size)
 
     c.fsroot = path(c.fsroot)
     c.gallery_root = c.fsroot / "gallery"
@@ -319,12 +476,27 @@ def activate_profile():
     if not c.fsroot.exists:
         c.fsroot.makedirs()
 
+    from bespin import queue
+    if isinstance(c.queue_workers, basestring):
+        c.queue_workers = [worker.strip().split(":")
+                           for worker in c.queue_workers.split(",")
+                           if worker.strip()]
+    c.queue_workers = [(name, int(count)) for name, count in c.queue_workers]
+    for name, count in c.queue_workers:
+        if name not in queue.QUEUES:
+            raise InvalidConfiguration("Unknown queue in queue_workers: %s"
+                                       % (name,))
+    c.queue_user_slots = int(c.queue_user_slots)
+    c.queue_processes = int(c.queue_processes)
+    c.queue_max_jobs = int(c.queue_max_jobs)
+    c.queue_health_timeout = float(c.queue_health_timeout)
+    c.queue_job_timeout = float(c.queue_job_timeout)
+    c.queue_shutdown_timeout = float(c.queue_shutdown_timeout)
+
     if c.async_jobs:
         if c.queue_port:
             c.queue_port = int(c.queue_port)
 
-        from bespin import queue
-
         if c.async_jobs is True or c.async_jobs == "beanstalk":
             c.queue = queue.BeanstalkQueue(c.queue_host, c.queue_port)
         elif c.async_jobs == "restmq":
@@ -333,7 +505,8 @@ def activate_profile():
     if c.redis_port:
         c.redis_port = int(c.redis_port)
 
-    if c.stats_type == "redis" or c.login_failure_tracking == "redis":
+    if c.stats_type == "redis" or c.login_failure_tracking == "redis" \
+        or c.inbox_type == "redis":
         from bespin import redis
         redis_client = redis.Redis(c.redis_host, c.redis_port)
     else:
@@ -348,6 +521,56 @@ def activate_profile():
     else:
         c.stats = stats.DoNothingStats()
 
+    from bespin import inbox
+    if c.inbox_type == "redis":
+        if not redis_client:
+            raise InvalidConfiguration("Inbox is set to redis, but redis is not configured")
+        c.inbox = inbox.RedisInbox(redis.Redis(c.redis_host, c.redis_port))
+    else:
+        c.inbox = inbox.DBInbox(float(c.inbox_poll_interval))
+    c.messages_max_wait = float(c.messages_max_wait)
+    c.channel_lifetime = float(c.channel_lifetime)
+    c.channel_heartbeat = float(c.channel_heartbeat)
+    c.channel_max_per_user = int(c.channel_max_per_user)
+    c.channel_max_open = int(c.channel_max_open)
+
+    c.mobwrite_server_port = int(c.mobwrite_server_port)
+    c.mobwrite_pool_size = int(c.mobwrite_pool_size)
+    c.mobwrite_pool_idle_timeout = float(c.mobwrite_pool_idle_timeout)
+    c.mobwrite_timeout = float(c.mobwrite_timeout)
+    if isinstance(c.mobwrite_shards, basestring):
+        c.mobwrite_shards = [shard.strip().split(":")
+                             for shard in c.mobwrite_shards.split(",")
+                             if shard.strip()]
+    c.mobwrite_shards = [(host, int(port)) for host, port in c.mobwrite_shards]
+    c.mobwrite_save_interval = float(c.mobwrite_save_interval)
+    c.mobwrite_save_max_pending = int(c.mobwrite_save_max_pending)
+    c.mobwrite_journal_compact_every = int(c.mobwrite_journal_compact_every)
+    c.mobwrite_journal_expiry = int(c.mobwrite_journal_expiry)
+    from bespin.mobwrite import storage
+    if c.mobwrite_storage not in storage.storages:
+        raise InvalidConfiguration("Unknown mobwrite_storage: %s"
+                                   % (c.mobwrite_storage,))
+    if not c.mobwrite_storage_file:
+        # not in fsroot itself, where it could clash with a user's directory
+        c.mobwrite_storage_file = c.fsroot.parent / "mobwrite" / "texts.sqlite"
+    c.mobwrite_storage_expiry = int(c.mobwrite_storage_expiry)
+    c.mobwrite_merge_idle = float(c.mobwrite_merge_idle)
+    if c.mobwrite_server_mode not in ("threaded", "async"):
+        raise InvalidConfiguration("Unknown mobwrite_server_mode: %s"
+                                   % (c.mobwrite_server_mode,))
+    c.mobwrite_async_workers = int(c.mobwrite_async_workers)
+    c.mobwrite_async_max_pending = int(c.mobwrite_async_max_pending)
+    c.mobwrite_memory_budget = int(c.mobwrite_memory_budget)
+    c.mobwrite_memory_min_idle = float(c.mobwrite_memory_min_idle)
+    c.mobwrite_buffer_budget = int(c.mobwrite_buffer_budget)
+    c.mobwrite_edit_stack_budget = int(c.mobwrite_edit_stack_budget)
+    from bespin.mobwrite import mobwrite_core
+    try:
+        mobwrite_core.use_dmp_backend(c.mobwrite_diff_backend)
+    except ValueError, e:
+        raise InvalidConfiguration(str(e))
+
     if isinstance(c.stats_users, basestring):
         c.stats_users = set(c.stats_users.split(','))
     if isinstance(c.stats_display, basestring):
@@ -46,6 +46,8 @@ import urllib
 from hashlib import sha256
 import re
 import md5
+import time
+import threading
 
 from urlrelay import URLRelay, register
 from paste.auth import auth_tkt
@@ -59,9 +61,10 @@ from bespin.config import c
 from bespin.framework import expose, BadRequest
 from bespin import vcs, deploy
 from bespin.database import User, get_project, log_event, GalleryPlugin
+from bespin import database
 from bespin.filesystem import NotAuthorized, OverQuota, File, FileNotFound
 from bespin.utils import send_email_template
-from bespin import filesystem, queue, plugins
+from bespin import filesystem, queue, plugins, notify
 from bespin.plugins import get_user_plugin_path, get_user_plugin_info
 
 log = logging.getLogger("bespin.controllers")
@@ -407,7 +410,7 @@ def rescan_project(request, response):
     project_name = request.kwargs['project_name']
     project = get_project(user, user, project_name)
     job_body = dict(user=user.username, project=project_name)
-    jobid = queue.enqueue("vcs", job_body, execute="bespin.filesystem:rescan_project",
+    jobid = queue.enqueue("files", job_body, execute="bespin.filesystem:rescan_project",
                         error_handler="bespin.vcs:vcs_error",
                         use_db=True)
     response.content_type = "application/json"
@@ -703,28 +706,7 @@ def _users_following_response(user, response):
     return response()
 
 def _tell_file_event(user, project, path, event):
-    followers = user.users_following_me()
-    followers = [follower.following.username for follower in followers if follower.following]
-    # find the owner
-    isMyProject = _is_project_shared(project, user)
-    for follower in followers:
-        #try:
-            member = User.find_user(follower)
-            if isMyProject and _is_project_shared(project, member):
-                # we can safely send a message
-                member.publish({
-                    'msgtargetid': 'file_event',
-                    'from':    user.username,
-                    'event':   event,
-                    'project': project.name,
-                    'owner':   project.owner.username,
-                    'path':    path,
-                })
-        #except:
-            #pass
-    
-def _is_project_shared(project, user):
-    return project.owner.username == user.username or project.owner.is_project_shared(project, user)
+    notify.tell_file_event(user, project, path, event)
 
 @expose(r'^/share/list/all/$', 'GET')
 def share_list_all(request, response):
@@ -785,23 +767,9 @@ def share_tell(request, response):
     else:
         owner = user
     project = get_project(user, owner, project_name)
-    isMyProject = _is_project_shared(project, user)
     # notify recipients
-    list = []
     recipients = post.get('recipients', [])
-    for recipient in recipients:
-        #try:
-            member = User.find_user(recipient)
-            if isMyProject and _is_project_shared(project, member):
-                # we can safely send a message
-                member.publish({
-                    'msgtargetid': 'share_tell',
-                    'from': user.username,
-                    'text': text
-                })
-                list.append(recipient)
-        #except:
-        #    pass
+    list = notify.share_tell(user, project, recipients, text)
     response.body = simplejson.dumps(list)
     response.content_type = "text/plain"
     return response()
@@ -830,6 +798,7 @@ def viewme_set(request, response):
 
 from bespin.mobwrite.mobwrite_daemon import DaemonMobWrite
 from bespin.mobwrite.mobwrite_daemon import maybe_cleanup
+from bespin.mobwrite import transport, sharding
 
 class MobwriteInProcess(DaemonMobWrite):
     "Talk to an in-process mobwrite"
@@ -840,36 +809,68 @@ class MobwriteInProcess(DaemonMobWrite):
         maybe_cleanup()
         return answer
 
-class MobwriteTelnetProxy():
-    "Talk to mobwrite using port 3017"
+class MobwriteTelnetProxy(object):
+    "Talk to mobwrite using port 3017, over pooled keep-alive connections"
+
+    def __init__(self):
+        self.pool = _make_mobwrite_pool(transport.TelnetConnection)
 
     def processRequest(self, question):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((c.mobwrite_server_address, c.mobwrite_server_port))
-        s.send(question)
-        answer = ''
-        while True:
-            line = s.recv(1024)
-            if not line:
-                break
-            answer += line
-        s.close()
-        return answer
+        try:
+            return self.pool.request(question)
+        except transport.TransportError, e:
+            raise BadRequest(str(e))
+
+class MobwriteHttpProxy(object):
+    "Talk to mobwrite over HTTP, over pooled keep-alive connections"
 
-class MobwriteHttpProxy():
-    "Talk to mobwrite over HTTP"
+    def __init__(self):
+        self.pool = _make_mobwrite_pool(transport.HttpConnection)
 
     def processRequest(self, question):
-        url = "http://%s:%s/" % (c.mobwrite_server_address,
-                                 c.mobwrite_server_port)
         try:
-            datafile = urllib2.urlopen(url, question)
-        except urllib2.URLError, e:
+            return self.pool.request(question)
+        except transport.TransportError, e:
             raise BadRequest(str(e))
 
-        answer = datafile.read()
-        datafile.close()
-        return answer
+class MobwriteShardedProxy(object):
+    "Talk to the mobwrite shards in c.mobwrite_shards over telnet"
+
+    def __init__(self):
+        pools = [_make_mobwrite_pool(transport.TelnetConnection, host, port)
+                 for host, port in c.mobwrite_shards]
+        self.router = sharding.ShardRouter(pools)
+
+    def processRequest(self, question):
+        try:
+            return self.router.request(question)
+        except transport.TransportError, e:
+            raise BadRequest(str(e))
+
+def _make_mobwrite_pool(connection_class, host=None, port=None):
+    host = host or c.mobwrite_server_address
+    port = port or c.mobwrite_server_port
+    def factory():
+        return connection_class(host, port, c.mobwrite_timeout)
+    return transport.ConnectionPool(factory, c.mobwrite_pool_size,
+                                    c.mobwrite_pool_idle_timeout)
+
+_mobwrite_implementations = dict(MobwriteInProcess=MobwriteInProcess,
+                                 MobwriteTelnetProxy=MobwriteTelnetProxy,
+                                 MobwriteHttpProxy=MobwriteHttpProxy,
+                                 MobwriteShardedProxy=MobwriteShardedProxy)
+_mobwrite_workers = {}
+
+def _get_mobwrite_worker():
+    """Returns the worker for c.mobwrite_implementation. Workers are kept
+    for the life of the process, so the proxies' connection pools are
+    shared by all requests."""
+    name = c.mobwrite_implementation
+    worker = _mobwrite_workers.get(name)
+    if worker is None:
+        worker = _mobwrite_implementations[name]()
+        _mobwrite_workers[name] = worker
+    return worker
 
 @expose(r'^/mobwrite/$', 'POST')
 def mobwrite(request, response):
@@ -890,13 +891,7 @@ def mobwrite(request, response):
     question = question[2:]
     question = "H:" + str(request.user.username) + "\n" + question
 
-    # Java: Class.forName(...) There *has* to be a better way in python?
-    if c.mobwrite_implementation == "MobwriteInProcess":
-        worker = MobwriteInProcess()
-    if c.mobwrite_implementation == "MobwriteTelnetProxy":
-        worker = MobwriteTelnetProxy()
-    if c.mobwrite_implementation == "MobwriteHttpProxy":
-        worker = MobwriteHttpProxy()
+    worker = _get_mobwrite_worker()
 
     #log.debug("\n\nQUESTION:\n" + question);
     answer = worker.processRequest(question)
@@ -1050,13 +1045,7 @@ def ask_mobwrite(question, user):
     c.stats.incr("mobwrite_DATE")
     question = "H:" + str(user.username) + "\n" + question
 
-    # Java: Class.forName(...) There *has* to be a better way in python?
-    if c.mobwrite_implementation == "MobwriteInProcess":
-        worker = MobwriteInProcess()
-    if c.mobwrite_implementation == "MobwriteTelnetProxy":
-        worker = MobwriteTelnetProxy()
-    if c.mobwrite_implementation == "MobwriteHttpProxy":
-        worker = MobwriteHttpProxy()
+    worker = _get_mobwrite_worker()
 
     #log.debug("\n\nQUESTION:\n" + question);
     answer = worker.processRequest(question)
@@ -1072,20 +1061,158 @@ def messages(request, response):
         body = u"[]"
     else:
         question = request.body
-        msgs = [simplejson.loads(msg) for msg in user.pop_messages()]
+        # a client with nothing to send to mobwrite can ask to wait
+        # for messages instead of polling again
+        wait = 0
+        if not question.strip():
+            try:
+                wait = float(request.GET.get("wait", 0))
+            except ValueError:
+                raise BadRequest("wait must be a number")
+            wait = max(0, min(wait, c.messages_max_wait))
+        msgs = [simplejson.loads(msg) for msg in user.pop_messages(wait)]
         if "collab" in c.capabilities:
-            answer = ask_mobwrite(question, user) + "\n\n"
-            msgs.append({
-                "msgtargetid": "mobwrite",
-                "from": user.username,
-                "text": answer
-            })
+            msgs.append(_mobwrite_message(question, user))
         body = simplejson.dumps(msgs)
 
     response.content_type = "application/json"
     response.body = body.encode("utf8")
     return response()
 
+def _mobwrite_message(question, user):
+    """Wraps the mobwrite answer to question in a message for the
+    mobwrite target on the client."""
+    answer = ask_mobwrite(question, user) + "\n\n"
+    return {
+        "msgtargetid": "mobwrite",
+        "from": user.username,
+        "text": answer
+    }
+
+@expose("^/channel/$", 'POST')
+def channel(request, response):
+    """Streams the user's messages over one long-lived response.
+
+    The body is handled like a /messages/ request: the first frame holds
+    the waiting messages and, if the body has a mobwrite question, its
+    answer. After that, new messages (job progress, file events and so
+    on) are pushed as they arrive. Each frame is a JSON list on a line of
+    its own. An empty list is sent every c.channel_heartbeat seconds when
+    nothing happens, and the response ends after c.channel_lifetime
+    seconds, at which point the client reconnects.
+
+    Only the question in the opening request is answered here. Mobwrite
+    answers are not pushed, so while the channel is open the client keeps
+    sending its edits to /mobwrite/ or /messages/. A user can hold at
+    most c.channel_max_per_user channels open at once, and a process no
+    more than c.channel_max_open; past that, the client is told to poll
+    /messages/ instead (503)."""
+    c.stats.incr("channel_DATE")
+    user = request.user
+    refused = _open_channel(user.id)
+    if refused == "process":
+        response.status = "503 Service Unavailable"
+        response.headers['Retry-After'] = str(int(c.channel_lifetime))
+        response.content_type = "text/plain"
+        response.body = "Too many open channels, use /messages/"
+        return response()
+    if refused == "user":
+        raise database.ConflictError("Too many open channels")
+    try:
+        question = request.body
+        msgs = [simplejson.loads(msg) for msg in user.pop_messages()]
+        if "collab" in c.capabilities and question.strip():
+            msgs.append(_mobwrite_message(question, user))
+    except:
+        _close_channel(user.id)
+        raise
+
+    response.content_type = "application/json"
+    response.app_iter = ChannelFrames(user.id, msgs)
+    return response()
+
+# user id -> number of channels open in this process
+_open_channels = {}
+_channels_lock = threading.Lock()
+
+def _open_channel(user_id):
+    """Counts a channel opened for user_id. Returns None, or "user" or
+    "process" if that has too many channels open already."""
+    _channels_lock.acquire()
+    try:
+        count = _open_channels.get(user_id, 0)
+        if count >= c.channel_max_per_user:
+            return "user"
+        if sum(_open_channels.values()) >= c.channel_max_open:
+            return "process"
+        _open_channels[user_id] = count + 1
+        return None
+    finally:
+        _channels_lock.release()
+
+def _close_channel(user_id):
+    _channels_lock.acquire()
+    try:
+        count = _open_channels.get(user_id, 0) - 1
+        if count > 0:
+            _open_channels[user_id] = count
+        else:
+            _open_channels.pop(user_id, None)
+    finally:
+        _channels_lock.release()
+
+class ChannelFrames(object):
+    """The body of a channel response. This is read after db_middleware
+    has committed the request, so it commits the messages it pops
+    itself. Messages are only committed as popped once the server has
+    asked for the next frame, which means that the previous one was
+    written out. If the client goes away first, close() puts them back
+    in the inbox."""
+
+    def __init__(self, user_id, first_frame):
+        self.user_id = user_id
+        self.first_frame = first_frame
+        self.session = None
+        self.deadline = None
+        self.pending = []
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.first_frame is not None:
+            frame = self.first_frame
+            self.first_frame = None
+            self.session = c.session_factory()
+            self.deadline = time.time() + c.channel_lifetime
+            return simplejson.dumps(frame) + "\n"
+
+        if self.pending:
+            self.session.commit()
+            self.pending = []
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise StopIteration
+        self.pending = c.inbox.pop(self.user_id,
+                                   min(c.channel_heartbeat, remaining))
+        return simplejson.dumps([simplejson.loads(msg)
+                                 for msg in self.pending]) + "\n"
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.pending:
+                c.inbox.unpop(self.user_id, self.pending)
+                self.pending = []
+            if self.session is not None:
+                self.session.rollback()
+        finally:
+            _close_channel(self.user_id)
+            c.stats.disconnect()
+
 @expose('^/stats/$', 'GET')
 def stats(request, response):
     username = request.username
@@ -1494,6 +1621,7 @@ def db_middleware(app):
         from sqlalchemy.orm import scoped_session
         session = c.session_factory()
         environ['bespin.docommit'] = True
+        database.begin_identity_map()
         try:
             # If you need to work out what <script> tags to insert into a
             # page to get Dojo to behave properly, then uncomment these 3
@@ -1513,6 +1641,8 @@ def db_middleware(app):
             c.stats.incr("exceptions_DATE")
             log.exception("Error raised during request: %s", environ)
             raise
+        finally:
+            database.end_identity_map()
         c.stats.disconnect()
         return result
     return wrapped
@@ -38,6 +38,8 @@
 """Data classes for working with files/projects/users."""
 from datetime import datetime
 import logging
+import threading
+from collections import OrderedDict
 from uuid import uuid4
 import simplejson
 from hashlib import sha256
@@ -48,10 +50,11 @@ from pathutils import LockError as PULockError, Lock, LockFile
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import (Column, PickleType, String, Integer,
                     Boolean, ForeignKey, Binary,
-                    DateTime, Text, Table)
-from sqlalchemy.orm import relation
+                    DateTime, Text, Table, select, and_, or_, union_all)
+from sqlalchemy.orm import (relation, MapperExtension, SessionExtension,
+                            EXT_CONTINUE)
 from sqlalchemy.exc import DBAPIError
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.schema import UniqueConstraint, Index
 
 from bespin import config, filesystem
 from bespin.utils import _check_identifiers, BadValue
@@ -70,6 +73,147 @@ def debug():
 def _get_session():
     return config.c.session_factory()
 
+def _user_location(file_location):
+    if file_location.startswith("/"):
+        location = path_obj(file_location)
+    else:
+        location = config.c.fsroot / file_location
+    if not location.exists():
+        location.makedirs()
+    return location
+
+class UserInfo(object):
+    """The parts of a users row that never change. They are enough to find
+    a user's files and to check what the user may see, without loading
+    the User (see User.find_info)."""
+    __slots__ = ("id", "uuid", "username", "file_location")
+
+    def __init__(self, id, uuid, username, file_location):
+        self.id = id
+        self.uuid = uuid
+        self.username = username
+        self.file_location = file_location
+
+    def get_location(self):
+        return _user_location(self.file_location)
+
+class UserCache(object):
+    """Process-level cache of username -> UserInfo.
+
+    Only the parts of a user record that never change are kept here, so
+    it is safe for several processes to each have their own copy. Entries
+    are still dropped whenever the users row is updated or deleted
+    (password, settings, quota...) so that lookups go back to the
+    database after any change. Once full, the least recently used entry
+    makes way for a new one. A size of 0 turns the cache off."""
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, username):
+        self.lock.acquire()
+        try:
+            info = self.entries.pop(username, None)
+            if info is not None:
+                self.entries[username] = info
+            return info
+        finally:
+            self.lock.release()
+
+    def put(self, info):
+        if not self.size:
+            return
+        self.lock.acquire()
+        try:
+            self.entries.pop(info.username, None)
+            while len(self.entries) >= self.size:
+                self.entries.popitem(last=False)
+            self.entries[info.username] = info
+        finally:
+            self.lock.release()
+
+    def invalidate(self, username):
+        self.lock.acquire()
+        try:
+            self.entries.pop(username, None)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+# Per-request identity map of username -> User. It is only active between
+# begin_identity_map() and end_identity_map() (the db_middleware and the
+# queue worker do this), so code running outside of a request always goes
+# to the session.
+_identity = threading.local()
+
+def begin_identity_map():
+    depth = getattr(_identity, "depth", 0)
+    if not depth:
+        _identity.users = {}
+    _identity.depth = depth + 1
+
+def end_identity_map():
+    depth = getattr(_identity, "depth", 0) - 1
+    if depth <= 0:
+        depth = 0
+        _identity.users = None
+    _identity.depth = depth
+
+# Callbacks waiting for the current thread's transaction to commit (see
+# after_commit). Sessions are scoped per thread, so this is too.
+_pending_commit = threading.local()
+
+def after_commit(callback):
+    """Calls callback() once the current thread's session has committed.
+    If the session is rolled back instead, callback is forgotten."""
+    callbacks = getattr(_pending_commit, "callbacks", None)
+    if callbacks is None:
+        callbacks = _pending_commit.callbacks = []
+    if callback not in callbacks:
+        callbacks.append(callback)
+
+class AfterCommitExtension(SessionExtension):
+    """Runs the callbacks registered with after_commit."""
+    def after_commit(self, session):
+        callbacks = getattr(_pending_commit, "callbacks", None)
+        _pending_commit.callbacks = None
+        for callback in callbacks or []:
+            try:
+                callback()
+            except:
+                log.exception("Error in after_commit callback")
+
+    def after_rollback(self, session):
+        _pending_commit.callbacks = None
+
+def _get_user_cache():
+    return config.c.get("user_cache")
+
+class _UserCacheExtension(MapperExtension):
+    """Keeps the process-level UserCache honest."""
+    def after_update(self, mapper, connection, instance):
+        cache = _get_user_cache()
+        if cache is not None:
+            cache.invalidate(instance.username)
+        return EXT_CONTINUE
+
+    def after_delete(self, mapper, connection, instance):
+        cache = _get_user_cache()
+        if cache is not None:
+            cache.invalidate(instance.username)
+        users = getattr(_identity, "users", None)
+        if users:
+            users.pop(instance.username, None)
+        return EXT_CONTINUE
+
 Base = declarative_base()
 
 class Connection(Base):
@@ -93,6 +237,10 @@ class Message(Base):
     def __str__(self):
         return "Message[id=%s, msg=%s]" % (self.id, self.message)
 
+# messages are always read and removed per user, oldest first
+Index("ix_messages_user_id_id", Message.__table__.c.user_id,
+      Message.__table__.c.id)
+
 class User(Base):
     __tablename__ = "users"
 
@@ -117,8 +265,9 @@ class User(Base):
                             primaryjoin=Connection.followed_id==id,
                             secondary=Connection.__table__,
                             secondaryjoin=id==Connection.following_id)
-                    
-                    
+
+    __mapper_args__ = {'extension': _UserCacheExtension()}
+
     @staticmethod
     def generate_password(password):
         password_hash = sha256()
@@ -161,13 +310,49 @@ class User(Base):
                 return None
             user = users[0]
         else:
-            user = _get_session().query(cls).filter_by(username=username).first()
+            user = cls._find_by_username(username)
         if user and password is not None:
             digest = User.generate_password(password)
             if str(user.password) != digest:
                 user = None
         return user
         
+    @classmethod
+    def _find_by_username(cls, username):
+        """Resolves a username through the request's identity map before
+        falling back to a query."""
+        session = _get_session()
+        users = getattr(_identity, "users", None)
+        if users is not None:
+            user = users.get(username)
+            if user is not None and user in session:
+                return user
+
+        user = session.query(cls).filter_by(username=username).first()
+        if users is not None and user is not None:
+            users[username] = user
+        return user
+
+    @classmethod
+    def find_info(cls, username):
+        """Looks up the UserInfo for a username, from the process-level
+        UserCache if it is there. Returns None if the user is not found.
+        Code that only needs a user's id, uuid or files should use this
+        rather than find_user, as no User is loaded."""
+        cache = _get_user_cache()
+        if cache is not None:
+            info = cache.get(username)
+            if info is not None:
+                return info
+        row = _get_session().query(cls.id, cls.uuid, cls.file_location) \
+            .filter_by(username=username).first()
+        if row is None:
+            return None
+        info = UserInfo(row[0], row[1], username, row[2])
+        if cache is not None:
+            cache.put(info)
+        return info
+
     @classmethod
     def find_by_email(cls, email):
         """Looks up a user by email address."""
@@ -207,14 +392,7 @@ class User(Base):
         return (self.quota * filesystem.QUOTA_UNITS, self.amount_used)
 
     def get_location(self):
-        file_loc = self.file_location
-        if file_loc.startswith("/"):
-            location = path_obj(file_loc)
-        else:
-            location = config.c.fsroot / file_loc
-        if not location.exists():
-            location.makedirs()
-        return location
+        return _user_location(self.file_location)
 
     @property
     def projects(self):
@@ -605,17 +783,14 @@ class User(Base):
         return [ "Not implemented", member, value ]
 
     def publish(self, message_obj):
-        data = simplejson.dumps(message_obj)
-        message = Message(user=self, message=data)
-        self.messages.append(message)
-        print(message)
-
-    def pop_messages(self):
-        messages = []
-        for message in self.messages:
-            messages.append(message.message)
-            _get_session().delete(message)
-        return messages
+        config.c.inbox.publish(self.id, message_obj)
+
+    def pop_messages(self, wait=0):
+        """Returns the JSON strings of the messages waiting for this
+        user and removes them from the inbox. If wait is given and
+        there are no messages, waits up to that many seconds for
+        one to arrive."""
+        return config.c.inbox.pop(self.id, wait)
 
 class Group(Base):
     __tablename__ = "groups"
@@ -756,6 +931,57 @@ class EveryoneSharing(Base):
     def invited_name(self):
         return 'everyone'
 
+def get_shared_access(user, projects):
+    """Works out how user may use each of the given projects, which are
+    (owner, project_name) pairs belonging to other people. This gives
+    the same answers as calling owner.is_project_shared for every pair,
+    but looks at all three sharing tables in a single statement.
+
+    Returns a dictionary that maps (owner.id, project_name) to True for
+    the projects user may edit and False for the ones user may only
+    read. Projects that are not shared with user are left out."""
+    names_by_owner = {}
+    for owner, project_name in projects:
+        if isinstance(project_name, Project):
+            project_name = project_name.name
+        names_by_owner.setdefault(owner.id, set()).add(project_name)
+    if not names_by_owner:
+        return {}
+
+    def shared(table):
+        return or_(*[and_(table.c.owner_id == owner_id,
+                          table.c.project_name.in_(list(names)))
+                     for owner_id, names in names_by_owner.items()])
+
+    everyone = EveryoneSharing.__table__
+    user_sharing = UserSharing.__table__
+    group_sharing = GroupSharing.__table__
+    memberships = GroupMembership.__table__
+
+    query = union_all(
+        select([everyone.c.owner_id, everyone.c.project_name,
+                everyone.c.edit],
+               shared(everyone)),
+        select([user_sharing.c.owner_id, user_sharing.c.project_name,
+                user_sharing.c.edit],
+               and_(shared(user_sharing),
+                    user_sharing.c.invited_user_id == user.id)),
+        select([group_sharing.c.owner_id, group_sharing.c.project_name,
+                group_sharing.c.edit],
+               and_(shared(group_sharing),
+                    group_sharing.c.invited_group_id == memberships.c.group_id,
+                    memberships.c.user_id == user.id)))
+    # a plain connection.execute() skips the session's autoflush, and
+    # the sharing rows may have been added in this transaction
+    session = _get_session()
+    session.flush()
+    result = {}
+    for owner_id, project_name, edit in \
+            session.connection().execute(query).fetchall():
+        key = (owner_id, project_name)
+        result[key] = result.get(key, False) or bool(edit)
+    return result
+
 EventLog = Table('eventlog', Base.metadata, 
     Column('ts', DateTime, default=datetime.now),
     Column('kind', String(10)),
@@ -0,0 +1,22 @@
+from sqlalchemy import *
+from migrate import *
+
+metadata = MetaData()
+metadata.bind = migrate_engine
+
+messages = Table('messages', metadata, autoload=True)
+
+messages_user_id_index = Index('ix_messages_user_id_id',
+                               messages.c.user_id, messages.c.id)
+
+def upgrade():
+    # Upgrade operations go here. Don't create your own engine; use the engine
+    # named 'migrate_engine' imported from migrate.
+    
+    messages_user_id_index.create(bind=migrate_engine)
+    
+
+def downgrade():
+    # Operations to reverse the above upgrade go here.
+    
+    messages_user_id_index.drop(bind=migrate_engine)
@@ -47,9 +47,9 @@ from omnisync.main import OmniSync
 from omnisync.configuration import Configuration
 
 from bespin.vcs import KeyChain, TempSSHKeyFile
-from bespin import queue
+from bespin import config, queue
 from bespin.filesystem import get_project
-from bespin.database import User, Message, _get_session
+from bespin.database import User, _get_session
 
 
 log = logging.getLogger("bespin.deploy")
@@ -188,8 +188,7 @@ def deploy_error(qi, e):
         message = dict(jobid=qi.id, output=dict(output=tb, 
             error=True))
         message['asyncDone'] = True
-        retval = Message(user_id=user.id, message=dumps(message))
-        s.add(retval)
+        config.c.inbox.publish(user.id, message)
     
 def run_deploy(user, project, kcpass, options):
     """Add the deployment request to the worker queue."""
@@ -200,7 +199,7 @@ def run_deploy(user, project, kcpass, options):
     project = project.name
     job_body = dict(user=user, project=project, kcpass=kcpass, 
                     options=options)
-    return queue.enqueue("vcs", job_body, execute="bespin.deploy:deploy_impl",
+    return queue.enqueue("deploy", job_body, execute="bespin.deploy:deploy_impl",
                         error_handler="bespin.deploy:deploy_error",
                         use_db=True)
     
@@ -246,8 +245,7 @@ def deploy_impl(qi):
         result = dict(output=dict(output=output, error=error))
 
         result.update(dict(jobid=qi.id, asyncDone=True))
-        retvalue = Message(user_id=user.id, message=dumps(result))
-        s.add(retvalue)
+        config.c.inbox.publish(user.id, result)
     finally:
         if keyfile:
             keyfile.delete()
@@ -300,9 +298,7 @@ class BespinOmniSync(OmniSync):
             message_body = dict(jobid=self.qid, asyncDone=False, 
                 output="%s files and %s bytes copied" % (
                     self.file_counter, self.bytes_total))
-            message = Message(user_id = self.user_id,
-                message=dumps(message_body))
-            s.add(message)
+            config.c.inbox.publish(self.user_id, message_body)
             s.commit()
             
             self.last_display_time = time.time()
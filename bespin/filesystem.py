@@ -261,7 +261,11 @@ class File(object):
         return self.info['modified_time']
 
     def save(self, contents):
-        _save(self.location, contents)
+        # Written beside the file and moved into place, so that readers
+        # never see half a file.
+        partial = self.location.dirname() / (".%s.partial" % self.short_name)
+        _save(partial, contents)
+        partial.rename(self.location)
 
     @property
     def statusfile(self):
@@ -352,10 +356,28 @@ def rescan_project(qi):
     user = database.User.find_user(message['user'])
     project = get_project(user, user, message['project'])
     project.scan_files()
-    retvalue = database.Message(user_id=user.id, message=simplejson.dumps(
-            dict(asyncDone=True,
-            jobid=qi.id, output="Rescan complete")))
-    s.add(retvalue)
+    config.c.inbox.publish(user.id, dict(asyncDone=True,
+            jobid=qi.id, output="Rescan complete"))
+
+def merge_temp_files_run(qi):
+    """Runs the merge of a project's mobwrite temp files into its real
+    files (see Project.merge_temp_files)"""
+    from bespin import database
+
+    message = qi.message
+    owner = database.User.find_user(message['owner'])
+    if owner is None:
+        return
+    try:
+        project = get_project(owner, owner, message['project'])
+    except FileNotFound:
+        return
+    project.merge_temp_files(message.get('idle', 0))
+
+def merge_temp_files_error(qi, e):
+    """Merges are retried the next time the project is edited, so the user
+    is not told about failures."""
+    log.error("Unable to merge temp files for %s: %s", qi.message, e)
     
 
 class Project(object):
@@ -437,8 +459,7 @@ class Project(object):
         while destpath and destpath.startswith("/"):
             destpath = destpath[1:]
 
-        temp_name = get_temp_file_name(self.name, destpath)
-        file_loc = self.location.parent / temp_name
+        file_loc = self._temp_location(destpath)
 
         if file_loc.isdir():
             raise FileConflict("Cannot save file at %s in project "
@@ -452,6 +473,75 @@ class Project(object):
         log.debug("save_temp_file to %s", file_loc)
         _save(file_loc, contents)
 
+    def _temp_location(self, path):
+        return self.location.parent / get_temp_file_name(self.name, path)
+
+    def merge_temp_files(self, idle=0):
+        """Copies the collaborative edits that save_temp_file has kept
+        into the real files, for the temp files that have been left alone
+        for at least idle seconds. The real files are saved with
+        save_file, so the quota and the search cache are kept up to date.
+        Temp files that match their real file and that nobody has open are
+        then removed. Returns the number of files written.
+
+        A real file that has been saved since its temp file was last
+        written (outside of mobwrite) is not overwritten. The temp file is
+        left alone and a warning is logged, so that the two versions can
+        be reconciled by hand."""
+        temp_dir = self.location.parent / get_temp_file_name(self.name, "")
+        if not temp_dir.exists():
+            return 0
+
+        written = 0
+        removed = 0
+        cutoff = time.time() - idle
+        for temp_loc in list(temp_dir.walkfiles()):
+            stat = temp_loc.stat()
+            if stat.st_mtime > cutoff:
+                continue
+            path = temp_dir.relpathto(temp_loc)
+            try:
+                file_obj = File(self, path)
+            except FSException, e:
+                log.warning("Not merging temp file %s of %s: %s",
+                            path, self.name, e)
+                continue
+            contents = temp_loc.bytes()
+            if file_obj.exists():
+                unchanged = file_obj.data == contents
+            else:
+                # An empty temp file is only a placeholder for a new file.
+                unchanged = contents == ""
+            if not unchanged and file_obj.exists() and \
+                    file_obj.location.mtime > stat.st_mtime:
+                log.warning("Not merging temp file %s of %s: the real file "
+                            "is newer", path, self.name)
+                continue
+            if not unchanged:
+                try:
+                    self.save_file(path, contents)
+                except OverQuota:
+                    log.warning("Not merging temp file %s of %s: over quota",
+                                path, self.name)
+                    continue
+                written += 1
+            if file_obj.users:
+                continue
+            # Leave it if mobwrite has saved it again in the meantime.
+            now = temp_loc.stat()
+            if (now.st_mtime, now.st_size) == (stat.st_mtime, stat.st_size):
+                temp_loc.remove()
+                removed += 1
+
+        for dirpath in sorted(temp_dir.walkdirs(), reverse=True):
+            if not dirpath.listdir():
+                dirpath.rmdir()
+        if not temp_dir.listdir():
+            temp_dir.rmdir()
+        log.debug("Merged %s temp files of %s and removed %s",
+                  written, self.name, removed)
+        return written
+
     def create_directory(self, destpath):
         """Create a new directory"""
         if "../" in destpath:
@@ -852,7 +942,7 @@ class ProjectView(Project):
             raise BadValue("Relative directories are not allowed")
 
         # Load from the temp file first
-        file_loc = self.location / get_temp_file_name(self.name, path)
+        file_loc = self._temp_location(path)
         if file_loc.exists():
             log.debug("get_temp_file path=%s" % file_loc)
             return str(file_loc.bytes())
@@ -0,0 +1,210 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""Per-user message inboxes.
+
+Messages are the JSON blobs that the client picks up from /messages/.
+An inbox supports publishing to one or many users and popping everything
+that is waiting for a user in one operation, optionally waiting (long
+polling) until something arrives.
+"""
+
+import time
+import threading
+import logging
+
+import simplejson
+from sqlalchemy import select, and_
+
+from bespin.database import Message, _get_session, after_commit
+
+log = logging.getLogger("bespin.inbox")
+
+class DBInbox(object):
+    """Keeps the messages in the messages table. Pops are done with
+    one indexed SELECT on (user_id, id) followed by a single DELETE up
+    to the last id seen, rather than loading and deleting through
+    the ORM.
+
+    Waiters in this process are woken up as soon as the transaction
+    that published a message here commits. Messages published by other processes are picked up
+    by rechecking every poll_interval seconds."""
+
+    def __init__(self, poll_interval=1.0):
+        self.poll_interval = poll_interval
+        self.condition = threading.Condition()
+
+    def publish(self, user_id, message_obj):
+        self.publish_many([user_id], message_obj)
+
+    def publish_many(self, user_ids, message_obj):
+        """Adds message_obj to the inbox of every user in user_ids using
+        a single multi-row insert."""
+        if not user_ids:
+            return 0
+        data = simplejson.dumps(message_obj)
+        rows = [dict(user_id=user_id, message=data) for user_id in user_ids]
+        _get_session().connection().execute(Message.__table__.insert(), rows)
+        # waiters use their own sessions, so they can't see the rows yet
+        after_commit(self._notify)
+        return len(rows)
+
+    def _notify(self):
+        self.condition.acquire()
+        try:
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def _pop(self, user_id):
+        messages = Message.__table__
+        connection = _get_session().connection()
+        rows = connection.execute(
+            select([messages.c.id, messages.c.message],
+                   messages.c.user_id == user_id,
+                   order_by=[messages.c.id], for_update=True)).fetchall()
+        if not rows:
+            return []
+        connection.execute(messages.delete(and_(
+            messages.c.user_id == user_id, messages.c.id <= rows[-1][0])))
+        return [row[1] for row in rows]
+
+    def pop(self, user_id, wait=0):
+        """Removes and returns the messages (as JSON strings) waiting for
+        user_id, oldest first. If there are none and wait is given, blocks
+        for up to wait seconds for one to arrive."""
+        result = self._pop(user_id)
+        if result or not wait:
+            return result
+
+        session = _get_session()
+        deadline = time.time() + wait
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return []
+            self.condition.acquire()
+            try:
+                self.condition.wait(min(self.poll_interval, remaining))
+            finally:
+                self.condition.release()
+            # end the current transaction so that rows committed by
+            # other sessions become visible
+            session.commit()
+            result = self._pop(user_id)
+            if result:
+                return result
+
+    def unpop(self, user_id, messages):
+        """Puts messages popped in the current transaction back in front
+        of the inbox, because they could not be delivered. The caller
+        rolls the transaction back afterwards, which is all that is
+        needed here."""
+        pass
+
+class RedisInbox(object):
+    """Keeps each user's messages in a redis list. Waiting is done with
+    BLPOP on a connection of its own, so that a long poll does not tie
+    up the shared client.
+
+    Unlike DBInbox, messages are visible as soon as they are published,
+    even if the surrounding database transaction is later rolled
+    back."""
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.lock = threading.Lock()
+
+    def _key(self, user_id):
+        return "inbox_%s" % user_id
+
+    def publish(self, user_id, message_obj):
+        self.publish_many([user_id], message_obj)
+
+    def publish_many(self, user_ids, message_obj):
+        data = simplejson.dumps(message_obj)
+        self.lock.acquire()
+        try:
+            for user_id in user_ids:
+                self.redis.push(self._key(user_id), data)
+        finally:
+            self.lock.release()
+        return len(user_ids)
+
+    def _pop(self, user_id):
+        # one LPOP at a time, so that no message can be pushed between
+        # reading the list and trimming it and then be lost, even if
+        # another process is popping the same inbox
+        key = self._key(user_id)
+        result = []
+        self.lock.acquire()
+        try:
+            while True:
+                item = self.redis.pop(key)
+                if item is None:
+                    break
+                result.append(item)
+        finally:
+            self.lock.release()
+        return result
+
+    def pop(self, user_id, wait=0):
+        result = self._pop(user_id)
+        if result or not wait:
+            return result
+
+        from bespin import redis
+        client = redis.Redis(self.redis.host, self.redis.port,
+                             db=self.redis.db)
+        try:
+            item = client.blpop([self._key(user_id)], max(int(wait), 1))
+        finally:
+            client.disconnect()
+        if item is None:
+            return []
+        return [item[1]] + self._pop(user_id)
+
+    def unpop(self, user_id, messages):
+        """Puts messages back in front of the inbox, because they could
+        not be delivered."""
+        key = self._key(user_id)
+        self.lock.acquire()
+        try:
+            for message in reversed(messages):
+                self.redis.push(key, message, tail=True)
+        finally:
+            self.lock.release()
@@ -0,0 +1,378 @@
+/* ***** BEGIN LICENSE BLOCK *****
+ * Version: MPL 1.1/GPL 2.0/LGPL 2.1
+ *
+ * The contents of this file are subject to the Mozilla Public License Version
+ * 1.1 (the "License"); you may not use this file except in compliance with
+ * the License. You may obtain a copy of the License at
+ * http://www.mozilla.org/MPL/
+ *
+ * Software distributed under the License is distributed on an "AS IS" basis,
+ * WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+ * for the specific language governing rights and limitations under the
+ * License.
+ *
+ * The Original Code is Bespin.
+ *
+ * The Initial Developer of the Original Code is
+ * Mozilla.
+ * Portions created by the Initial Developer are Copyright (C) 2009
+ * the Initial Developer. All Rights Reserved.
+ *
+ * Contributor(s):
+ *
+ * Alternatively, the contents of this file may be used under the terms of
+ * either the GNU General Public License Version 2 or later (the "GPL"), or
+ * the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+ * in which case the provisions of the GPL or the LGPL are applicable instead
+ * of those above. If you wish to allow use of your version of this file only
+ * under the terms of either the GPL or the LGPL, and not to allow others to
+ * use your version of this file under the terms of the MPL, indicate your
+ * decision by deleting the provisions above and replace them with the notice
+ * and other provisions required by the GPL or the LGPL. If you do not delete
+ * the provisions above, a recipient may use your version of this file under
+ * the terms of any one of the MPL, the GPL or the LGPL.
+ *
+ * ***** END LICENSE BLOCK ***** */
+
+/*
+ * C versions of the inner loops of diff_match_patch. See dmp_backends.py
+ * for the class that uses them; it falls back to the pure Python methods
+ * whenever this module is not built.
+ *
+ * Both functions work on the raw unicode buffers and release the GIL while
+ * they run, so other daemon threads can keep going.
+ */
+
+#include <Python.h>
+#include <stdlib.h>
+#include <sys/time.h>
+
+typedef unsigned long long bits_t;
+
+#define MAX_BITS 64
+
+static double
+now(void)
+{
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return tv.tv_sec + tv.tv_usec / 1000000.0;
+}
+
+/*
+ * Myers' O(ND) algorithm, walking from both ends at once until the paths
+ * meet. Returns 1 and sets *split_x and *split_y to the middle snake, 0 if
+ * the texts have nothing in common and -1 if the deadline passed.
+ */
+static int
+bisect(const Py_UNICODE *text1, Py_ssize_t len1,
+       const Py_UNICODE *text2, Py_ssize_t len2, double deadline,
+       Py_ssize_t *v1, Py_ssize_t *v2,
+       Py_ssize_t *split_x, Py_ssize_t *split_y)
+{
+    Py_ssize_t max_d = (len1 + len2 + 1) / 2;
+    Py_ssize_t v_offset = max_d;
+    Py_ssize_t v_length = 2 * max_d + 2;
+    Py_ssize_t delta = len1 - len2;
+    /* If the total number of characters is odd, then the front path will
+       collide with the reverse path. */
+    int front = (delta % 2 != 0);
+    Py_ssize_t k1start = 0, k1end = 0, k2start = 0, k2end = 0;
+    Py_ssize_t d, k1, k2, k1_offset, k2_offset, x1, y1, x2, y2;
+
+    for (k1 = 0; k1 < v_length; k1++) {
+        v1[k1] = -1;
+        v2[k1] = -1;
+    }
+    v1[v_offset + 1] = 0;
+    v2[v_offset + 1] = 0;
+
+    for (d = 0; d < max_d; d++) {
+        if (deadline > 0 && now() > deadline)
+            return -1;
+
+        /* Walk the front path one step. */
+        for (k1 = -d + k1start; k1 <= d - k1end; k1 += 2) {
+            k1_offset = v_offset + k1;
+            if (k1 == -d || (k1 != d && v1[k1_offset - 1] < v1[k1_offset + 1]))
+                x1 = v1[k1_offset + 1];
+            else
+                x1 = v1[k1_offset - 1] + 1;
+            y1 = x1 - k1;
+            while (x1 < len1 && y1 < len2 && text1[x1] == text2[y1]) {
+                x1++;
+                y1++;
+            }
+            v1[k1_offset] = x1;
+            if (x1 > len1) {
+                /* Ran off the right of the graph. */
+                k1end += 2;
+            } else if (y1 > len2) {
+                /* Ran off the bottom of the graph. */
+                k1start += 2;
+            } else if (front) {
+                k2_offset = v_offset + delta - k1;
+                if (k2_offset >= 0 && k2_offset < v_length &&
+                        v2[k2_offset] != -1) {
+                    /* Mirror x2 onto top-left coordinate system. */
+                    x2 = len1 - v2[k2_offset];
+                    if (x1 >= x2) {
+                        *split_x = x1;
+                        *split_y = y1;
+                        return 1;
+                    }
+                }
+            }
+        }
+
+        /* Walk the reverse path one step. */
+        for (k2 = -d + k2start; k2 <= d - k2end; k2 += 2) {
+            k2_offset = v_offset + k2;
+            if (k2 == -d || (k2 != d && v2[k2_offset - 1] < v2[k2_offset + 1]))
+                x2 = v2[k2_offset + 1];
+            else
+                x2 = v2[k2_offset - 1] + 1;
+            y2 = x2 - k2;
+            while (x2 < len1 && y2 < len2 &&
+                   text1[len1 - x2 - 1] == text2[len2 - y2 - 1]) {
+                x2++;
+                y2++;
+            }
+            v2[k2_offset] = x2;
+            if (x2 > len1) {
+                k2end += 2;
+            } else if (y2 > len2) {
+                k2start += 2;
+            } else if (!front) {
+                k1_offset = v_offset + delta - k2;
+                if (k1_offset >= 0 && k1_offset < v_length &&
+                        v1[k1_offset] != -1) {
+                    x1 = v1[k1_offset];
+                    y1 = v_offset + x1 - k1_offset;
+                    x2 = len1 - x2;
+                    if (x1 >= x2) {
+                        *split_x = x1;
+                        *split_y = y1;
+                        return 1;
+                    }
+                }
+            }
+        }
+    }
+    return 0;
+}
+
+PyDoc_STRVAR(diff_bisect__doc__,
+"diff_bisect(text1, text2, deadline) -> (x, y) or None\n\n"
+"Find the middle snake of the shortest edit path between two unicode\n"
+"strings. The texts are split at text1[x] and text2[y]. Returns None\n"
+"if they have nothing in common or the deadline (0 for none) passed.");
+
+static PyObject *
+diff_bisect(PyObject *self, PyObject *args)
+{
+    PyObject *text1, *text2;
+    double deadline;
+    Py_ssize_t len1, len2, v_length, x = 0, y = 0;
+    Py_ssize_t *v1, *v2;
+    int found;
+
+    if (!PyArg_ParseTuple(args, "UUd:diff_bisect", &text1, &text2, &deadline))
+        return NULL;
+    len1 = PyUnicode_GET_SIZE(text1);
+    len2 = PyUnicode_GET_SIZE(text2);
+    v_length = 2 * ((len1 + len2 + 1) / 2) + 2;
+    v1 = PyMem_New(Py_ssize_t, v_length);
+    v2 = PyMem_New(Py_ssize_t, v_length);
+    if (v1 == NULL || v2 == NULL) {
+        PyMem_Free(v1);
+        PyMem_Free(v2);
+        return PyErr_NoMemory();
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    found = bisect(PyUnicode_AS_UNICODE(text1), len1,
+                   PyUnicode_AS_UNICODE(text2), len2, deadline,
+                   v1, v2, &x, &y);
+    Py_END_ALLOW_THREADS
+
+    PyMem_Free(v1);
+    PyMem_Free(v2);
+    if (found != 1)
+        Py_RETURN_NONE;
+    return Py_BuildValue("(nn)", x, y);
+}
+
+/* Score for a match with e errors at location x, as match_bitapScore. */
+static double
+bitap_score(Py_ssize_t e, Py_ssize_t x, Py_ssize_t pattern_length,
+            Py_ssize_t loc, double distance)
+{
+    double accuracy = (double)e / pattern_length;
+    Py_ssize_t proximity = loc > x ? loc - x : x - loc;
+    if (distance == 0)
+        return proximity ? 1.0 : accuracy;
+    return accuracy + (proximity / distance);
+}
+
+/*
+ * The same search as diff_match_patch.match_bitap, done in 64 bit words.
+ * Only the bits below the length of the pattern ever decide anything, so
+ * the result is identical for patterns of up to MAX_BITS characters.
+ */
+static Py_ssize_t
+bitap(const Py_UNICODE *text, Py_ssize_t text_length,
+      const Py_UNICODE *pattern, Py_ssize_t pattern_length,
+      Py_ssize_t loc, double threshold, double distance,
+      bits_t *rd, bits_t *last_rd, const bits_t *latin1)
+{
+    bits_t matchmask = (bits_t)1 << (pattern_length - 1);
+    bits_t char_match, *swap;
+    Py_ssize_t best_loc = -1;
+    Py_ssize_t bin_min, bin_mid, bin_max = pattern_length + text_length;
+    Py_ssize_t start, finish, d, i, j;
+    Py_UNICODE c;
+    double score;
+
+    for (d = 0; d < pattern_length; d++) {
+        /* Run a binary search to determine how far from loc we can stray
+           at this error level. */
+        bin_min = 0;
+        bin_mid = bin_max;
+        while (bin_min < bin_mid) {
+            if (bitap_score(d, loc + bin_mid, pattern_length, loc,
+                            distance) <= threshold)
+                bin_min = bin_mid;
+            else
+                bin_max = bin_mid;
+            bin_mid = (bin_max - bin_min) / 2 + bin_min;
+        }
+        bin_max = bin_mid;
+        start = loc - bin_mid + 1;
+        if (start < 1)
+            start = 1;
+        finish = loc + bin_mid;
+        if (finish > text_length)
+            finish = text_length;
+        finish += pattern_length;
+
+        /* The Python version starts from range(finish + 1), so slots the
+           scan does not reach hold their own index. */
+        for (j = 0; j <= finish; j++)
+            rd[j] = j;
+        rd[finish + 1] = ((bits_t)1 << d) - 1;
+        for (j = finish; j >= start; j--) {
+            if (text_length <= j - 1) {
+                char_match = 0;
+            } else {
+                c = text[j - 1];
+                if (c < 256) {
+                    char_match = latin1[c];
+                } else {
+                    char_match = 0;
+                    for (i = 0; i < pattern_length; i++)
+                        if (pattern[i] == c)
+                            char_match |= (bits_t)1 << (pattern_length - i - 1);
+                }
+            }
+            if (d == 0)
+                rd[j] = ((rd[j + 1] << 1) | 1) & char_match;
+            else
+                rd[j] = (((rd[j + 1] << 1) | 1) & char_match) |
+                        (((last_rd[j + 1] | last_rd[j]) << 1) | 1) |
+                        last_rd[j + 1];
+            if (rd[j] & matchmask) {
+                score = bitap_score(d, j - 1, pattern_length, loc, distance);
+                if (score <= threshold) {
+                    threshold = score;
+                    best_loc = j - 1;
+                    /* Once past loc it is downhill from here on in. (The
+                       Python loop does not narrow its range when the match
+                       lies beyond loc, so neither does this one.) */
+                    if (best_loc <= loc)
+                        break;
+                }
+            }
+        }
+        /* No hope for a (better) match at greater error levels. */
+        if (bitap_score(d + 1, loc, pattern_length, loc, distance) > threshold)
+            break;
+        swap = last_rd;
+        last_rd = rd;
+        rd = swap;
+    }
+    return best_loc;
+}
+
+PyDoc_STRVAR(match_bitap__doc__,
+"match_bitap(text, pattern, loc, threshold, distance) -> int\n\n"
+"Locate the best instance of pattern in text near loc. threshold is the\n"
+"score to beat and distance is Match_Distance. The pattern must not be\n"
+"longer than 64 characters and loc must lie within the text. Returns the\n"
+"index or -1.");
+
+static PyObject *
+match_bitap(PyObject *self, PyObject *args)
+{
+    PyObject *text, *pattern;
+    Py_ssize_t loc, text_length, pattern_length, i, best_loc;
+    double threshold, distance;
+    bits_t latin1[256];
+    bits_t *rd, *last_rd;
+    const Py_UNICODE *p;
+
+    if (!PyArg_ParseTuple(args, "UUndd:match_bitap", &text, &pattern, &loc,
+                          &threshold, &distance))
+        return NULL;
+    text_length = PyUnicode_GET_SIZE(text);
+    pattern_length = PyUnicode_GET_SIZE(pattern);
+    if (pattern_length < 1 || pattern_length > MAX_BITS) {
+        PyErr_SetString(PyExc_ValueError,
+                        "pattern must be 1 to 64 characters long");
+        return NULL;
+    }
+    if (loc < 0 || loc > text_length) {
+        PyErr_SetString(PyExc_ValueError, "loc must be within the text");
+        return NULL;
+    }
+
+    p = PyUnicode_AS_UNICODE(pattern);
+    memset(latin1, 0, sizeof(latin1));
+    for (i = 0; i < pattern_length; i++)
+        if (p[i] < 256)
+            latin1[p[i]] |= (bits_t)1 << (pattern_length - i - 1);
+
+    /* finish is at most text_length + pattern_length. */
+    rd = PyMem_New(bits_t, text_length + pattern_length + 2);
+    last_rd = PyMem_New(bits_t, text_length + pattern_length + 2);
+    if (rd == NULL || last_rd == NULL) {
+        PyMem_Free(rd);
+        PyMem_Free(last_rd);
+        return PyErr_NoMemory();
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    best_loc = bitap(PyUnicode_AS_UNICODE(text), text_length, p,
+                     pattern_length, loc, threshold, distance,
+                     rd, last_rd, latin1);
+    Py_END_ALLOW_THREADS
+
+    PyMem_Free(rd);
+    PyMem_Free(last_rd);
+    return PyInt_FromSsize_t(best_loc);
+}
+
+static PyMethodDef speedups_methods[] = {
+    {"diff_bisect", diff_bisect, METH_VARARGS, diff_bisect__doc__},
+    {"match_bitap", match_bitap, METH_VARARGS, match_bitap__doc__},
+    {NULL, NULL, 0, NULL}
+};
+
+PyMODINIT_FUNC
+init_speedups(void)
+{
+    PyObject *module = Py_InitModule3("_speedups", speedups_methods,
+        "C versions of the diff_match_patch inner loops.");
+    if (module != NULL)
+        PyModule_AddIntConstant(module, "MAX_BITS", MAX_BITS);
+}
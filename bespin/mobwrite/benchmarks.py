@@ -0,0 +1,349 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""Benchmarks for the mobwrite daemon.
+
+Run them with:
+
+  python -m bespin.mobwrite.benchmarks [name ...]
+
+Each benchmark prints its timings. They use an in-memory persister and do
+not need a database.
+"""
+
+import os
+import re
+import sys
+import tempfile
+import time
+import urllib
+
+from bespin.mobwrite import mobwrite_daemon, mobwrite_core, dmp_backends
+from bespin.mobwrite.diff_match_patch import diff_match_patch
+from bespin.mobwrite.integrate import Access
+
+class MemoryPersister(object):
+    def __init__(self, texts=None):
+        self.texts = texts or {}
+
+    def load(self, name, handle):
+        return self.texts.get(name, u"")
+
+    def save(self, name, contents, handle):
+        self.texts[name] = contents
+
+    def check_access(self, name, handle):
+        return Access.ReadWrite
+
+class BenchmarkMobWrite(mobwrite_daemon.DaemonMobWrite):
+    def __init__(self, persister):
+        self.persister = persister
+
+def _timed(func, rounds):
+    start = time.time()
+    for i in xrange(rounds):
+        func()
+    return (time.time() - start) / rounds
+
+def _reset_daemon():
+    mobwrite_daemon.texts.clear()
+    mobwrite_daemon.views.clear()
+    mobwrite_daemon.user_views.clear()
+    mobwrite_daemon.view_queue.clear()
+    mobwrite_daemon.text_queue.clear()
+    mobwrite_daemon.buffers.clear()
+    mobwrite_daemon.buffer_queue.clear()
+    mobwrite_daemon.buffer_bytes = 0
+
+def make_source_text(size):
+    """Returns roughly size characters of source-like text."""
+    lines = []
+    total = 0
+    i = 0
+    while total < size:
+        line = u"    var value%d = compute(%d, \"item %d\"); // step %d\n" % (
+            i, i * 7, i % 97, i)
+        lines.append(line)
+        total += len(line)
+        i += 1
+    return u"".join(lines)
+
+def bench_idle_viewers(size=1000000, viewers=10, rounds=20):
+    """Viewers of a 1 MB document syncing while nobody types, and while
+    one of them types a character between syncs."""
+    _reset_daemon()
+    persister = MemoryPersister({"doc": make_source_text(size)})
+    worker = BenchmarkMobWrite(persister)
+    views = [mobwrite_daemon.fetch_viewobj("user%d" % i, "doc",
+                handle="user%d:1" % i, metadata={}, persister=persister)
+             for i in xrange(viewers)]
+
+    def sync_all(full_diff):
+        for view in views:
+            if full_diff:
+                # what every sync did before versions were tracked
+                view.shadow_text_version = None
+            worker.generateDiffs(view, None, None, False, False, True, False)
+            view.edit_stack.clear()
+
+    sync_all(False)
+    textobj = views[0].textobj
+
+    def type_char():
+        textobj.lock.acquire()
+        try:
+            middle = len(textobj.text) // 2
+            textobj.setText(textobj.text[:middle] + u"x" +
+                            textobj.text[middle:], justLoaded=True)
+        finally:
+            textobj.lock.release()
+
+    def type_and_sync(full_diff):
+        type_char()
+        sync_all(full_diff)
+
+    print "%d viewers of a %d character document, %d rounds" % (
+        viewers, len(textobj.text), rounds)
+    typing = _timed(type_char, rounds)
+    sync_all(False)
+    for label, func, overhead in [("idle", sync_all, 0),
+                                  ("one typist", type_and_sync, typing)]:
+        full = _timed(lambda: func(True), rounds) - overhead
+        tracked = _timed(lambda: func(False), rounds) - overhead
+        print "  %-12s full diff %8.3fms   versioned %8.3fms" % (
+            label, full * 1000, tracked * 1000)
+    _reset_daemon()
+
+def load_source_files(root=None):
+    """Returns the Python sources of the bespin package as one document."""
+    if root is None:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parts = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(".py"):
+                f = open(os.path.join(dirpath, filename))
+                try:
+                    parts.append(f.read().decode("utf8", "replace"))
+                finally:
+                    f.close()
+    return u"".join(parts)
+
+def scatter_edits(text, every=50):
+    """Edits one line in every so many: changes, inserts and deletes."""
+    lines = text.splitlines(True)
+    result = []
+    for i, line in enumerate(lines):
+        kind = (i // every) % 3
+        if i % every != 0:
+            result.append(line)
+        elif kind == 0:
+            result.append(line.replace("e", "E", 1))
+        elif kind == 1:
+            result.append(line)
+            result.append(u"    # inserted line %d\n" % i)
+    return u"".join(result)
+
+def bench_diff_lines(rounds=5, timeout=1.0):
+    """Diffs the package's own sources against a copy with scattered edits,
+    with and without the line-level pass."""
+    text1 = load_source_files()
+    text2 = scatter_edits(text1)
+    dmp = diff_match_patch()
+    dmp.Diff_Timeout = timeout
+    print "%d lines, %d characters, Diff_Timeout %.1fs, %d rounds" % (
+        text1.count("\n"), len(text1), timeout, rounds)
+    for label, checklines in [("line mode", True), ("characters", False)]:
+        result = []
+        elapsed = _timed(lambda: result.append(
+            dmp.diff_main(text1, text2, checklines)), rounds)
+        diffs = result[-1]
+        changed = sum(len(data) for (op, data) in diffs
+                      if op != dmp.DIFF_EQUAL)
+        exact = (dmp.diff_text1(diffs) == text1 and
+                 dmp.diff_text2(diffs) == text2)
+        print "  %-12s %8.1fms   %7d characters changed   %s" % (
+            label, elapsed * 1000, changed, exact and "ok" or "WRONG")
+
+def bench_dmp_backends(size=50000, rounds=3):
+    """The diff, match and patch work of a sync, once for each
+    diff_match_patch backend that is built."""
+    text1 = load_source_files()[:size]
+    text2 = scatter_edits(text1, every=20)
+    # what another user typed meanwhile, so the patches need fuzzy matching
+    text3 = scatter_edits(text1, every=7)
+    # edits on every other line leave the line pass little to skip
+    chars1 = text1[:size // 10]
+    chars2 = scatter_edits(chars1, every=2)
+    print "%d characters, %d rounds" % (len(text1), rounds)
+    for name in sorted(dmp_backends.backends):
+        dmp = dmp_backends.make_dmp(name, mobwrite_core.DMP)
+        dmp.Diff_Timeout = 0
+        patches = dmp.patch_make(text1, text2)
+        timings = [
+            ("line diff", lambda: dmp.diff_main(text1, text2)),
+            ("char diff", lambda: dmp.diff_main(chars1, chars2, False)),
+            ("patch_make", lambda: dmp.patch_make(text1, text2)),
+            ("patch_apply", lambda: dmp.patch_apply(patches, text3)),
+        ]
+        print "  %s" % (name,)
+        for label, func in timings:
+            print "    %-12s %8.1fms" % (label, _timed(func, rounds) * 1000)
+
+_client_version = re.compile(r"^F:(\d+):", re.M)
+_server_version = re.compile(r"^[dDrR]:(\d+):", re.M)
+
+def record_traffic(clients=20, syncs=50, size=20000):
+    """Plays clients editing their own documents through a daemon, as the
+    browser client does, and returns the questions they asked and the
+    seconds the daemon spent answering them."""
+    _reset_daemon()
+    source = load_source_files()
+    persister = MemoryPersister()
+    worker = BenchmarkMobWrite(persister)
+    dmp = mobwrite_core.DMP
+    questions = []
+    elapsed = 0.0
+    states = []
+    for i in xrange(clients):
+        text = source[i * size:(i + 1) * size]
+        persister.texts["doc%d" % i] = text
+        states.append(dict(shadow=u"", text=text, client_version=0,
+                           server_version=0, edits=0))
+    for sync in xrange(syncs):
+        for i, state in enumerate(states):
+            if sync:
+                # type a few characters somewhere in the middle
+                text = state["text"]
+                middle = len(text) // 2 + sync * 13 % 1000
+                state["text"] = text[:middle] + u"x = %d;" % sync + \
+                    text[middle:]
+            if state["shadow"] == state["text"] or not sync:
+                command = "r:%d:%s" % (state["client_version"], urllib.quote(
+                    state["text"].encode("utf-8"), "!~*'();/?:@&=+$,# "))
+            else:
+                diffs = dmp.diff_main(state["shadow"], state["text"])
+                command = "d:%d:%s" % (state["client_version"],
+                                       dmp.diff_toDelta(diffs))
+            question = ("H:user%d:1\nu:user%d\nm:{\"id\": \"user\"}\n"
+                        "F:%d:doc%d\n%s\n\n" % (
+                        i, i, state["server_version"], i, command))
+            questions.append(question)
+            start = time.time()
+            answer = worker.handleRequest(question)
+            elapsed += time.time() - start
+            state["shadow"] = state["text"]
+            state["client_version"] += 1
+            match = _client_version.search(answer)
+            if match:
+                state["client_version"] = int(match.group(1))
+            match = _server_version.search(answer)
+            if match:
+                state["server_version"] = int(match.group(1)) + 1
+    _reset_daemon()
+    return questions, elapsed
+
+def bench_parse_requests(rounds=20):
+    """Parses the questions of an editing session, and compares that with
+    the time the daemon took to answer them."""
+    questions, answering = record_traffic()
+    parser = BenchmarkMobWrite(MemoryPersister())
+    def parse_all():
+        for question in questions:
+            parser.parseRequest(question)
+    parsing = _timed(parse_all, rounds)
+    print "%d questions, %d bytes, %d rounds" % (
+        len(questions), sum(len(question) for question in questions), rounds)
+    print "  parse      %8.1fus per question" % (
+        parsing / len(questions) * 1000000)
+    print "  answer     %8.1fus per question   (parsing %.1f%%)" % (
+        answering / len(questions) * 1000000, parsing / answering * 100)
+
+def bench_restart(views=5000, documents=500, size=5000):
+    """Saves and restores the state of a daemon with this many open views,
+    and compares the file with the raw texts every client would be sent
+    again without it."""
+    _reset_daemon()
+    source = load_source_files()
+    starts = [i * size % (len(source) - size) for i in xrange(documents)]
+    persister = MemoryPersister(dict(
+        ("doc%d" % i, source[start:start + size])
+        for i, start in enumerate(starts)))
+    worker = BenchmarkMobWrite(persister)
+    for i in xrange(views):
+        view = mobwrite_daemon.fetch_viewobj("user%d" % i,
+            "doc%d" % (i % documents), handle="user%d:1" % i, metadata={},
+            persister=persister)
+        worker.generateDiffs(view, None, None, False, False, True, False)
+        # the client got its text
+        view.edit_stack.acknowledge(view.shadow_server_version)
+    path = os.path.join(tempfile.mkdtemp(), "state.pickle")
+    start = time.time()
+    mobwrite_daemon.save_state(path)
+    saving = time.time() - start
+    state_bytes = os.path.getsize(path)
+    _reset_daemon()
+    start = time.time()
+    mobwrite_daemon.restore_state(path, persister)
+    restoring = time.time() - start
+    os.rmdir(os.path.dirname(path))
+    resync_bytes = sum(len(urllib.quote(view.textobj.text.encode("utf-8")))
+                       for view in mobwrite_daemon.views.values())
+    print "%d views of %d documents of %d characters" % (
+        len(mobwrite_daemon.views), documents, size)
+    print "  save       %8.1fms   %9d bytes" % (saving * 1000, state_bytes)
+    print "  restore    %8.1fms" % (restoring * 1000,)
+    print "  without it, clients are sent %d bytes of raw text" % (
+        resync_bytes,)
+    _reset_daemon()
+
+benchmarks = dict(idle_viewers=bench_idle_viewers,
+                  diff_lines=bench_diff_lines,
+                  dmp_backends=bench_dmp_backends,
+                  parse_requests=bench_parse_requests,
+                  restart=bench_restart)
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    mobwrite_core.LOG.setLevel(mobwrite_core.logging.WARNING)
+    for name in args or sorted(benchmarks):
+        benchmarks[name]()
+
+if __name__ == "__main__":
+    main()
@@ -78,7 +78,7 @@ class diff_match_patch:
   DIFF_INSERT = 1
   DIFF_EQUAL = 0
 
-  def diff_main(self, text1, text2, checklines=True):
+  def diff_main(self, text1, text2, checklines=True, deadline=None):
     """Find the differences between two texts.  Simplifies the problem by
       stripping any common prefix or suffix off the texts before diffing.
 
@@ -88,6 +88,9 @@ class diff_match_patch:
       checklines: Optional speedup flag.  If present and false, then don't run
         a line-level diff first to identify the changed areas.
         Defaults to true, which does a faster, slightly less optimal diff.
+      deadline: Optional time when the diff should be complete by.  Used
+        internally for recursive calls.  Users should set Diff_Timeout
+        instead.
 
     Returns:
       Array of changes.
@@ -97,6 +100,13 @@ class diff_match_patch:
     if text1 == text2:
       return [(self.DIFF_EQUAL, text1)]
 
+    # The whole diff, including any recursion, shares one deadline.
+    if deadline is None:
+      if self.Diff_Timeout <= 0:
+        deadline = 0
+      else:
+        deadline = time.time() + self.Diff_Timeout
+
     # Trim off common prefix (speedup)
     commonlength = self.diff_commonPrefix(text1, text2)
     commonprefix = text1[:commonlength]
@@ -113,7 +123,7 @@ class diff_match_patch:
       text2 = text2[:-commonlength]
 
     # Compute the diff on the middle block
-    diffs = self.diff_compute(text1, text2, checklines)
+    diffs = self.diff_compute(text1, text2, checklines, deadline)
 
     # Restore the prefix and suffix
     if commonprefix:
@@ -123,7 +133,7 @@ class diff_match_patch:
     self.diff_cleanupMerge(diffs)
     return diffs
 
-  def diff_compute(self, text1, text2, checklines):
+  def diff_compute(self, text1, text2, checklines, deadline=0):
     """Find the differences between two texts.  Assumes that the texts do not
       have any common prefix or suffix.
 
@@ -133,6 +143,7 @@ class diff_match_patch:
       checklines: Speedup flag.  If false, then don't run a line-level diff
         first to identify the changed areas.
         If true, then run a faster, slightly less optimal diff.
+      deadline: Time when the diff should be complete by (0 for none).
 
     Returns:
       Array of changes.
@@ -167,57 +178,81 @@ class diff_match_patch:
       # A half-match was found, sort out the return data.
       (text1_a, text1_b, text2_a, text2_b, mid_common) = hm
       # Send both pairs off for separate processing.
-      diffs_a = self.diff_main(text1_a, text2_a, checklines)
-      diffs_b = self.diff_main(text1_b, text2_b, checklines)
+      diffs_a = self.diff_main(text1_a, text2_a, checklines, deadline)
+      diffs_b = self.diff_main(text1_b, text2_b, checklines, deadline)
       # Merge the results.
       return diffs_a + [(self.DIFF_EQUAL, mid_common)] + diffs_b
 
     # Perform a real diff.
-    if checklines and (len(text1) < 100 or len(text2) < 100):
-      checklines = False  # Too trivial for the overhead.
-    if checklines:
-      # Scan the text on a line-by-line basis first.
-      (text1, text2, linearray) = self.diff_linesToChars(text1, text2)
+    if checklines and len(text1) >= 100 and len(text2) >= 100:
+      return self.diff_lineMode(text1, text2, deadline)
 
-    diffs = self.diff_map(text1, text2)
+    diffs = self.diff_map(text1, text2, deadline)
     if not diffs:  # No acceptable result.
       diffs = [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
-    if checklines:
-      # Convert the diff back to original text.
-      self.diff_charsToLines(diffs, linearray)
-      # Eliminate freak matches (e.g. blank lines)
-      self.diff_cleanupSemantic(diffs)
-
-      # Rediff any replacement blocks, this time character-by-character.
-      # Add a dummy entry at the end.
-      diffs.append((self.DIFF_EQUAL, ''))
-      pointer = 0
-      count_delete = 0
-      count_insert = 0
-      text_delete = ''
-      text_insert = ''
-      while pointer < len(diffs):
-        if diffs[pointer][0] == self.DIFF_INSERT:
-          count_insert += 1
-          text_insert += diffs[pointer][1]
-        elif diffs[pointer][0] == self.DIFF_DELETE:
-          count_delete += 1
-          text_delete += diffs[pointer][1]
-        elif diffs[pointer][0] == self.DIFF_EQUAL:
-          # Upon reaching an equality, check for prior redundancies.
-          if count_delete >= 1 and count_insert >= 1:
-            # Delete the offending records and add the merged ones.
-            a = self.diff_main(text_delete, text_insert, False)
-            diffs[pointer - count_delete - count_insert : pointer] = a
-            pointer = pointer - count_delete - count_insert + len(a)
-          count_insert = 0
-          count_delete = 0
-          text_delete = ''
-          text_insert = ''
+    return diffs
 
-        pointer += 1
+  def diff_lineMode(self, text1, text2, deadline=0):
+    """Do a quick line-level diff on both strings, then rediff the parts for
+      greater accuracy.
+      This speedup can produce non-minimal diffs.
 
-      diffs.pop()  # Remove the dummy entry at the end.
+    Args:
+      text1: Old string to be diffed.
+      text2: New string to be diffed.
+      deadline: Time when the character-level rediffs should be complete by
+        (0 for none).
+
+    Returns:
+      Array of changes.
+    """
+
+    # Scan the text on a line-by-line basis first.  Every distinct line
+    # becomes one character, so the diff below works on lines.
+    (text1, text2, linearray) = self.diff_linesToChars(text1, text2)
+
+    # The line-level pass gets a budget of its own: if it timed out, the
+    # whole document would come back as one replacement.
+    diffs = self.diff_main(text1, text2, False)
+
+    # Convert the diff back to original text.
+    self.diff_charsToLines(diffs, linearray)
+    # Eliminate freak matches (e.g. blank lines)
+    self.diff_cleanupSemantic(diffs)
+
+    # Rediff any replacement blocks, this time character-by-character.
+    # Once the deadline has passed diff_map gives up straight away, so the
+    # remaining blocks are left as plain replacements.
+    # Add a dummy entry at the end.
+    diffs.append((self.DIFF_EQUAL, ''))
+    pointer = 0
+    count_delete = 0
+    count_insert = 0
+    text_delete = []
+    text_insert = []
+    while pointer < len(diffs):
+      if diffs[pointer][0] == self.DIFF_INSERT:
+        count_insert += 1
+        text_insert.append(diffs[pointer][1])
+      elif diffs[pointer][0] == self.DIFF_DELETE:
+        count_delete += 1
+        text_delete.append(diffs[pointer][1])
+      elif diffs[pointer][0] == self.DIFF_EQUAL:
+        # Upon reaching an equality, check for prior redundancies.
+        if count_delete >= 1 and count_insert >= 1:
+          # Delete the offending records and add the merged ones.
+          a = self.diff_main("".join(text_delete), "".join(text_insert),
+                             False, deadline)
+          diffs[pointer - count_delete - count_insert : pointer] = a
+          pointer = pointer - count_delete - count_insert + len(a)
+        count_insert = 0
+        count_delete = 0
+        text_delete = []
+        text_insert = []
+
+      pointer += 1
+
+    diffs.pop()  # Remove the dummy entry at the end.
     return diffs
 
   def diff_linesToChars(self, text1, text2):
@@ -252,25 +287,21 @@ class diff_match_patch:
         Encoded string.
       """
       chars = []
-      # Walk the text, pulling out a substring for each line.
-      # text.split('\n') would would temporarily double our memory footprint.
-      # Modifying text would create many large strings to garbage collect.
-      lineStart = 0
-      lineEnd = -1
-      while lineEnd < len(text) - 1:
-        lineEnd = text.find('\n', lineStart)
-        if lineEnd == -1:
-          lineEnd = len(text) - 1
-        line = text[lineStart:lineEnd + 1]
-        lineStart = lineEnd + 1
-
-        if line in lineHash:
-          chars.append(unichr(lineHash[line]))
-        else:
+      # Splitting the whole text at once is much faster than walking it
+      # with find(), at the cost of briefly holding the lines in memory.
+      lines = text.split('\n')
+      last = lines.pop()
+      lines = [line + '\n' for line in lines]
+      if last:
+        lines.append(last)
+      append = chars.append
+      for line in lines:
+        index = lineHash.get(line)
+        if index is None:
           lineArray.append(line)
-          lineHash[line] = len(lineArray) - 1
-          chars.append(unichr(len(lineArray) - 1))
-      return "".join(chars)
+          index = lineHash[line] = len(lineArray) - 1
+        append(unichr(index))
+      return u"".join(chars)
 
     chars1 = diff_linesToCharsMunge(text1)
     chars2 = diff_linesToCharsMunge(text2)
@@ -290,19 +321,26 @@ class diff_match_patch:
         text.append(lineArray[ord(char)])
       diffs[x] = (diffs[x][0], "".join(text))
 
-  def diff_map(self, text1, text2):
+  def diff_map(self, text1, text2, deadline=None):
     """Explore the intersection points between the two texts.
 
     Args:
       text1: Old string to be diffed.
       text2: New string to be diffed.
+      deadline: Time when the diff should be complete by (0 for none).
 
     Returns:
       Array of diff tuples or None if no diff available.
     """
 
     # Unlike in most languages, Python counts time in seconds.
-    s_end = time.time() + self.Diff_Timeout  # Don't run for too long.
+    if deadline is None:
+      if self.Diff_Timeout <= 0:
+        s_end = 0
+      else:
+        s_end = time.time() + self.Diff_Timeout  # Don't run for too long.
+    else:
+      s_end = deadline
     # Cache the text lengths to prevent multiple calls.
     text1_length = len(text1)
     text2_length = len(text2)
@@ -321,7 +359,7 @@ class diff_match_patch:
     front = (text1_length + text2_length) % 2
     for d in xrange(max_d):
       # Bail out if timeout reached.
-      if self.Diff_Timeout > 0 and time.time() > s_end:
+      if s_end and time.time() > s_end:
         return None
 
       # Walk the front path one step.
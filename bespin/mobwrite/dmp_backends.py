@@ -0,0 +1,135 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""Interchangeable implementations of diff_match_patch.
+
+Every backend is a subclass of diff_match_patch with the same API and the
+same delta and patch formats, so they can be mixed freely between clients,
+the daemon and the journal. "python" is the original pure Python code.
+"c" replaces the hot loops (diff_map and match_bitap, which patch_apply
+spends its time in) with the optional bespin.mobwrite._speedups extension.
+It is built with the package when a compiler is available. Where it is not
+built, "auto" quietly falls back to "python".
+"""
+
+import logging
+import time
+
+from bespin.mobwrite.diff_match_patch import diff_match_patch
+
+try:
+    from bespin.mobwrite import _speedups
+except ImportError:
+    _speedups = None
+
+log = logging.getLogger("mobwrite.dmp_backends")
+
+class c_diff_match_patch(diff_match_patch):
+    """diff_match_patch with its inner loops in C.
+
+    Diffs are found by bisecting at the middle snake rather than by
+    following the footsteps of diff_map, so for some inputs the changes
+    are split up differently. They describe the same texts, are no
+    longer overall and patches made from them apply the same way.
+    """
+
+    def diff_map(self, text1, text2, deadline=None):
+        if not isinstance(text1, unicode) or not isinstance(text2, unicode):
+            return diff_match_patch.diff_map(self, text1, text2, deadline)
+        if deadline is None:
+            if self.Diff_Timeout <= 0:
+                deadline = 0
+            else:
+                deadline = time.time() + self.Diff_Timeout
+        split = _speedups.diff_bisect(text1, text2, deadline)
+        if split is None:
+            return None
+        (x, y) = split
+        diffs_a = self.diff_main(text1[:x], text2[:y], False, deadline)
+        diffs_b = self.diff_main(text1[x:], text2[y:], False, deadline)
+        return diffs_a + diffs_b
+
+    def match_bitap(self, text, pattern, loc):
+        if (not isinstance(text, unicode) or not isinstance(pattern, unicode)
+            or not 0 < len(pattern) <= _speedups.MAX_BITS
+            or not 0 <= loc <= len(text)):
+            return diff_match_patch.match_bitap(self, text, pattern, loc)
+
+        # The nearby exact matches are found as in the Python version.
+        score_threshold = self.Match_Threshold
+        best_loc = text.find(pattern, loc)
+        if best_loc != -1:
+            score_threshold = min(self._exact_score(best_loc, loc, pattern),
+                                  score_threshold)
+        best_loc = text.rfind(pattern, loc + len(pattern))
+        if best_loc != -1:
+            score_threshold = min(self._exact_score(best_loc, loc, pattern),
+                                  score_threshold)
+        return _speedups.match_bitap(text, pattern, loc, score_threshold,
+                                     self.Match_Distance)
+
+    def _exact_score(self, x, loc, pattern):
+        proximity = abs(loc - x)
+        if not self.Match_Distance:
+            return proximity and 1.0 or 0.0
+        return 0.0 + (proximity / float(self.Match_Distance))
+
+backends = dict(python=diff_match_patch)
+if _speedups is not None:
+    backends["c"] = c_diff_match_patch
+
+def get_backend(name="auto"):
+    """Returns the diff_match_patch class for name, which is "auto" or one
+    of the keys of backends. A backend that is not built falls back to
+    "python"; unknown names raise ValueError."""
+    if name == "auto":
+        return backends.get("c", diff_match_patch)
+    if name in backends:
+        return backends[name]
+    if name == "c":
+        log.warning("The C diff_match_patch backend is not built, "
+                    "using the Python one")
+        return diff_match_patch
+    raise ValueError("Unknown diff_match_patch backend: %s" % (name,))
+
+def make_dmp(name="auto", template=None):
+    """Returns a diff_match_patch object of the named backend, with the
+    settings of template if given."""
+    dmp = get_backend(name)()
+    if template is not None:
+        dmp.__dict__.update(template.__dict__)
+    return dmp
@@ -35,9 +35,15 @@
 # ***** END LICENSE BLOCK *****
 #
 
-from bespin.database import User, get_project
+import time
+import threading
 import logging
 
+from path import path as path_obj
+
+from bespin import config, database, queue
+from bespin.database import User, get_project
+
 log = logging.getLogger("mobwrite.integrate")
 
 
@@ -56,9 +62,27 @@ class Access:
     ReadWrite = 3
 
 
+def check_access_many(persister, names, handle):
+    """Asks persister for the access levels of several names at once,
+    falling back to one check_access call per name for persisters that
+    cannot check them together."""
+    check_many = getattr(persister, "check_access_many", None)
+    if check_many is not None:
+        return check_many(names, handle)
+    return dict((name, persister.check_access(name, handle))
+                for name in names)
+
+
 class Persister:
     """A plug-in for mobwrite_daemon that diverts calls to Bespin"""
 
+    def __init__(self):
+        self.merge_lock = threading.Lock()
+        # (owner, project name) -> when a temp file in it was last saved
+        self.unmerged = {}
+        # whether temp files left by an earlier process have been found
+        self.scanned = False
+
     def load(self, name, handle):
         """Load a temporary file by extracting the project from the filename
         and calling project.get_temp_file"""
@@ -78,36 +102,139 @@ class Persister:
             return ""
 
     def save(self, name, contents, handle):
-        """Load a temporary file by extracting the project from the filename
-        and calling project.save_temp_file"""
+        """Save a temporary file by extracting the project from the filename
+        and calling project.save_temp_file. Errors are logged and raised,
+        so that the caller knows the text has not been saved."""
         try:
             (user, owner, project_name, path) = self._split_path(name, handle)
             project = get_project(user, owner, project_name)
             log.debug("saving to temp file for: %s/%s" % (project.name, path))
             project.save_temp_file(path, contents)
+            self.merge_lock.acquire()
+            try:
+                self.unmerged[(owner.username, project_name)] = time.time()
+            finally:
+                self.merge_lock.release()
         except:
             log.exception("Error in Persister.save() for name=%s", name)
+            raise
+
+    def schedule_merges(self, idle):
+        """Queues a job to merge the temp files into the real files for
+        every project whose temp files have not been saved for idle
+        seconds. The projects are merged one job each. Returns the number
+        of jobs queued."""
+        if not self.scanned:
+            self.scanned = True
+            try:
+                self.find_unmerged()
+            except:
+                log.exception("Error in Persister.find_unmerged()")
+        cutoff = time.time() - idle
+        self.merge_lock.acquire()
+        try:
+            due = [key for key, saved in self.unmerged.items()
+                   if saved <= cutoff]
+            for key in due:
+                del self.unmerged[key]
+        finally:
+            self.merge_lock.release()
+        for owner_name, project_name in due:
+            job_body = dict(owner=owner_name, project=project_name, idle=idle)
+            try:
+                queue.enqueue("files", job_body,
+                        execute="bespin.filesystem:merge_temp_files_run",
+                        error_handler="bespin.filesystem:merge_temp_files_error",
+                        use_db=True)
+            except:
+                log.exception("Error in Persister.schedule_merges() for %s/%s",
+                              owner_name, project_name)
+        return len(due)
+
+    def find_unmerged(self):
+        """Looks through every user's directory for projects with temp
+        files, so that edits saved before this process started are merged
+        too. Returns the number of projects found."""
+        found = []
+        users = database._get_session().query(User.username,
+                                              User.file_location)
+        for username, file_location in users:
+            if file_location.startswith("/"):
+                location = path_obj(file_location)
+            else:
+                location = config.c.fsroot / file_location
+            if not location.isdir():
+                continue
+            for temp_dir in location.dirs(".*-mobwrite"):
+                project_name = temp_dir.name[1:-len("-mobwrite")]
+                found.append(((username, project_name), temp_dir.mtime))
+        self.merge_lock.acquire()
+        try:
+            for key, saved in found:
+                self.unmerged.setdefault(key, saved)
+        finally:
+            self.merge_lock.release()
+        return len(found)
 
     def check_access(self, name, handle):
         """Check to see what level of access user has over an owner's project.
         Returns one of: Access.Denied, Access.ReadOnly or Access.ReadWrite
         Note that if user==owner then no check of project_name is performed, and
         Access.ReadWrite is returned straight away"""
+        return self.check_access_many([name], handle)[name]
+
+    def check_access_many(self, names, handle):
+        """Checks access to several files for the same requester at once.
+        Returns a dictionary mapping each name to one of the Access levels.
+        The requester and the owners are looked up once each, and all the
+        projects that belong to other people are checked with a single
+        sharing query. Only the cached user info is needed for this, so
+        no User objects are loaded."""
+        result = {}
         try:
-            (user, owner, project_name, path) = self._split_path(name, handle)
-            if user == owner:
-                return Access.ReadWrite
-            if user != owner:
-                if owner.is_project_shared(project_name, user, require_write=True):
-                    return Access.ReadWrite
-                if owner.is_project_shared(project_name, user, require_write=False):
-                    return Access.ReadOnly
+            user = User.find_info(get_username_from_handle(handle))
+            owners = {}
+            projects = {}
+            for name in names:
+                owner_name, project_name = self._owner_and_project(name)
+                if owner_name is None:
+                    owner = user
                 else:
-                    return Access.Denied
-        except Error, e:
-            log.exception("Error in Persister.check_access() for name=%s, handle=%s", 
-                            name, handle)
-            return Access.Denied
+                    if owner_name not in owners:
+                        owners[owner_name] = User.find_info(owner_name)
+                    owner = owners[owner_name]
+                if user is None or owner is None:
+                    result[name] = Access.Denied
+                elif owner.id == user.id:
+                    result[name] = Access.ReadWrite
+                else:
+                    projects[name] = (owner, project_name)
+            if projects:
+                shared = database.get_shared_access(user, projects.values())
+                for name, (owner, project_name) in projects.items():
+                    edit = shared.get((owner.id, project_name))
+                    if edit is None:
+                        result[name] = Access.Denied
+                    elif edit:
+                        result[name] = Access.ReadWrite
+                    else:
+                        result[name] = Access.ReadOnly
+        except:
+            log.exception("Error in Persister.check_access_many() for handle=%s",
+                            handle)
+            for name in names:
+                result[name] = Access.Denied
+        return result
+
+    def _owner_and_project(self, path):
+        """Extract the owner's username and the project name from a path.
+        The owner is None when the path is in the requester's own project."""
+        if path[0] == "/":
+            path = path[1:]
+        parts = path.split('/', 1)[0].partition('+')
+        if parts[1] == '':
+            return (None, parts[0])
+        return (parts[0], parts[2])
 
     def _split_path(self, path, handle):
         """Extract user, owner, project name, and path and return it as a tuple."""
@@ -124,3 +251,161 @@ class Persister:
             result[1] = parts[2]
         result.insert(0, user)
         return result
+
+
+class WriteBehindPersister:
+    """Wraps a Persister so that saves are held in memory and written out
+    by a background thread. A document that is saved many times between
+    flushes is only written once, after it has been dirty for interval
+    seconds, or sooner if more than max_pending_bytes are waiting.
+
+    A document stays pending (and load() keeps returning it) until the
+    persister has saved it. If that fails, it is tried again on the next
+    flush.
+
+    If on_flush is set, it is called with the name and the journal_seq
+    given to save() of every document after it has been written."""
+
+    def __init__(self, persister, interval=5.0, max_pending_bytes=4000000):
+        self.persister = persister
+        self.interval = interval
+        self.max_pending_bytes = max_pending_bytes
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # name -> (contents, handle, time it became dirty, sequence,
+        #          journal_seq)
+        self.pending = {}
+        self.pending_bytes = 0
+        # numbers the saves, so that a flush can tell whether the
+        # document was saved again while it was being written
+        self.sequence = 0
+        self.thread = None
+        self.on_flush = None
+
+    def start(self):
+        """Starts the flusher thread."""
+        self.running = True
+        self.thread = threading.Thread(target=self._run,
+                                       name="mobwrite-flusher")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops the flusher thread and writes out everything pending."""
+        self.running = False
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.flush(everything=True)
+
+    def load(self, name, handle):
+        self.lock.acquire()
+        try:
+            entry = self.pending.get(name)
+        finally:
+            self.lock.release()
+        if entry is not None:
+            return entry[0] or u""
+        return self.persister.load(name, handle)
+
+    def save(self, name, contents, handle, journal_seq=None):
+        self.lock.acquire()
+        try:
+            old = self.pending.get(name)
+            if old is None:
+                dirty_since = time.time()
+            else:
+                dirty_since = old[2]
+                self.pending_bytes -= len(old[0] or "")
+            self.sequence += 1
+            self.pending[name] = (contents, handle, dirty_since, self.sequence,
+                                  journal_seq)
+            self.pending_bytes += len(contents or "")
+            over_budget = self.pending_bytes > self.max_pending_bytes
+        finally:
+            self.lock.release()
+        if over_budget:
+            self.wakeup.set()
+
+    def check_access(self, name, handle):
+        return self.persister.check_access(name, handle)
+
+    def check_access_many(self, names, handle):
+        return check_access_many(self.persister, names, handle)
+
+    def schedule_merges(self, idle):
+        schedule_merges = getattr(self.persister, "schedule_merges", None)
+        if schedule_merges is None:
+            return 0
+        return schedule_merges(idle)
+
+    def expire(self, before):
+        expire = getattr(self.persister, "expire", None)
+        if expire is None:
+            return 0
+        return expire(before)
+
+    def close(self):
+        close = getattr(self.persister, "close", None)
+        if close is not None:
+            close()
+
+    def flush(self, everything=False):
+        """Writes out the documents that have been dirty for long enough,
+        or all of them if everything is true or too many bytes are
+        waiting. Returns the number of documents written."""
+        self.flush_lock.acquire()
+        try:
+            now = time.time()
+            self.lock.acquire()
+            try:
+                if self.pending_bytes > self.max_pending_bytes:
+                    everything = True
+                due = [(name, entry) for name, entry in self.pending.items()
+                       if everything or now - entry[2] >= self.interval]
+            finally:
+                self.lock.release()
+
+            written = 0
+            for name, (contents, handle, dirty_since, sequence,
+                       journal_seq) in due:
+                try:
+                    self.persister.save(name, contents, handle)
+                except:
+                    log.exception("Error saving %s, will try again", name)
+                    continue
+                written += 1
+                self.lock.acquire()
+                try:
+                    # a save that came in while this one was being
+                    # written stays pending
+                    entry = self.pending.get(name)
+                    if entry is not None and entry[3] == sequence:
+                        del self.pending[name]
+                        self.pending_bytes -= len(contents or "")
+                finally:
+                    self.lock.release()
+                if self.on_flush:
+                    self.on_flush(name, journal_seq)
+            return written
+        finally:
+            self.flush_lock.release()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval / 2.0)
+            self.wakeup.clear()
+            if not self.running:
+                return
+            database.begin_identity_map()
+            try:
+                self.flush()
+            except:
+                log.exception("Error flushing mobwrite saves")
+            finally:
+                database.end_identity_map()
+                session = config.c.session_factory()
+                session.rollback()
+                session.close()
@@ -0,0 +1,259 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""An append-only journal of the changes made to mobwrite documents.
+
+Every change to a document is appended to its log as a diff_toDelta
+delta, so an edit costs I/O in proportion to the edit rather than to
+the document. Every compact_every records, the log is folded into a
+snapshot of the whole text. Loading a document replays its log on top
+of its snapshot. Snapshots are synced to disk; log records are not, so
+a crash of the machine (rather than of the process) can lose the last
+few edits.
+
+Each record is numbered. Once the text of a record has been saved
+through the persister, discard() removes the journal, unless the
+document has changed again since. Journals of documents that are not
+loaded again are removed by expire().
+
+Each document has two files in the journal directory, named after the
+quoted document name:
+
+  <name>.snap  "<seq> T\n" and the UTF-8 text, or "<seq> N\n" for no text
+  <name>.log   one "<seq>:<delta>\n" line per change ("N" for no text)
+"""
+
+import itertools
+import os
+import threading
+import time
+import urllib
+import logging
+
+from bespin.mobwrite import mobwrite_core
+
+log = logging.getLogger("mobwrite.journal")
+
+LOCK_STRIPES = 64
+
+class DeltaJournal(object):
+    def __init__(self, directory, compact_every=100):
+        self.directory = directory
+        self.compact_every = compact_every
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Changes to one document are written in order, but different
+        # documents don't wait for each other.
+        self.locks = [threading.Lock() for i in xrange(LOCK_STRIPES)]
+        # name -> [number of the latest record, records in the log]
+        self.documents = {}
+        # Records are numbered across all documents, so that a number
+        # is never given to two texts of one document.
+        self.numbers = itertools.count(1)
+
+    def _lock(self, name):
+        return self.locks[hash(name) % LOCK_STRIPES]
+
+    def _paths(self, name):
+        base = os.path.join(self.directory, urllib.quote(name, ""))
+        return base + ".snap", base + ".log"
+
+    def append(self, name, old_text, new_text, diffs=None):
+        """Records that the document changed from old_text to new_text,
+        and returns the number of the record. diffs, if given, must be
+        that change (as they are when a client's edit was applied to the
+        text its shadow was a copy of); otherwise it is worked out."""
+        record = None
+        if old_text is not None:
+            if new_text is None:
+                record = "N"
+            else:
+                if diffs is None:
+                    diffs = mobwrite_core.DMP.diff_main(old_text, new_text,
+                                                        False)
+                record = mobwrite_core.DMP.diff_toDelta(diffs)
+
+        lock = self._lock(name)
+        lock.acquire()
+        try:
+            seq = self.numbers.next()
+            state = self.documents.get(name)
+            if state is None or record is None:
+                # nothing to apply a delta to yet
+                self._snapshot(name, seq, new_text)
+                return seq
+            state[0] = seq
+            logfile = open(self._paths(name)[1], "ab")
+            try:
+                logfile.write("%d:%s\n" % (state[0], record))
+            finally:
+                logfile.close()
+            state[1] += 1
+            if state[1] >= self.compact_every:
+                self._snapshot(name, state[0], new_text)
+            return state[0]
+        finally:
+            lock.release()
+
+    def sequence(self, name):
+        """Returns the number of the latest record for name, or None if
+        it has no journal."""
+        state = self.documents.get(name)
+        if state is None:
+            return None
+        return state[0]
+
+    def _snapshot(self, name, seq, text):
+        """Writes text as the snapshot for name and empties its log."""
+        snap_path, log_path = self._paths(name)
+        temp_path = snap_path + ".tmp"
+        snap = open(temp_path, "wb")
+        try:
+            if text is None:
+                snap.write("%d N\n" % seq)
+            else:
+                snap.write("%d T\n" % seq)
+                snap.write(text.encode("utf-8"))
+            snap.flush()
+            os.fsync(snap.fileno())
+        finally:
+            snap.close()
+        os.rename(temp_path, snap_path)
+        self._sync_directory()
+        if os.path.exists(log_path):
+            os.remove(log_path)
+        self.documents[name] = [seq, 0]
+
+    def _sync_directory(self):
+        # makes the rename of a snapshot durable
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def load(self, name):
+        """Returns (found, text) with the journaled text of the document.
+        found is False if there is no journal for it."""
+        lock = self._lock(name)
+        lock.acquire()
+        try:
+            snap_path, log_path = self._paths(name)
+            if not os.path.exists(snap_path):
+                return False, None
+            snap = open(snap_path, "rb")
+            try:
+                kind = snap.readline().split()[1]
+                if kind == "N":
+                    text = None
+                else:
+                    text = snap.read().decode("utf-8")
+            finally:
+                snap.close()
+
+            records = 0
+            if os.path.exists(log_path):
+                logfile = open(log_path, "rb")
+                try:
+                    for line in logfile:
+                        if not line.endswith("\n"):
+                            # cut off by a crash while it was being written
+                            break
+                        delta = line[:-1].split(":", 1)[1]
+                        if delta == "N":
+                            text = None
+                        else:
+                            diffs = mobwrite_core.DMP.diff_fromDelta(
+                                text or u"", delta)
+                            text = mobwrite_core.DMP.diff_text2(diffs)
+                        records += 1
+                finally:
+                    logfile.close()
+            log.info("Replayed %d journal records for %s", records, name)
+            # numbered afresh, as the numbers in the files may come from
+            # an earlier process
+            self.documents[name] = [self.numbers.next(), records]
+            return True, text
+        finally:
+            lock.release()
+
+    def discard(self, name, seq):
+        """Removes the journal for name, if record seq (whose text has just
+        been saved through the persister) is still the latest one."""
+        lock = self._lock(name)
+        lock.acquire()
+        try:
+            state = self.documents.get(name)
+            if state is None or state[0] != seq:
+                return
+            del self.documents[name]
+            self._remove(name)
+        finally:
+            lock.release()
+
+    def _remove(self, name):
+        for path in self._paths(name):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def expire(self, before):
+        """Removes the journals that have not been written to since before
+        (a time.time() value) of documents that have not been loaded since
+        this journal was opened. Returns the number removed."""
+        expired = 0
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".snap"):
+                continue
+            name = urllib.unquote(filename[:-len(".snap")])
+            lock = self._lock(name)
+            lock.acquire()
+            try:
+                if name in self.documents:
+                    continue
+                paths = [path for path in self._paths(name)
+                         if os.path.exists(path)]
+                if not paths or max(os.path.getmtime(path)
+                                    for path in paths) >= before:
+                    continue
+                log.warning("Removing the journal of %s, which has not "
+                            "been loaded since %s", name,
+                            time.ctime(os.path.getmtime(paths[0])))
+                self._remove(name)
+                expired += 1
+            finally:
+                lock.release()
+        return expired
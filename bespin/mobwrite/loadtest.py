@@ -0,0 +1,223 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""Load test for the mobwrite daemon's telnet protocol.
+
+  python -m bespin.mobwrite.loadtest [options] [host:port]
+
+Opens many kept-alive connections at once. Each one plays an editor that
+syncs a document over and over. Without host:port, a server of the kind
+given by --server is started in this process with an in-memory persister,
+and its peak thread count is reported as well.
+"""
+
+import asyncore
+import optparse
+import re
+import select
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+from bespin.mobwrite import mobwrite_core, mobwrite_daemon, transport
+from bespin.mobwrite.benchmarks import MemoryPersister, BenchmarkMobWrite, \
+    make_source_text
+from bespin.mobwrite.mobwrite_async import AsyncServer
+
+_client_version = re.compile(r"^F:(\d+):", re.M)
+_server_version = re.compile(r"^[dDrR]:(\d+):", re.M)
+
+class Editor(asyncore.dispatcher):
+    """A client that syncs one document syncs times, a question at a
+    time."""
+
+    def __init__(self, address, username, filename, syncs, map):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.username = username
+        self.filename = filename
+        self.syncs_left = syncs
+        self.client_version = 0
+        self.server_version = 0
+        self.length = 0
+        self.outbuf = transport.KEEPALIVE_LINE + "\n"
+        self.inbuf = ""
+        self.sent_at = None
+        self.latencies = []
+        self.failed = False
+        self.connect(address)
+        self.ask()
+
+    def ask(self):
+        self.outbuf += "H:%s:1\nu:%s\nF:%d:%s\nd:%d:=%d\n\n" % (
+            self.username, self.username, self.server_version, self.filename,
+            self.client_version, self.length)
+        self.sent_at = time.time()
+
+    def handle_connect(self):
+        pass
+
+    def writable(self):
+        return bool(self.outbuf)
+
+    def handle_write(self):
+        sent = self.send(self.outbuf)
+        self.outbuf = self.outbuf[sent:]
+
+    def handle_read(self):
+        self.inbuf += self.recv(65536)
+        end = self.inbuf.find("\n")
+        if end == -1:
+            return
+        length = int(self.inbuf[:end])
+        if len(self.inbuf) < end + 1 + length:
+            return
+        answer = self.inbuf[end + 1:end + 1 + length]
+        self.inbuf = self.inbuf[end + 1 + length:]
+        self.latencies.append(time.time() - self.sent_at)
+        match = _client_version.search(answer)
+        if match:
+            self.client_version = int(match.group(1))
+        match = _server_version.search(answer)
+        if match:
+            self.server_version = int(match.group(1)) + 1
+        self.length = self.expected_length
+        self.syncs_left -= 1
+        if self.syncs_left:
+            self.ask()
+        else:
+            self.close()
+
+    def handle_close(self):
+        if self.syncs_left:
+            self.failed = True
+        self.close()
+
+    def handle_error(self):
+        self.failed = True
+        self.close()
+
+def run(address, connections, syncs, documents, text_length):
+    map = {}
+    editors = []
+    start = time.time()
+    for i in xrange(connections):
+        editor = Editor(address, "user%d" % i, "doc%d" % (i % documents),
+                        syncs, map)
+        editor.expected_length = text_length
+        editors.append(editor)
+    use_poll = hasattr(select, "poll")
+    while map:
+        asyncore.loop(timeout=1, use_poll=use_poll, map=map, count=1)
+    elapsed = time.time() - start
+    latencies = sorted(latency for editor in editors
+                       for latency in editor.latencies)
+    failed = len([editor for editor in editors if editor.failed])
+    return elapsed, latencies, failed
+
+def start_server(kind, persister, workers):
+    """Starts a server in this process on a free port and returns it."""
+    if kind == "async":
+        server = AsyncServer(("127.0.0.1", 0), workers=workers,
+                             max_pending=workers * 32,
+                             worker_factory=lambda: BenchmarkMobWrite(persister))
+    else:
+        class Handler(mobwrite_daemon.StreamRequestHandlerDaemonMobWrite):
+            def __init__(self, *args):
+                self.persister = persister
+                SocketServer.StreamRequestHandler.__init__(self, *args)
+        class Server(SocketServer.ThreadingTCPServer):
+            daemon_threads = True
+            request_queue_size = 1024
+        server = Server(("127.0.0.1", 0), Handler)
+        server.address = server.server_address
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+def main(args=None):
+    parser = optparse.OptionParser(usage="%prog [options] [host:port]")
+    parser.add_option("--server", default="async",
+                      help="threaded or async, when no host:port is given")
+    parser.add_option("--connections", type="int", default=1000)
+    parser.add_option("--syncs", type="int", default=10,
+                      help="syncs per connection")
+    parser.add_option("--documents", type="int", default=100)
+    parser.add_option("--workers", type="int", default=8,
+                      help="worker threads of an async server")
+    (options, args) = parser.parse_args(args)
+    mobwrite_core.logging.basicConfig()
+    mobwrite_core.LOG.setLevel(mobwrite_core.logging.WARNING)
+
+    text = make_source_text(2000)
+    peak_threads = None
+    if args:
+        (host, port) = args[0].split(":")
+        address = (host, int(port))
+    else:
+        persister = MemoryPersister(dict(("doc%d" % i, text)
+                                         for i in xrange(options.documents)))
+        server = start_server(options.server, persister, options.workers)
+        address = server.address
+        peak = [threading.activeCount()]
+        def watch():
+            while True:
+                peak[0] = max(peak[0], threading.activeCount())
+                time.sleep(0.05)
+        watcher = threading.Thread(target=watch)
+        watcher.setDaemon(True)
+        watcher.start()
+
+    (elapsed, latencies, failed) = run(address, options.connections,
+                                       options.syncs, options.documents,
+                                       len(text))
+    count = len(latencies)
+    print "%d connections, %d syncs in %.2fs: %.0f syncs/s, %d failed" % (
+        options.connections, count, elapsed, count / elapsed, failed)
+    if latencies:
+        print "latency: median %.1fms, 99th percentile %.1fms, max %.1fms" % (
+            latencies[count // 2] * 1000,
+            latencies[min(count - 1, int(count * 0.99))] * 1000,
+            latencies[-1] * 1000)
+    if not args:
+        print "server threads at peak: %d" % (peak[0],)
+
+if __name__ == "__main__":
+    main()
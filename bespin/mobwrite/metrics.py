@@ -0,0 +1,127 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""Collaboration metrics for the mobwrite daemon.
+
+Timings are counted into histograms and events into counters, both held
+in memory so that recording one costs a lock and an addition. The daemon
+publishes them through bespin.stats every few seconds (see
+mobwrite_daemon.publish_metrics), and the mobwrite web server serves them
+as JSON at /stats.
+"""
+
+import bisect
+import threading
+
+# Upper bounds of the histogram buckets, in milliseconds. The last bucket
+# holds everything slower.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class Histogram(object):
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        ms = seconds * 1000
+        bucket = bisect.bisect_left(self.bounds, ms)
+        self.lock.acquire()
+        try:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.total += ms
+            if ms > self.max:
+                self.max = ms
+        finally:
+            self.lock.release()
+
+    def percentile(self, fraction):
+        """Returns the upper bound of the bucket that holds the given
+        fraction of the observations, or the slowest one if that is the
+        last bucket."""
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        return dict(count=self.count, total_ms=self.total, max_ms=self.max,
+                    buckets=zip(self.bounds + ("inf",), self.counts),
+                    p50_ms=self.percentile(0.5),
+                    p99_ms=self.percentile(0.99))
+
+_lock = threading.Lock()
+histograms = {}
+counters = {}
+
+def observe(name, seconds):
+    """Counts a timing into the histogram called name."""
+    histogram = histograms.get(name)
+    if histogram is None:
+        _lock.acquire()
+        try:
+            histogram = histograms.setdefault(name, Histogram())
+        finally:
+            _lock.release()
+    histogram.observe(seconds)
+
+def count(name, by=1):
+    """Adds by to the counter called name."""
+    _lock.acquire()
+    try:
+        counters[name] = counters.get(name, 0) + by
+    finally:
+        _lock.release()
+
+def snapshot():
+    """Returns the counters and timings recorded so far."""
+    _lock.acquire()
+    try:
+        result = dict(counters=dict(counters))
+        timings = histograms.items()
+    finally:
+        _lock.release()
+    result["timings"] = dict((name, histogram.snapshot())
+                             for name, histogram in timings)
+    return result
@@ -0,0 +1,334 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""An event-driven server for the mobwrite daemon's telnet protocol.
+
+The threaded server (mobwrite_daemon.main with c.mobwrite_server_mode set
+to "threaded") ties up an OS thread for every open connection, which adds
+up with thousands of kept-alive editor connections. AsyncServer runs every
+connection on one asyncore loop instead. It only hands complete questions
+to a fixed pool of worker threads, which do the diff and patch work.
+
+The protocol is the same as StreamRequestHandlerDaemonMobWrite.handle: a
+question ends with a blank line, and a connection that starts with
+transport.KEEPALIVE_LINE stays open and gets length-prefixed answers.
+
+Backpressure: each connection has at most one question with the workers,
+so pipelined questions wait in its input buffer. No connection is read
+while max_pending questions are waiting for a worker, or while its own
+buffers are over MAX_BUFFER bytes. Clients are then held up by TCP flow
+control instead of the server queueing without limit.
+"""
+
+import asyncore
+import collections
+import errno
+import logging
+import select
+import socket
+import threading
+import time
+import Queue
+
+from bespin.mobwrite import mobwrite_daemon, transport
+
+log = logging.getLogger("mobwrite.async")
+
+# A connection stops being read once this many bytes wait in either of
+# its buffers.
+MAX_BUFFER = 4 * 1024 * 1024
+
+# Bytes read or written in one go.
+CHUNK_SIZE = 65536
+
+# Most connections accepted in one go.
+ACCEPT_BATCH = 256
+
+class Connection(asyncore.dispatcher):
+    """One client connection."""
+
+    def __init__(self, server, sock):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        self.server = server
+        self.inbuf = ""
+        self.outbuf = ""
+        self.lines = []
+        self.keepalive = False
+        # a question is with the workers
+        self.busy = False
+        # the client has stopped sending
+        self.eof = False
+        # close once the output is written
+        self.finished = False
+        self.touch()
+
+    def touch(self):
+        # Like the socket timeouts of the threaded server, the time allowed
+        # starts again whenever data moves.
+        if self.keepalive:
+            timeout = mobwrite_daemon.TIMEOUT_KEEPALIVE
+        else:
+            timeout = mobwrite_daemon.TIMEOUT_TELNET
+        self.deadline = time.time() + timeout
+
+    def readable(self):
+        return (not self.eof and not self.finished
+                and not self.server.saturated()
+                and len(self.inbuf) < MAX_BUFFER
+                and len(self.outbuf) < MAX_BUFFER)
+
+    def writable(self):
+        return bool(self.outbuf)
+
+    def handle_read(self):
+        data = self.recv(CHUNK_SIZE)
+        if data:
+            self.inbuf += data
+            self.touch()
+            self.process()
+
+    def handle_close(self):
+        # Called by recv when the client has shut down its side.
+        if self.eof:
+            self.close()
+            return
+        self.eof = True
+        if self.keepalive or self.finished:
+            self.close()
+        elif not self.busy:
+            # Like the threaded server, answer what has arrived so far.
+            self.submit("".join(self.lines) + self.inbuf)
+
+    def handle_write(self):
+        sent = self.send(self.outbuf[:CHUNK_SIZE])
+        if sent:
+            self.outbuf = self.outbuf[sent:]
+            self.touch()
+        if not self.outbuf and self.finished:
+            self.close()
+
+    def handle_error(self):
+        log.exception("Error on mobwrite connection")
+        self.close()
+
+    def process(self):
+        # Split complete lines off the input until a question is complete.
+        while not self.busy and not self.finished:
+            end = self.inbuf.find("\n")
+            if end == -1:
+                return
+            line = self.inbuf[:end + 1]
+            self.inbuf = self.inbuf[end + 1:]
+            if not self.lines and not self.keepalive and \
+                    line.rstrip("\r\n") == transport.KEEPALIVE_LINE:
+                self.keepalive = True
+                self.touch()
+                continue
+            self.lines.append(line)
+            if not line.rstrip("\r\n"):
+                question = "".join(self.lines)
+                self.lines = []
+                self.submit(question)
+
+    def submit(self, question):
+        self.busy = True
+        self.server.submit(self, question)
+
+    def answered(self, answer):
+        # Called on the loop thread once a worker has the answer.
+        self.busy = False
+        if answer is None or not self.connected:
+            self.close()
+            return
+        answer = str(answer)
+        self.touch()
+        if self.keepalive and not self.eof:
+            self.outbuf += "%d\n%s" % (len(answer), answer)
+            self.process()
+        else:
+            self.outbuf += answer
+            self.finished = True
+            if not self.outbuf:
+                self.close()
+
+    def check_timeout(self, now):
+        if self.busy or now < self.deadline:
+            return
+        if not self.keepalive:
+            log.warning("Timeout on connection")
+        self.close()
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.server.connections.discard(self)
+
+class Waker(asyncore.dispatcher):
+    """Wakes the loop up when workers have answers for it."""
+
+    def __init__(self, map):
+        (self.reader, self.writer) = socket.socketpair()
+        self.writer.setblocking(0)
+        asyncore.dispatcher.__init__(self, self.reader, map=map)
+        self.callbacks = collections.deque()
+
+    def call_soon(self, callback, *args):
+        # Called from the worker threads.
+        self.callbacks.append((callback, args))
+        try:
+            self.writer.send("x")
+        except socket.error, e:
+            if e.args[0] != errno.EAGAIN:
+                raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(CHUNK_SIZE)
+        except socket.error:
+            pass
+        while self.callbacks:
+            (callback, args) = self.callbacks.popleft()
+            callback(*args)
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.writer.close()
+
+class AsyncServer(asyncore.dispatcher):
+    """Serves the mobwrite telnet protocol from one thread, with worker
+    threads for the questions.
+
+    worker_factory makes the object that answers questions in each worker
+    thread, DaemonMobWrite by default."""
+
+    def __init__(self, address, workers=8, max_pending=256,
+                 worker_factory=None):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(1024)
+        self.address = self.socket.getsockname()
+        self.connections = set()
+        self.max_pending = max_pending
+        self.pending = 0
+        self.running = False
+        self.waker = Waker(self.map)
+        self.worker_factory = worker_factory or mobwrite_daemon.DaemonMobWrite
+        self.questions = Queue.Queue()
+        self.workers = []
+        for i in xrange(workers):
+            worker = threading.Thread(target=self._work,
+                                      name="mobwrite-worker-%d" % i)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def handle_accept(self):
+        # Take every waiting connection, not one per pass of the loop.
+        for i in xrange(ACCEPT_BATCH):
+            pair = self.accept()
+            if pair is None:
+                return
+            (sock, address) = pair
+            origin = mobwrite_daemon.CONNECTION_ORIGIN
+            if origin and address[0] != origin:
+                log.warning("Connection refused from %s", address[0])
+                sock.close()
+                continue
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections.add(Connection(self, sock))
+
+    def handle_error(self):
+        log.exception("Error in the mobwrite server")
+
+    def saturated(self):
+        return self.pending >= self.max_pending
+
+    def submit(self, connection, question):
+        self.pending += 1
+        self.questions.put((connection, question))
+
+    def _answered(self, connection, answer):
+        self.pending -= 1
+        connection.answered(answer)
+
+    def _work(self):
+        mobwrite = self.worker_factory()
+        while True:
+            item = self.questions.get()
+            if item is None:
+                return
+            (connection, question) = item
+            try:
+                answer = mobwrite.handleRequest(question)
+            except:
+                log.exception("Error handling mobwrite request")
+                answer = None
+            # this thread lives as long as the server, so it mustn't keep
+            # a transaction (or a pool connection) open between requests
+            mobwrite_daemon.release_session()
+            self.waker.call_soon(self._answered, connection, answer)
+
+    def serve_forever(self):
+        self.running = True
+        use_poll = hasattr(select, "poll")
+        last_sweep = time.time()
+        while self.running:
+            asyncore.loop(timeout=0.5, use_poll=use_poll, map=self.map,
+                          count=1)
+            now = time.time()
+            if now - last_sweep >= 1:
+                last_sweep = now
+                for connection in list(self.connections):
+                    connection.check_timeout(now)
+
+    def shutdown(self):
+        """Stops serve_forever (from another thread) and the workers."""
+        self.running = False
+        for worker in self.workers:
+            self.questions.put(None)
+        self.waker.call_soon(self._close_all)
+
+    def _close_all(self):
+        for connection in list(self.connections):
+            connection.close()
+        self.close()
+        self.waker.close()
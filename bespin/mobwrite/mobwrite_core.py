@@ -23,13 +23,14 @@ limitations under the License.
 __author__ = "fraser@google.com (Neil Fraser)"
 
 import datetime
-import diff_match_patch as dmp_module
+import dmp_backends
 import logging
 import re
 import simplejson
 
 # Global Diff/Match/Patch object.
-DMP = dmp_module.diff_match_patch()
+# Mozilla: The C backend is used when it is built, see use_dmp_backend().
+DMP = dmp_backends.make_dmp()
 DMP.Diff_Timeout = 0.1
 
 # Demo usage should limit the maximum size of any text.
@@ -53,6 +54,128 @@ LOG = logging.getLogger("mobwrite")
 LOG.setLevel(logging.INFO)
 
 
+def use_dmp_backend(name):
+  """Replace DMP with an object of the named diff_match_patch backend, keeping
+  its settings.
+
+  Args:
+    name: "auto", "python" or "c", see dmp_backends.
+  """
+  global DMP
+  DMP = dmp_backends.make_dmp(name, DMP)
+
+
+# One "name:value" command per line.  A line whose second character is not a
+# colon is not a command.
+COMMAND_RE = re.compile(r"^([^\n:]):([^\n]*)$", re.M)
+
+# Commands whose value starts with a version number.
+VERSIONED_COMMANDS = frozenset("FfDdRr")
+
+
+def tokenize_request(data):
+  """Split raw MobWrite commands into (name, value) pairs, stopping at the
+  first blank line.
+
+  Args:
+    data: A multi-line string of MobWrite commands.
+
+  Returns:
+    A list of (name, value) tuples, or None if data does not end with a
+    blank line.
+  """
+  if not (data.endswith("\n\n") or data.endswith("\r\r") or
+          data.endswith("\n\r\n\r") or data.endswith("\r\n\r\n")):
+    # There must be a linefeed followed by a blank line.
+    return None
+  if "\r" in data:
+    data = data.replace("\r\n", "\n").replace("\r", "\n")
+  if data.startswith("\n"):
+    return []
+  # Terminate on blank line.
+  return COMMAND_RE.findall(data, 0, data.find("\n\n") + 1)
+
+
+# Clients send the same metadata with every request, so remember what the
+# latest ones decoded to.
+METADATA_CACHE_SIZE = 1000
+_metadata_cache = {}
+
+
+def decode_metadata(value):
+  """Decode the JSON of an "m:" command into a new dictionary.
+
+  Args:
+    value: The JSON text.
+
+  Returns:
+    The decoded metadata, or {} if value is not valid JSON.
+  """
+  metadata = _metadata_cache.get(value)
+  if metadata is None:
+    try:
+      metadata = simplejson.loads(value)
+    except:
+      LOG.info("Error deserializing clientData. ignoring")
+      # TODO: We should run a check that the passed object really is an
+      # object and not an array, string, number, etc.
+      return {}
+    if not isinstance(metadata, dict):
+      return metadata
+    if len(_metadata_cache) >= METADATA_CACHE_SIZE:
+      _metadata_cache.clear()
+    _metadata_cache[value] = metadata
+  # Views keep, and change, the dictionary they are given.
+  return dict(metadata)
+
+
+class Action(object):
+  # One action of a request, as returned by MobWrite.parseRequest.
+
+  # Actions are also readable as dictionaries, action["mode"], for code
+  # written against the dictionaries parseRequest used to return.
+
+  __slots__ = ("username", "filename", "mode", "data", "force",
+               "server_version", "client_version", "handle", "metadata",
+               "echo_username", "echo_collaborators", "to_close")
+
+  def __init__(self, username, filename, mode, data=None, force=False,
+               server_version=None, client_version=None, handle=None,
+               metadata=None, echo_username=False, echo_collaborators=False,
+               to_close=None):
+    self.username = username
+    self.filename = filename
+    self.mode = mode
+    self.data = data
+    self.force = force
+    self.server_version = server_version
+    self.client_version = client_version
+    self.handle = handle
+    self.metadata = metadata
+    self.echo_username = echo_username
+    self.echo_collaborators = echo_collaborators
+    self.to_close = to_close
+
+  def __getitem__(self, key):
+    try:
+      return getattr(self, key)
+    except (AttributeError, TypeError):
+      raise KeyError(key)
+
+  def __setitem__(self, key, value):
+    setattr(self, key, value)
+
+  def __contains__(self, key):
+    return key in self.__slots__
+
+  def get(self, key, default=None):
+    return getattr(self, key, default)
+
+  def __repr__(self):
+    return "Action(%s)" % ", ".join(["%s=%r" % (key, getattr(self, key))
+                                     for key in self.__slots__])
+
+
 class TextObj:
   # An object which stores a text.
 
@@ -60,25 +183,34 @@ class TextObj:
   # .name - The unique name for this text, e.g 'proposal'
   # .text - The text itself.
   # .changed - Has the text changed since the last time it was saved.
+  # .version - Incremented every time the text changes.
 
   def __init__(self, *args, **kwargs):
     # Setup this object
     self.name = kwargs.get("name")
     self.text = None
     self.changed = False
+    self.version = 0
 
-  def setText(self, newtext):
+  def setText(self, newtext, diffs=None):
+    # diffs, if known, are the change from the current text to newtext.
+    # Returns them, or None if scrubbing the text made them wrong.
     # Scrub the text before setting it.
     if newtext != None:
       # Keep the text within the length limit.
       if MAX_CHARS != 0 and len(newtext) > MAX_CHARS:
         newtext = newtext[-MAX_CHARS:]
         LOG.warning("Truncated text to %d characters." % MAX_CHARS)
+        diffs = None
       # Normalize linebreaks to LF.
-      newtext = re.sub(r"(\r\n|\r|\n)", "\n", newtext)
+      (newtext, count) = re.subn(r"(\r\n|\r)", "\n", newtext)
+      if count:
+        diffs = None
     if self.text != newtext:
       self.text = newtext
       self.changed = True
+      self.version += 1
+    return diffs
 
 
 class ViewObj:
@@ -93,6 +225,8 @@ class ViewObj:
   # .shadow_server_version - The server's version for the shadow (m).
   # .backup_shadow_server_version - the server's version for the backup
   #     shadow (m).
+  # .shadow_text_version - The version of the text that the shadow is a
+  #     copy of, or None if the shadow came from the client.
 
   def __init__(self, *args, **kwargs):
     # Setup this object
@@ -103,6 +237,7 @@ class ViewObj:
     self.backup_shadow_server_version = kwargs.get("backup_shadow_server_version", 0)
     self.shadow = kwargs.get("shadow", u"")
     self.backup_shadow = kwargs.get("backup_shadow", u"")
+    self.shadow_text_version = None
 
 
 class MobWrite:
@@ -115,146 +250,129 @@ class MobWrite:
       data: A multi-line string of MobWrite commands.
 
     Returns:
-      A list of actions, each action is a dictionary.  Typical action:
-      {"username":"fred",
-       "filename":"report",
-       "mode":"delta",
-       "data":"=10+Hello-7=2",
-       "force":False,
-       "server_version":3,
-       "client_version":3,
-       "echo_username":False
-      }
+      A list of actions, each action is an Action.  Typical action:
+      Action(username="fred",
+             filename="report",
+             mode="delta",
+             data="=10+Hello-7=2",
+             force=False,
+             server_version=3,
+             client_version=3,
+             echo_username=False)
     """
     # Passing a Unicode string is an easy way to cause numerous subtle bugs.
     if type(data) != str:
       LOG.critical("parseRequest data type is %s" % type(data))
       return []
-    if not (data.endswith("\n\n") or data.endswith("\r\r") or
-            data.endswith("\n\r\n\r") or data.endswith("\r\n\r\n")):
-      # There must be a linefeed followed by a blank line.
-      # Truncated data.  Abort.
-      LOG.warning("Truncated data: '%s'" % data)
-      return []
 
-    # Parse the lines
-    actions = []
-    username = None
-    filename = None
-    handle = None
-    metadata = {}
-    server_version = None
-    echo_username = False
-    echo_collaborators = False
-    for line in data.splitlines():
-      if not line:
-        # Terminate on blank line.
-        break
-      if line.find(":") != 1:
-        # Invalid line.
-        continue
-      (name, value) = (line[:1], line[2:])
-
-      # Parse out a version number for file, delta or raw.
-      version = None
-      if ("FfDdRr".find(name) != -1):
-        div = value.find(":")
-        if div > 0:
+    # Mozilla: A completed buffer restarts parsing on its text, so loop
+    # rather than recurse.
+    while True:
+      commands = tokenize_request(data)
+      if commands is None:
+        # Truncated data.  Abort.
+        LOG.warning("Truncated data: '%s'" % data)
+        return []
+
+      actions = []
+      username = None
+      filename = None
+      handle = None
+      metadata = {}
+      server_version = None
+      echo_username = False
+      echo_collaborators = False
+      for (name, value) in commands:
+        # Parse out a version number for file, delta or raw.
+        version = None
+        if name in VERSIONED_COMMANDS:
+          (version, div, value) = value.partition(":")
+          if not (div and version):
+            LOG.warning("Missing version number: %s:%s%s%s" %
+                (name, version, div, value))
+            continue
           try:
-            version = int(value[:div])
+            version = int(version)
           except ValueError:
-            LOG.warning("Invalid version number: %s" % line)
+            LOG.warning("Invalid version number: %s:%s:%s" %
+                (name, version, value))
             continue
-          value = value[div + 1:]
-        else:
-          LOG.warning("Missing version number: %s" % line)
-          continue
-
-      if name == "b" or name == "B":
-        # Decode and store this entry into a buffer.
-        try:
-          (name, size, index, text) = value.split(" ", 3)
-          size = int(size)
-          index = int(index)
-        except ValueError:
-          LOG.warning("Invalid buffer format: %s" % value)
-          continue
-        # Store this buffer fragment.
-        text = self.feedBuffer(name, size, index, text)
-        # Check to see if the buffer is complete.  If so, execute it.
-        if text:
-          LOG.info("Executing buffer: %s_%d" % (name, size))
-          # Duplicate last character.  Should be a line break.
-          # Note that buffers are not intended to be mixed with other commands.
-          return self.parseRequest(text + text[-1])
-
-      elif name == "u" or name == "U":
-        # Remember the username.
-        username = value
-        # Client may request explicit usernames in response.
-        echo_username = (name == "U")
-
-      elif name == "h" or name == "H":
-        # Remember the username.
-        handle = value
-        # Client may request explicit collaborator handles in response.
-        echo_collaborators = (name == "H")
-
-      elif name == "m":
-        try:
-          metadata = simplejson.loads(value)
-        except:
-          LOG.info("Error deserializing clientData. ignoring")
-          # TODO: We should run a check that the passed object really is an
-          # object and not an array, string, number, etc.
-          metadata = {}
-
-      elif name == "f" or name == "F":
-        # Remember the filename and version.
-        filename = value
-        server_version = version
-
-      elif name == "n" or name == "N":
-        # Nullify this file.
-        filename = value
-        if username and filename:
-          action = {}
-          action["username"] = username
-          action["filename"] = filename
-          action["mode"] = "null"
-          actions.append(action)
 
-      else:
-        # A delta or raw action.
-        action = {}
-        if name == "d" or name == "D":
-          action["mode"] = "delta"
-        elif name == "r" or name == "R":
-          action["mode"] = "raw"
+        if name == "d" or name == "D" or name == "r" or name == "R":
+          # A delta or raw action.
+          if username:
+            actions.append(Action(username, filename,
+                name in "dD" and "delta" or "raw", data=value,
+                force=name.isupper(), server_version=server_version,
+                client_version=version, handle=handle, metadata=metadata,
+                echo_username=echo_username,
+                echo_collaborators=echo_collaborators))
+          else:
+            LOG.warning("Skipping %s:%d:%s: username=None, filename=%s" %
+                (name, version, value, filename))
+
+        elif name == "f" or name == "F":
+          # Remember the filename and version.
+          filename = value
+          server_version = version
+
+        elif name == "u" or name == "U":
+          # Remember the username.
+          username = value
+          # Client may request explicit usernames in response.
+          echo_username = (name == "U")
+
+        elif name == "h" or name == "H":
+          # Remember the username.
+          handle = value
+          # Client may request explicit collaborator handles in response.
+          echo_collaborators = (name == "H")
+
+        elif name == "m":
+          metadata = decode_metadata(value)
+
+        elif name == "b" or name == "B":
+          # Decode and store this entry into a buffer.
+          try:
+            (name, size, index, text) = value.split(" ", 3)
+            size = int(size)
+            index = int(index)
+          except ValueError:
+            LOG.warning("Invalid buffer format: %s" % value)
+            continue
+          # Store this buffer fragment.
+          text = self.feedBuffer(name, size, index, text)
+          # Check to see if the buffer is complete.  If so, execute it.
+          if text:
+            LOG.info("Executing buffer: %s_%d" % (name, size))
+            # Duplicate last character.  Should be a line break.
+            # Note that buffers are not intended to be mixed with other
+            # commands.
+            data = text + text[-1]
+            break
+
+        elif name == "n" or name == "N":
+          # Nullify this file.
+          filename = value
+          if username and filename:
+            actions.append(Action(username, filename, "null", handle=handle,
+                                  metadata=metadata))
+
         elif name == "x":
-          action["mode"] = "close"
-          action["to_close"] = value
-        else:
-          action["mode"] = None
-        if name.isupper():
-          action["force"] = True
-        else:
-          action["force"] = False
-        action["server_version"] = server_version
-        action["client_version"] = version
-        action["data"] = value
-        action["handle"] = handle
-        action["metadata"] = metadata
-        action["echo_username"] = echo_username
-        action["echo_collaborators"] = echo_collaborators
-        if username and action["mode"]:
-          action["username"] = username
-          action["filename"] = filename
-          actions.append(action)
+          if username:
+            actions.append(Action(username, filename, "close", data=value,
+                to_close=value, server_version=server_version, handle=handle,
+                metadata=metadata, echo_username=echo_username,
+                echo_collaborators=echo_collaborators))
+          else:
+            LOG.warning("Skipping x:%s: username=None, filename=%s" %
+                (value, filename))
+
         else:
-          LOG.warning("Skipping " + str(action) + ": username=" + str(username) + ", filename=" + str(filename) + ", action[mode]=" + str(action["mode"]))
+          LOG.warning("Skipping %s:%s: unknown command" % (name, value))
 
-    return actions
+      else:
+        return actions
 
 
   def applyPatches(self, viewobj, diffs, action):
@@ -269,9 +387,14 @@ class MobWrite:
     """
     # Expand the fragile diffs into a full set of patches.
     patches = DMP.patch_make(viewobj.shadow, diffs)
+    # If the shadow was a copy of the current text, nobody else has changed
+    # the text and the client's diffs are exactly the change to it.
+    in_step = viewobj.shadow_text_version is not None and \
+        viewobj.shadow_text_version == viewobj.textobj.version
 
     # First, update the client's shadow.
     viewobj.shadow = DMP.diff_text2(diffs)
+    viewobj.shadow_text_version = None
     viewobj.backup_shadow = viewobj.shadow
     viewobj.backup_shadow_server_version = viewobj.shadow_server_version
 
@@ -280,11 +403,11 @@ class MobWrite:
     if textobj.text is None:
       # A view is sending a valid delta on a file we've never heard of.
       textobj.setText(viewobj.shadow)
-      action["force"] = False
+      action.force = False
       LOG.debug("Set content: '%s@%s'" %
           (viewobj.username, viewobj.filename))
     else:
-      if action["force"]:
+      if action.force:
         # Clobber the server's text if a change was received.
         if patches:
           mastertext = viewobj.shadow
@@ -297,4 +420,12 @@ class MobWrite:
         LOG.debug("Patched (%s): '%s@%s'" %
             (",".join(["%s" % (x) for x in results]),
              viewobj.username, viewobj.filename))
-      textobj.setText(mastertext)
+      # The client's diffs spare the journal from working out the change.
+      if in_step:
+        textobj.setText(mastertext, diffs=diffs)
+      else:
+        textobj.setText(mastertext)
+    if textobj.text == viewobj.shadow:
+      # Nobody else changed the text, so the client is already up to date
+      # and the next response needs no diff.
+      viewobj.shadow_text_version = textobj.version
@@ -25,9 +25,13 @@ from clients.
 
 __author__ = "fraser@google.com (Neil Fraser)"
 
+import collections
+import cPickle
 import datetime
-import glob
+import heapq
+import logging
 import os
+import signal
 import socket
 import SocketServer
 import sys
@@ -37,18 +41,19 @@ import urllib
 import simplejson
 
 import mobwrite_core
-from bespin.mobwrite.integrate import Persister, Access, get_username_from_handle
+from bespin.mobwrite.integrate import WriteBehindPersister, Access, get_username_from_handle, check_access_many
+from bespin.mobwrite import metrics, storage, transport
+from bespin.mobwrite.journal import DeltaJournal
+from bespin import config, database
 
 # Demo usage should limit the maximum number of connected views.
 # Set to 0 to disable limit.
 MAX_VIEWS = 10000
 
-# How should data be stored.
-MEMORY = 0
-FILE = 1
-BDB = 2
-PERSISTER = 3
-STORAGE_MODE = PERSISTER
+# How often, in seconds, the memory held by texts and views is measured.
+# Above c.mobwrite_memory_budget bytes, idle documents are unloaded (see
+# govern_memory).
+MEMORY_CHECK_INTERVAL = 5
 
 # Port to listen on.
 LOCAL_PORT = 3017
@@ -56,24 +61,137 @@ LOCAL_PORT = 3017
 # If the Telnet connection stalls for more than 2 seconds, give up.
 TIMEOUT_TELNET = 2.0
 
+# How long a kept-alive Telnet connection may sit idle between requests.
+# This should be longer than the idle timeout of the web nodes' pools.
+TIMEOUT_KEEPALIVE = 60.0
+
 # Restrict all Telnet connections to come from this location.
 # Set to "" to allow connections from anywhere.
 CONNECTION_ORIGIN = "127.0.0.1"
 
+class ExpiryQueue:
+  # Objects ordered by when they expire, so that cleanup only visits the
+  # ones that are due.
+
+  # Objects are not moved when they are used again.  An entry whose object
+  # has been used since it was queued is put back with its new expiry time
+  # when it comes due, and dropped if its object is gone.
+
+  def __init__(self, expiry_of, is_live):
+    # expiry_of(obj) returns when obj expires, or None if it does not.
+    # is_live(obj) says whether obj is still in its dictionary.
+    self.expiry_of = expiry_of
+    self.is_live = is_live
+    self.heap = []
+    self.count = 0
+    self.lock = thread.allocate_lock()
+
+  def __len__(self):
+    return len(self.heap)
+
+  def clear(self):
+    self.lock.acquire()
+    try:
+      self.heap = []
+    finally:
+      self.lock.release()
+
+  def add(self, obj):
+    expiry = self.expiry_of(obj)
+    if expiry is None:
+      return
+    self.lock.acquire()
+    try:
+      # The count keeps entries with the same expiry in order.
+      self.count += 1
+      heapq.heappush(self.heap, (expiry, self.count, obj))
+    finally:
+      self.lock.release()
+
+  def expire(self, now):
+    # Call cleanup() on every object that is due by now.  Returns the number
+    # of entries that were looked at.
+    due = []
+    self.lock.acquire()
+    try:
+      while self.heap and self.heap[0][0] <= now:
+        due.append(heapq.heappop(self.heap)[2])
+    finally:
+      self.lock.release()
+    for obj in due:
+      if not self.is_live(obj):
+        continue
+      expiry = self.expiry_of(obj)
+      if expiry is not None and expiry <= now:
+        obj.cleanup()
+      if self.is_live(obj):
+        self.add(obj)
+    return len(due)
+
+
 # Dictionary of all text objects.
 texts = {}
 
-# Berkeley Databases
-texts_db = None
-lasttime_db = None
+# Number of locks that the texts and views dictionaries are striped over.
+# Creating or deleting an entry takes only the lock for its key, so work on
+# one document does not hold up work on documents in other stripes.
+LOCK_STRIPES = 64
 
-# Lock to prevent simultaneous changes to the texts dictionary.
-lock_texts = thread.allocate_lock()
+# Locks to prevent simultaneous changes to an entry in the texts dictionary.
+text_locks = [thread.allocate_lock() for x in xrange(LOCK_STRIPES)]
+
+def text_lock(name):
+  return text_locks[hash(name) % LOCK_STRIPES]
 
 # A special mode to save on every change which should reduce the impact of
-# server crashes and restarts at the expense of server-load
+# server crashes and restarts at the expense of server-load.  With
+# c.mobwrite_save_interval set, these saves are coalesced by a
+# WriteBehindPersister (see get_persister).
 PARANOID_SAVE = True
 
+# The persister shared by all requests, of the kind named by
+# c.mobwrite_storage (see bespin.mobwrite.storage).
+persister = None
+lock_persister = thread.allocate_lock()
+
+def get_persister():
+  global persister
+  lock_persister.acquire()
+  try:
+    if persister is None:
+      c = config.c
+      if c.mobwrite_save_interval:
+        persister = WriteBehindPersister(storage.make_persister(c),
+            interval=c.mobwrite_save_interval,
+            max_pending_bytes=c.mobwrite_save_max_pending)
+        persister.start()
+      else:
+        persister = storage.make_persister(c)
+      if get_journal() and isinstance(persister, WriteBehindPersister):
+        # Journals are only discarded once the text is really written.
+        persister.on_flush = journal.discard
+  finally:
+    lock_persister.release()
+  return persister
+
+# The delta journal, if c.mobwrite_journal_dir is set.
+journal = None
+
+def get_journal():
+  global journal
+  if journal is None and config.c.mobwrite_journal_dir:
+    journal = DeltaJournal(config.c.mobwrite_journal_dir,
+                           config.c.mobwrite_journal_compact_every)
+  return journal
+
+def release_session():
+  # Hand back the calling thread's database session once a request is
+  # answered, so that the next request starts a fresh transaction (and sees
+  # sharing changes made since) and no pool connection is held in between.
+  session_factory = config.c.get("session_factory")
+  if session_factory is not None:
+    session_factory.remove()
+
 class TextObj(mobwrite_core.TextObj):
   # A persistent object which stores a text.
 
@@ -91,15 +209,23 @@ class TextObj(mobwrite_core.TextObj):
     # Setup this object
     mobwrite_core.TextObj.__init__(self, *args, **kwargs)
     self.persister = kwargs.get("persister")
+    self.journal = get_journal()
+    # The number of the journal record for the current text.
+    self.journal_seq = None
     self.handle = kwargs.get("handle")
     self.views = []
     self.lasttime = datetime.datetime.now()
     self.lock = thread.allocate_lock()
-    self.load()
-
-    # lock_texts must be acquired by the caller to prevent simultaneous
-    # creations of the same text.
-    assert lock_texts.locked(), "Can't create TextObj unless locked."
+    # Deltas already worked out for this text, keyed by (from version,
+    # to version).  Only deltas to the current version are kept.
+    self.delta_cache = {}
+    # The text is loaded by ensure_loaded, outside of the stripe lock.
+    self.loaded = False
+    self.load_lock = thread.allocate_lock()
+
+    # The stripe lock for the name must be acquired by the caller to
+    # prevent simultaneous creations of the same text.
+    assert text_lock(self.name).locked(), "Can't create TextObj unless locked."
     global texts
     texts[self.name] = self
 
@@ -108,9 +234,16 @@ class TextObj(mobwrite_core.TextObj):
     return "TextObj[len(text)=" + str(len(self.text)) + ", chgd=" + str(self.changed) + ", len(views)=" + str(len(self.views)) + "]"
 
 
-  def setText(self, newText, justLoaded=False):
-    mobwrite_core.TextObj.setText(self, newText)
+  def setText(self, newText, justLoaded=False, diffs=None):
+    oldText = self.text
+    oldVersion = self.version
+    diffs = mobwrite_core.TextObj.setText(self, newText, diffs)
+    if self.journal and not justLoaded and self.version != oldVersion:
+      self.journal_seq = self.journal.append(self.name, oldText, self.text,
+                                             diffs)
     self.lasttime = datetime.datetime.now()
+    if self.changed and not justLoaded:
+      mark_changed(self)
     if self.changed and PARANOID_SAVE and not justLoaded:
       if self.lock.locked():
         self.save()
@@ -125,118 +258,150 @@ class TextObj(mobwrite_core.TextObj):
     # General cleanup task.
     if len(self.views) > 0:
       return
-    terminate = False
     # Lock must be acquired to prevent simultaneous deletions.
     mobwrite_core.LOG.debug("text.lock.acquire on %s", self.name)
     self.lock.acquire()
     try:
-      if STORAGE_MODE == MEMORY:
-        if self.lasttime < datetime.datetime.now() - mobwrite_core.TIMEOUT_TEXT:
-          mobwrite_core.LOG.info("Expired text: '%s'" % self.name)
-          terminate = True
-      else:
-        # Delete myself from memory if there are no attached views.
-        mobwrite_core.LOG.info("Unloading text: '%s'" % self.name)
-        terminate = True
-
-      if terminate:
-        # Save to disk/database.
-        self.save()
-        # Terminate in-memory copy.
-        global texts
-        mobwrite_core.LOG.debug("lock_texts.acquire")
-        lock_texts.acquire()
-        try:
-          del texts[self.name]
-        except KeyError:
-          mobwrite_core.LOG.error("Text object not in text list: '%s'" % self.name)
-        finally:
-          mobwrite_core.LOG.debug("lock_texts.release")
-          lock_texts.release()
-      else:
-        if self.changed:
-          self.save()
+      # Delete myself from memory if there are no attached views.
+      mobwrite_core.LOG.info("Unloading text: '%s'" % self.name)
+      # Save to the persister, and stay in memory if that fails.
+      if not self.save():
+        return
+      # Terminate in-memory copy.
+      global texts
+      stripe = text_lock(self.name)
+      mobwrite_core.LOG.debug("text stripe acquire for %s", self.name)
+      stripe.acquire()
+      try:
+        if self.views:
+          # A view was attached while this text was being saved.
+          return
+        del texts[self.name]
+      except KeyError:
+        mobwrite_core.LOG.error("Text object not in text list: '%s'" % self.name)
+      finally:
+        mobwrite_core.LOG.debug("text stripe release for %s", self.name)
+        stripe.release()
     finally:
       mobwrite_core.LOG.debug("text.lock.release on %s", self.name)
       self.lock.release()
 
 
+  def memory_size(self):
+    # Bytes held by the text and its cached deltas, not counting views.
+    size = string_size(self.text)
+    for delta in self.delta_cache.values():
+      size += string_size(delta)
+    return size
+
+
+  def cached_delta(self, from_version, to_version):
+    return self.delta_cache.get((from_version, to_version))
+
+
+  def cache_delta(self, from_version, to_version, delta):
+    if to_version != self.version:
+      return
+    for key in self.delta_cache.keys():
+      if key[1] != to_version:
+        del self.delta_cache[key]
+    self.delta_cache[(from_version, to_version)] = delta
+
+
+  def ensure_loaded(self):
+    # Load the text the first time it is needed.  Only threads that want
+    # this text wait for the load.
+    if self.loaded:
+      return
+    self.load_lock.acquire()
+    try:
+      if not self.loaded:
+        self.load()
+        self.loaded = True
+    finally:
+      self.load_lock.release()
+
+
   def load(self):
-    # Load the text object from non-volatile storage.
-    if STORAGE_MODE == PERSISTER:
+    # Load the text object from the persister, or the journal if it has
+    # edits that were never saved.
+    found = False
+    if self.journal:
+      (found, contents) = self.journal.load(self.name)
+    if found:
+      self.setText(contents, justLoaded=True)
+      self.journal_seq = self.journal.sequence(self.name)
+      self.changed = True
+      mark_changed(self)
+    else:
+      start = time.time()
       contents = self.persister.load(self.name, self.handle)
+      metrics.observe("persister_load", time.time() - start)
       self.setText(contents, justLoaded=True)
       self.changed = False
 
-    if STORAGE_MODE == FILE:
-      # Load the text (if present) from disk.
-      filename = "%s/%s.txt" % (DATA_DIR, urllib.quote(self.name, ""))
-      if os.path.exists(filename):
-        try:
-          infile = open(filename, "r")
-          self.setText(infile.read().decode("utf-8"))
-          infile.close()
-          self.changed = False
-          mobwrite_core.LOG.info("Loaded file: '%s'" % filename)
-        except:
-          mobwrite_core.LOG.critical("Can't read file: %s" % filename)
-      else:
-        self.setText(None)
-        self.changed = False
-
-    if STORAGE_MODE == BDB:
-      # Load the text (if present) from database.
-      if texts_db.has_key(self.name):
-        self.setText(texts_db[self.name].decode("utf-8"))
-        mobwrite_core.LOG.info("Loaded from DB: '%s'" % self.name)
-      else:
-        self.setText(None)
-      self.changed = False
-
 
   def save(self):
-    # Save the text object to non-volatile storage.
+    # Save the text object to the persister.  Returns False if that failed.
     # Lock must be acquired by the caller to prevent simultaneous saves.
     assert self.lock.locked(), "Can't save unless locked."
+    if not self.loaded:
+      # Saving now would overwrite the stored text with nothing.
+      return True
 
-    if STORAGE_MODE == PERSISTER:
-      self.persister.save(self.name, self.text, self.handle)
-      self.changed = False
-
-    if STORAGE_MODE == FILE:
-      # Save the text to disk.
-      filename = "%s/%s.txt" % (DATA_DIR, urllib.quote(self.name, ''))
-      if self.text is None:
-        # Nullified text equates to no file.
-        if os.path.exists(filename):
-          try:
-            os.remove(filename)
-            mobwrite_core.LOG.info("Nullified file: '%s'" % filename)
-          except:
-            mobwrite_core.LOG.critical("Can't nullify file: %s" % filename)
-      else:
-        try:
-          outfile = open(filename, "w")
-          outfile.write(self.text.encode("utf-8"))
-          outfile.close()
-          self.changed = False
-          mobwrite_core.LOG.info("Saved file: '%s'" % filename)
-        except:
-          mobwrite_core.LOG.critical("Can't save file: %s" % filename)
-
-    if STORAGE_MODE == BDB:
-      # Save the text to database.
-      if self.text is None:
-        if lasttime_db.has_key(self.name):
-          del lasttime_db[self.name]
-        if texts_db.has_key(self.name):
-          del texts_db[self.name]
-          mobwrite_core.LOG.info("Nullified from DB: '%s'" % self.name)
+    start = time.time()
+    write_behind = isinstance(self.persister, WriteBehindPersister)
+    try:
+      if write_behind:
+        # The journal is discarded once the write goes through.
+        self.persister.save(self.name, self.text, self.handle,
+                            journal_seq=self.journal_seq)
       else:
-        mobwrite_core.LOG.info("Saved to DB: '%s'" % self.name)
-        texts_db[self.name] = self.text.encode("utf-8")
-        lasttime_db[self.name] = str(int(time.time()))
-      self.changed = False
+        self.persister.save(self.name, self.text, self.handle)
+    except:
+      # Keep the text (and its journal) until a save goes through.
+      mobwrite_core.LOG.exception("Error saving text: '%s'" % self.name)
+      mark_changed(self)
+      return False
+    metrics.observe("persister_save", time.time() - start)
+    self.changed = False
+    if self.journal and not write_behind:
+      self.journal.discard(self.name, self.journal_seq)
+    return True
+
+
+# Texts that have changed since the cleanup task last saved them.
+changed_texts = set()
+lock_changed_texts = thread.allocate_lock()
+
+def mark_changed(textobj):
+  lock_changed_texts.acquire()
+  try:
+    changed_texts.add(textobj)
+  finally:
+    lock_changed_texts.release()
+
+def take_changed():
+  # Return the texts marked as changed and start a new set.
+  global changed_texts
+  lock_changed_texts.acquire()
+  try:
+    taken = changed_texts
+    changed_texts = set()
+  finally:
+    lock_changed_texts.release()
+  return taken
+
+
+def text_expiry(textobj):
+  # Texts with views stay; the others are unloaded straight away.
+  if textobj.views:
+    return None
+  return datetime.datetime.min
+
+# Texts that have lost their last view, by when they may be dropped.
+text_queue = ExpiryQueue(text_expiry,
+                         lambda textobj: texts.get(textobj.name) is textobj)
 
 
 def fetch_textobj(name, view, persister, handle):
@@ -244,8 +409,11 @@ def fetch_textobj(name, view, persister, handle):
   # Add the given view into the text object's list of connected views.
   # Don't let two simultaneous creations happen, or a deletion during a
   # retrieval.
-  mobwrite_core.LOG.debug("lock_texts.acquire")
-  lock_texts.acquire()
+  # The text is not loaded yet when it is first created; callers use
+  # textobj.ensure_loaded() once they no longer hold any stripe lock.
+  stripe = text_lock(name)
+  mobwrite_core.LOG.debug("text stripe acquire for %s", name)
+  stripe.acquire()
   try:
     if texts.has_key(name):
       textobj = texts[name]
@@ -255,22 +423,58 @@ def fetch_textobj(name, view, persister, handle):
       mobwrite_core.LOG.debug("Creating text: '%s'" % name)
     textobj.views.append(view)
   finally:
-    mobwrite_core.LOG.debug("lock_texts.release")
-    lock_texts.release()
+    mobwrite_core.LOG.debug("text stripe release for %s", name)
+    stripe.release()
   return textobj
 
 
 # Dictionary of all view objects.
 views = {}
 
-# Lock to prevent simultaneous changes to the views dictionary.
-lock_views = thread.allocate_lock()
+# Locks to prevent simultaneous changes to an entry in the views dictionary.
+view_locks = [thread.allocate_lock() for x in xrange(LOCK_STRIPES)]
+
+def view_lock(username, filename):
+  return view_locks[hash((username, filename)) % LOCK_STRIPES]
+
+class EditStack:
+  # The edits sent to a client that it has not acknowledged yet, oldest
+  # first.  Every response repeats them all.
+
+  # Object properties:
+  # .edits - Deque of (server version, edit) pairs, in version order.
+  # .bytes - The total length of the edits.
+
+  def __init__(self):
+    self.edits = collections.deque()
+    self.bytes = 0
+
+  def __iter__(self):
+    return iter(self.edits)
+
+  def __len__(self):
+    return len(self.edits)
+
+  def push(self, version, edit):
+    self.edits.append((version, edit))
+    self.bytes += len(edit)
+
+  def acknowledge(self, version):
+    # Drop the edits the client has acknowledged by sending version.
+    edits = self.edits
+    while edits and edits[0][0] <= version:
+      self.bytes -= len(edits.popleft()[1])
+
+  def clear(self):
+    self.edits.clear()
+    self.bytes = 0
+
 
 class ViewObj(mobwrite_core.ViewObj):
   # A persistent object which contains one user's view of one text.
 
   # Object properties:
-  # .edit_stack - List of unacknowledged edits sent to the client.
+  # .edit_stack - EditStack of unacknowledged edits sent to the client.
   # .lasttime - The last time that a web connection serviced this object.
   # .lock - Access control for writing to the text on this object.
   # .textobj - The shared text object being worked on.
@@ -290,16 +494,19 @@ class ViewObj(mobwrite_core.ViewObj):
     mobwrite_core.ViewObj.__init__(self, *args, **kwargs)
     self.handle = kwargs.get("handle")
     self.metadata = kwargs.get("metadata")
-    self.edit_stack = []
+    self.edit_stack = EditStack()
     self.lasttime = datetime.datetime.now()
     self.lock = thread.allocate_lock()
     self.textobj = fetch_textobj(self.filename, self, kwargs.get("persister"), kwargs.get("handle"))
 
-    # lock_views must be acquired by the caller to prevent simultaneous
-    # creations of the same view.
-    assert lock_views.locked(), "Can't create ViewObj unless locked."
+    # The stripe lock for the view must be acquired by the caller to
+    # prevent simultaneous creations of the same view.
+    assert view_lock(self.username, self.filename).locked(), \
+        "Can't create ViewObj unless locked."
     global views
     views[(self.username, self.filename)] = self
+    index_view(self)
+    view_queue.add(self)
 
 
   def __str__(self):
@@ -310,37 +517,99 @@ class ViewObj(mobwrite_core.ViewObj):
     # General cleanup task.
     # Delete myself if I've been idle too long.
     # Don't delete during a retrieval.
-    mobwrite_core.LOG.debug("lock_views.acquire")
-    lock_views.acquire()
+    stripe = view_lock(self.username, self.filename)
+    mobwrite_core.LOG.debug("view stripe acquire for %s@%s", self.username, self.filename)
+    stripe.acquire()
     try:
       if self.lasttime < datetime.datetime.now() - mobwrite_core.TIMEOUT_VIEW:
         mobwrite_core.LOG.info("Idle out: '%s@%s'" % (self.username, self.filename))
-        global views
-        try:
-          del views[(self.username, self.filename)]
-        except KeyError:
-          mobwrite_core.LOG.error("View object not in view list: '%s %s'" % (self.username, self.filename))
-        try:
-          self.textobj.views.remove(self)
-        except ValueError:
-          mobwrite_core.LOG.error("self not in views list: '%s %s'" % (self.username, self.filename))
+        self.remove()
     finally:
-      mobwrite_core.LOG.debug("lock_views.release")
-      lock_views.release()
+      mobwrite_core.LOG.debug("view stripe release for %s@%s", self.username, self.filename)
+      stripe.release()
+
+  def remove(self):
+    # Delete myself.  The caller must hold my view stripe lock.
+    global views
+    try:
+      del views[(self.username, self.filename)]
+    except KeyError:
+      mobwrite_core.LOG.error("View object not in view list: '%s %s'" % (self.username, self.filename))
+    unindex_view(self)
+    try:
+      self.textobj.views.remove(self)
+    except ValueError:
+      mobwrite_core.LOG.error("self not in views list: '%s %s'" % (self.username, self.filename))
+    if not self.textobj.views:
+      text_queue.add(self.textobj)
 
   def nullify(self):
     self.lasttime = datetime.datetime.min
     self.cleanup()
 
+  def memory_size(self):
+    # Bytes held by the shadows and the edit stack.  A shadow that is the
+    # text itself is counted with the text.
+    size = 0
+    for shadow in (self.shadow, self.backup_shadow):
+      if shadow is not self.textobj.text:
+        size += string_size(shadow)
+    for (version, edit) in self.edit_stack:
+      size += string_size(edit)
+    return size
+
+
+# Index of the views of each user, by username and then filename.
+user_views = {}
+lock_user_views = thread.allocate_lock()
+
+def index_view(viewobj):
+  lock_user_views.acquire()
+  try:
+    user_views.setdefault(viewobj.username, {})[viewobj.filename] = viewobj
+  finally:
+    lock_user_views.release()
+
+def unindex_view(viewobj):
+  lock_user_views.acquire()
+  try:
+    filenames = user_views.get(viewobj.username, {})
+    if filenames.get(viewobj.filename) is viewobj:
+      del filenames[viewobj.filename]
+      if not filenames:
+        del user_views[viewobj.username]
+  finally:
+    lock_user_views.release()
+
+def views_for_user(username):
+  lock_user_views.acquire()
+  try:
+    return [viewobj for viewobj in user_views.get(username, {}).values()
+            if views.get((username, viewobj.filename)) is viewobj]
+  finally:
+    lock_user_views.release()
+
+# Views by when they go idle.
+view_queue = ExpiryQueue(
+    lambda viewobj: viewobj.lasttime + mobwrite_core.TIMEOUT_VIEW,
+    lambda viewobj: views.get((viewobj.username, viewobj.filename)) is viewobj)
+
+
+def string_size(text):
+  if text is None:
+    return 0
+  return sys.getsizeof(text)
+
 
 def fetch_viewobj(username, filename, handle=None, metadata=None, persister=None):
   # Retrieve the named view object.  Create it if it doesn't exist.
   # Don't let two simultaneous creations happen, or a deletion during a
   # retrieval.
-  mobwrite_core.LOG.debug("lock_views.acquire")
-  lock_views.acquire()
+  key = (username, filename)
+  stripe = view_lock(username, filename)
+  mobwrite_core.LOG.debug("view stripe acquire for %s@%s" % key)
+  stripe.acquire()
   try:
-    key = (username, filename)
     if views.has_key(key):
       viewobj = views[key]
       viewobj.lasttime = datetime.datetime.now()
@@ -354,94 +623,244 @@ def fetch_viewobj(username, filename, handle=None, metadata=None, persister=None
         viewobj = ViewObj(username=username, filename=filename, handle=handle, metadata=metadata, persister=persister)
         mobwrite_core.LOG.debug("Creating view: '%s@%s'" % key)
   finally:
-    mobwrite_core.LOG.debug("lock_views.release")
-    lock_views.release()
+    mobwrite_core.LOG.debug("view stripe release for %s@%s" % key)
+    stripe.release()
+  if viewobj is not None:
+    viewobj.textobj.ensure_loaded()
   return viewobj
 
 
 # Dictionary of all buffer objects.
+# Mozilla: Buffers are looked up without a lock.  lock_buffers is only held
+# to create, remove and account for them.
 buffers = {}
 
 # Lock to prevent simultaneous changes to the buffers dictionary.
 lock_buffers = thread.allocate_lock()
 
+# Bytes held by all partial buffers.  Above c.mobwrite_buffer_budget, the
+# least recently written buffers are dropped.
+buffer_bytes = 0
+
+# Buffers by when they expire.
+buffer_queue = ExpiryQueue(
+    lambda bufferobj: bufferobj.lasttime + mobwrite_core.TIMEOUT_BUFFER,
+    lambda bufferobj: buffers.get(bufferobj.name) is bufferobj)
+
+def unquote_prefix(text):
+  # URL-decode as much of text as can be decoded without seeing what comes
+  # after it.  Returns the decoded part and the undecoded rest, which is
+  # a "%" escape that a slot boundary has cut short.
+  cut = text.rfind("%", -2)
+  if cut == -1:
+    return urllib.unquote(text), ""
+  return urllib.unquote(text[:cut]), text[cut:]
+
 class BufferObj:
   # A persistent object which assembles large commands from fragments.
 
   # Object properties:
-  # .name - The name (and size) of the buffer, e.g. 'alpha:12'
+  # .name - The name (and size) of the buffer, e.g. 'alpha_12'
+  # .size - The number of slots.
   # .lasttime - The last time that a web connection wrote to this object.
-  # .data - The contents of the buffer.
+  # .received - The number of slots that have been filled.
+  # .decoded - Decoded text of slots 1 to .next - 1, in pieces.
+  # .carry - The end of slot .next - 1 that could not be decoded yet.
+  # .next - The first slot that has not been decoded.
+  # .waiting - Slots after .next that arrived early, by number.
+  # .bytes - Bytes held by this buffer.
+  # .accounted - Bytes of this buffer counted in buffer_bytes.
   # .lock - Access control for writing to the text on this object.
 
   def __init__(self, name, size):
     # Setup this object
     self.name = name
+    self.size = size
     self.lasttime = datetime.datetime.now()
+    self.received = 0
+    self.decoded = []
+    self.carry = ""
+    self.next = 1
+    self.waiting = {}
+    self.bytes = 0
+    self.accounted = 0
     self.lock = thread.allocate_lock()
 
-    # Initialize the buffer with a set number of slots.
-    # Null characters form dividers between each slot.
-    array = []
-    for x in xrange(size - 1):
-      array.append("\0")
-    self.data = "".join(array)
-
     # lock_buffers must be acquired by the caller to prevent simultaneous
     # creations of the same view.
     assert lock_buffers.locked(), "Can't create BufferObj unless locked."
     global buffers
     buffers[name] = self
+    buffer_queue.add(self)
     mobwrite_core.LOG.debug("Buffer initialized to %d slots: %s" % (size, name))
 
   def __str__(self):
-    return "BufferObj[name=" + self.name + ", len(data)=" + len(self.data) + "]"
+    return "BufferObj[name=%s, received=%d/%d, bytes=%d]" % (
+        self.name, self.received, self.size, self.bytes)
 
 
   def set(self, n, text):
-    # Set the nth slot of this buffer with text.
+    # Set the nth slot of this buffer with text.  Slots are decoded as soon
+    # as every slot before them has arrived.  Returns False if the slot was
+    # already set.
     assert self.lock.locked(), "Can't edit BufferObj unless locked."
     # n is 1-based.
-    n -= 1
-    array = self.data.split("\0")
-    assert 0 <= n < len(array), "Invalid buffer insertion"
-    array[n] = text
-    self.data = "\0".join(array)
-    mobwrite_core.LOG.debug("Inserted into slot %d of a %d slot buffer: %s" %
-        (n + 1, len(array), self.name))
+    assert 0 < n <= self.size, "Invalid buffer insertion"
+    if n < self.next or n in self.waiting:
+      mobwrite_core.LOG.warning("Repeated slot %d of buffer: %s" %
+          (n, self.name))
+      return False
+    self.received += 1
+    if n != self.next:
+      self.waiting[n] = text
+      self.bytes += len(text)
+      return True
+    while True:
+      (piece, self.carry) = unquote_prefix(self.carry + text)
+      self.decoded.append(piece)
+      self.bytes += len(piece)
+      self.next += 1
+      text = self.waiting.pop(self.next, None)
+      if text is None:
+        break
+      self.bytes -= len(text)
+    mobwrite_core.LOG.debug("Decoded %d of %d slots of buffer: %s" %
+        (self.next - 1, self.size, self.name))
+    return True
 
   def get(self):
     # Fetch the completed text from the buffer.
-    if ("\0" + self.data + "\0").find("\0\0") == -1:
-      text = self.data.replace("\0", "")
-      # Delete this buffer.
-      self.lasttime = datetime.datetime.min
-      self.cleanup()
-      return text
+    if self.received == self.size:
+      return "".join(self.decoded) + urllib.unquote(self.carry)
     # Not complete yet.
     return None
 
   def cleanup(self):
     # General cleanup task.
     # Delete myself if I've been idle too long.
-    # Don't delete during a retrieval.
+    if self.lasttime < datetime.datetime.now() - mobwrite_core.TIMEOUT_BUFFER:
+      mobwrite_core.LOG.info("Expired buffer: '%s'" % self.name)
+      forget_buffer(self)
+
+
+def account_buffer(bufferobj):
+  # Count the bytes bufferobj holds now in buffer_bytes, and drop the least
+  # recently written buffers if that puts buffer_bytes over budget.
+  global buffer_bytes
+  budget = config.c.mobwrite_buffer_budget
+  mobwrite_core.LOG.debug("lock_buffers.acquire")
+  lock_buffers.acquire()
+  try:
+    if buffers.get(bufferobj.name) is not bufferobj:
+      # Completed or dropped meanwhile.
+      return
+    buffer_bytes += bufferobj.bytes - bufferobj.accounted
+    bufferobj.accounted = bufferobj.bytes
+    if not budget or buffer_bytes <= budget:
+      return
+    oldest = buffers.values()
+    oldest.sort(key=lambda other: (other is bufferobj, other.lasttime))
+    for other in oldest:
+      if buffer_bytes <= budget:
+        break
+      mobwrite_core.LOG.warning("Dropping partial buffer over budget: '%s'" %
+          other.name)
+      del buffers[other.name]
+      buffer_bytes -= other.accounted
+      other.accounted = 0
+  finally:
+    mobwrite_core.LOG.debug("lock_buffers.release")
+    lock_buffers.release()
+
+
+def forget_buffer(bufferobj):
+  # Remove bufferobj from buffers, if it is still there.
+  global buffer_bytes
+  mobwrite_core.LOG.debug("lock_buffers.acquire")
+  lock_buffers.acquire()
+  try:
+    if buffers.get(bufferobj.name) is bufferobj:
+      del buffers[bufferobj.name]
+      buffer_bytes -= bufferobj.accounted
+      bufferobj.accounted = 0
+  finally:
+    mobwrite_core.LOG.debug("lock_buffers.release")
+    lock_buffers.release()
+
+
+def fetch_bufferobj(name, size):
+  # Retrieve the named buffer object.  Create it if it doesn't exist.
+  bufferobj = buffers.get(name)
+  if bufferobj is None:
+    # Don't let two simultaneous creations happen.
     mobwrite_core.LOG.debug("lock_buffers.acquire")
     lock_buffers.acquire()
     try:
-      if self.lasttime < datetime.datetime.now() - mobwrite_core.TIMEOUT_BUFFER:
-        mobwrite_core.LOG.info("Expired buffer: '%s'" % self.name)
-        global buffers
-        del buffers[self.name]
+      bufferobj = buffers.get(name)
+      if bufferobj is None:
+        bufferobj = BufferObj(name, size)
+        mobwrite_core.LOG.debug("Creating buffer: '%s'" % name)
     finally:
       mobwrite_core.LOG.debug("lock_buffers.release")
       lock_buffers.release()
+  else:
+    mobwrite_core.LOG.debug("Found buffer: '%s'" % name)
+  bufferobj.lasttime = datetime.datetime.now()
+  return bufferobj
 
 
 class DaemonMobWrite(mobwrite_core.MobWrite):
   def __init__(self):
-    self.persister = Persister()
+    self.persister = get_persister()
+
+  def feedBuffer(self, name, size, index, datum):
+    """Add one block of text to the buffer and return the whole text if the
+      buffer is complete.
+
+    Args:
+      name: Unique name of buffer object.
+      size: Total number of slots in the buffer.
+      index: Which slot to insert this text (note that index is 1-based)
+      datum: The text to insert.
+
+    Returns:
+      String with all the text blocks merged in the correct order and
+      URL-decoded.  Or if the buffer is not yet complete returns the empty
+      string.
+    """
+    # Note that 'index' is 1-based.
+    if not 0 < index <= size:
+      mobwrite_core.LOG.error("Invalid buffer: '%s %d %d'" % (name, size, index))
+      return ""
+    elif size == 1 and index == 1:
+      # A buffer with one slot?  Pointless.
+      mobwrite_core.LOG.debug("Buffer with only one slot: '%s'" % name)
+      return urllib.unquote(datum)
+
+    name += "_%d" % size
+    bufferobj = fetch_bufferobj(name, size)
+    mobwrite_core.LOG.debug("buffer.lock.acquire on %s", name)
+    bufferobj.lock.acquire()
+    try:
+      if not bufferobj.set(index, datum):
+        return ""
+      # Check if Buffer is complete.
+      text = bufferobj.get()
+    finally:
+      mobwrite_core.LOG.debug("buffer.lock.release on %s", name)
+      bufferobj.lock.release()
+    if text is None:
+      account_buffer(bufferobj)
+      return ""
+    # Delete this buffer.
+    forget_buffer(bufferobj)
+    return text
+
 
   def handleRequest(self, text):
+    # Every action in a request looks up the same users, so let them share
+    # an identity map.
+    database.begin_identity_map()
     try:
       mobwrite_core.LOG.debug("Incoming: " + text)
       actions = self.parseRequest(text)
@@ -451,15 +870,33 @@ class DaemonMobWrite(mobwrite_core.MobWrite):
     except:
       mobwrite_core.LOG.exception("Error handling request: " + text)
       return "E:all:Processing error"
+    finally:
+      database.end_identity_map()
+
+  def checkAccess(self, actions):
+    # All the actions in a request normally come from one user, so the
+    # access checks are done together, once per handle, rather than going
+    # back to the database for every file.
+    names = {}
+    for action in actions:
+      if action.mode != "close":
+        names.setdefault(action.handle, set()).add(action.filename)
+    access_levels = {}
+    for handle, filenames in names.iteritems():
+      for filename, access in check_access_many(self.persister, filenames, handle).iteritems():
+        access_levels[(handle, filename)] = access
+    return access_levels
 
   def doActions(self, actions):
     output = []
     last_username = None
     last_filename = None
 
-    for action_index in xrange(len(actions)):
-      action = actions[action_index]
-      mobwrite_core.LOG.debug("action %s = %s", action_index, action)
+    if mobwrite_core.LOG.isEnabledFor(logging.DEBUG):
+      for action_index in xrange(len(actions)):
+        mobwrite_core.LOG.debug("action %s = %s", action_index, actions[action_index])
+
+    access_levels = self.checkAccess(actions)
 
     for action_index in xrange(len(actions)):
       # Use an indexed loop in order to peek ahead one step to detect
@@ -468,15 +905,15 @@ class DaemonMobWrite(mobwrite_core.MobWrite):
 
       # Close mode doesn't need a filename or handle for the 'close all' case
       # If killing a specific view, then the id is in the 'data'
-      if action["mode"] == "close":
-        to_close = action.get("data")
+      if action.mode == "close":
+        to_close = action.to_close
         if to_close == "all":
-          kill_views_for_user(action["username"])
+          kill_views_for_user(action.username)
         elif to_close is not None:
-          kill_view(action["username"], to_close)
+          kill_view(action.username, to_close)
         continue
 
-      viewobj = fetch_viewobj(action["username"], action["filename"], handle=action["handle"], metadata=action["metadata"], persister=self.persister)
+      viewobj = fetch_viewobj(action.username, action.filename, handle=action.handle, metadata=action.metadata, persister=self.persister)
       if viewobj is None:
         # Too many views connected at once.
         # Send back nothing.  Pretend the return packet was lost.
@@ -484,21 +921,23 @@ class DaemonMobWrite(mobwrite_core.MobWrite):
 
       delta_ok = True
       mobwrite_core.LOG.debug("view.lock.acquire on %s@%s", viewobj.username, viewobj.filename)
+      start = time.time()
       viewobj.lock.acquire()
+      metrics.observe("view_lock_wait", time.time() - start)
       textobj = viewobj.textobj
 
       try:
-        access = self.persister.check_access(action["filename"], action["handle"])
+        access = access_levels.get((action.handle, action.filename), Access.Denied)
         if access == Access.Denied:
-          name = get_username_from_handle(action["handle"])
-          message = "%s does not have access to %s" % (name, action["filename"])
+          name = get_username_from_handle(action.handle)
+          message = "%s does not have access to %s" % (name, action.filename)
           mobwrite_core.LOG.warning(message)
-          output.append("E:" + action["filename"] + ":" + message + "\n")
+          output.append("E:" + action.filename + ":" + message + "\n")
           continue
 
-        if action["mode"] == "null":
+        if action.mode == "null":
           if access == Access.ReadOnly:
-            output.append("O:" + action["filename"] + "\n")
+            output.append("O:" + action.filename + "\n")
           else:
             # Nullify the text.
             mobwrite_core.LOG.debug("Nullifying: '%s@%s'" %
@@ -513,40 +952,38 @@ class DaemonMobWrite(mobwrite_core.MobWrite):
             viewobj.nullify()
           continue
 
-        if (action["server_version"] != viewobj.shadow_server_version and
-            action["server_version"] == viewobj.backup_shadow_server_version):
+        if (action.server_version != viewobj.shadow_server_version and
+            action.server_version == viewobj.backup_shadow_server_version):
           # Client did not receive the last response.  Roll back the shadow.
           mobwrite_core.LOG.warning("Rollback from shadow %d to backup shadow %d" %
               (viewobj.shadow_server_version, viewobj.backup_shadow_server_version))
+          metrics.count("rollbacks")
           viewobj.shadow = viewobj.backup_shadow
+          viewobj.shadow_text_version = None
           viewobj.shadow_server_version = viewobj.backup_shadow_server_version
-          viewobj.edit_stack = []
+          viewobj.edit_stack.clear()
 
         # Remove any elements from the edit stack with low version numbers which
         # have been acked by the client.
-        x = 0
-        while x < len(viewobj.edit_stack):
-          if viewobj.edit_stack[x][0] <= action["server_version"]:
-            del viewobj.edit_stack[x]
-          else:
-            x += 1
+        viewobj.edit_stack.acknowledge(action.server_version)
 
-        if action["mode"] == "raw":
+        if action.mode == "raw":
           # It's a raw text dump.
-          data = urllib.unquote(action["data"]).decode("utf-8")
+          data = urllib.unquote(action.data).decode("utf-8")
           mobwrite_core.LOG.info("Got %db raw text: '%s@%s'" %
               (len(data), viewobj.username, viewobj.filename))
           delta_ok = True
           # First, update the client's shadow.
           viewobj.shadow = data
-          viewobj.shadow_client_version = action["client_version"]
-          viewobj.shadow_server_version = action["server_version"]
+          viewobj.shadow_text_version = None
+          viewobj.shadow_client_version = action.client_version
+          viewobj.shadow_server_version = action.server_version
           viewobj.backup_shadow = viewobj.shadow
           viewobj.backup_shadow_server_version = viewobj.shadow_server_version
-          viewobj.edit_stack = []
+          viewobj.edit_stack.clear()
           if access == Access.ReadOnly:
-            output.append("O:" + action["filename"] + "\n")
-          elif action["force"] or textobj.text == None:
+            output.append("O:" + action.filename + "\n")
+          elif action.force or textobj.text == None:
             # Clobber the server's text.
             mobwrite_core.LOG.debug("text.lock.acquire on %s", textobj.name)
             textobj.lock.acquire()
@@ -559,46 +996,53 @@ class DaemonMobWrite(mobwrite_core.MobWrite):
               mobwrite_core.LOG.debug("text.lock.release on %s", textobj.name)
               textobj.lock.release()
 
-        elif action["mode"] == "delta":
+        elif action.mode == "delta":
           # It's a delta.
           mobwrite_core.LOG.debug("Got delta: %s@%s",
               viewobj.username, viewobj.filename)
           # mobwrite_core.LOG.debug("Got '%s' delta: '%s@%s'" %
-          #     (action["data"], viewobj.username, viewobj.filename))
-          if action["server_version"] != viewobj.shadow_server_version:
+          #     (action.data, viewobj.username, viewobj.filename))
+          if action.server_version != viewobj.shadow_server_version:
             # Can't apply a delta on a mismatched shadow version.
             delta_ok = False
             mobwrite_core.LOG.warning("Shadow version mismatch: %d != %d" %
-                (action["server_version"], viewobj.shadow_server_version))
-          elif action["client_version"] > viewobj.shadow_client_version:
+                (action.server_version, viewobj.shadow_server_version))
+            metrics.count("version_mismatches")
+          elif action.client_version > viewobj.shadow_client_version:
             # Client has a version in the future?
             delta_ok = False
             mobwrite_core.LOG.warning("Future delta: %d > %d" %
-                (action["client_version"], viewobj.shadow_client_version))
-          elif action["client_version"] < viewobj.shadow_client_version:
+                (action.client_version, viewobj.shadow_client_version))
+            metrics.count("version_mismatches")
+          elif action.client_version < viewobj.shadow_client_version:
             # We've already seen this diff.
             pass
             mobwrite_core.LOG.warning("Repeated delta: %d < %d" %
-                (action["client_version"], viewobj.shadow_client_version))
+                (action.client_version, viewobj.shadow_client_version))
           else:
             # Expand the delta into a diff using the client shadow.
             try:
-              diffs = mobwrite_core.DMP.diff_fromDelta(viewobj.shadow, action["data"])
+              diffs = mobwrite_core.DMP.diff_fromDelta(viewobj.shadow, action.data)
             except ValueError:
               diffs = None
               delta_ok = False
               mobwrite_core.LOG.warning("Delta failure, expected %d length: '%s@%s'" %
                   (len(viewobj.shadow), viewobj.username, viewobj.filename))
+              metrics.count("delta_failures")
             viewobj.shadow_client_version += 1
             if diffs != None:
               if access == Access.ReadOnly:
-                output.append("O:" + action["filename"] + "\n")
+                output.append("O:" + action.filename + "\n")
               else:
                 # Textobj lock required for read/patch/write cycle.
                 mobwrite_core.LOG.debug("text.lock.acquire on %s", textobj.name)
+                start = time.time()
                 textobj.lock.acquire()
+                patch_start = time.time()
+                metrics.observe("text_lock_wait", patch_start - start)
                 try:
                   self.applyPatches(viewobj, diffs, action)
+                  metrics.observe("patch", time.time() - patch_start)
                 finally:
                   mobwrite_core.LOG.debug("text.lock.release on %s", textobj.name)
                   textobj.lock.release()
@@ -606,12 +1050,12 @@ class DaemonMobWrite(mobwrite_core.MobWrite):
         # Generate output if this is the last action or the username/filename
         # will change in the next iteration.
         if ((action_index + 1 == len(actions)) or
-            actions[action_index + 1]["username"] != viewobj.username or
-            actions[action_index + 1]["filename"] != viewobj.filename):
+            actions[action_index + 1].username != viewobj.username or
+            actions[action_index + 1].filename != viewobj.filename):
           echo_collaborators = "echo_collaborators" in action
           output.append(self.generateDiffs(viewobj,
                                            last_username, last_filename,
-                                           action["echo_username"], action["force"],
+                                           action.echo_username, action.force,
                                            delta_ok, echo_collaborators))
           last_username = viewobj.username
           last_filename = viewobj.filename
@@ -625,6 +1069,35 @@ class DaemonMobWrite(mobwrite_core.MobWrite):
     return answer
 
 
+  def computeDelta(self, viewobj, textobj, mastertext, text_version):
+    # Return the delta from the view's shadow to mastertext, which is
+    # version text_version of the text.
+    shadow_version = viewobj.shadow_text_version
+    if shadow_version == text_version:
+      # The text hasn't changed since the shadow was taken.
+      if mastertext:
+        return "=%d" % len(mastertext)
+      return ""
+    if shadow_version is not None:
+      # Every view with a shadow of the same version needs the same delta.
+      text = textobj.cached_delta(shadow_version, text_version)
+      if text is not None:
+        return text
+    # Create the diff between the view's text and the master text.
+    start = time.time()
+    diffs = mobwrite_core.DMP.diff_main(viewobj.shadow, mastertext)
+    mobwrite_core.DMP.diff_cleanupEfficiency(diffs)
+    text = mobwrite_core.DMP.diff_toDelta(diffs)
+    metrics.observe("diff", time.time() - start)
+    if shadow_version is not None:
+      textobj.lock.acquire()
+      try:
+        textobj.cache_delta(shadow_version, text_version, text)
+      finally:
+        textobj.lock.release()
+    return text
+
+
   def generateDiffs(self, viewobj, last_username, last_filename,
                     echo_username, force, delta_ok, echo_collaborators):
     output = []
@@ -635,27 +1108,41 @@ class DaemonMobWrite(mobwrite_core.MobWrite):
           (viewobj.shadow_client_version, viewobj.filename))
 
     textobj = viewobj.textobj
-    mastertext = textobj.text
-
-    if delta_ok:
+    # Read the text and its version together.
+    textobj.lock.acquire()
+    try:
+      mastertext = textobj.text
+      text_version = textobj.version
+    finally:
+      textobj.lock.release()
+
+    # Mozilla: A client that doesn't acknowledge its edits would get an ever
+    # longer response.  Past c.mobwrite_edit_stack_budget bytes, send it the
+    # whole text once instead, without diffing.
+    budget = config.c.mobwrite_edit_stack_budget
+    resync = delta_ok and budget and viewobj.edit_stack.bytes > budget
+    if resync:
+      mobwrite_core.LOG.info("Edit stack over budget, %d bytes: '%s@%s'" %
+          (viewobj.edit_stack.bytes, viewobj.username, viewobj.filename))
+      metrics.count("edit_stack_resyncs")
+      viewobj.edit_stack.clear()
+
+    if delta_ok and not resync:
       if mastertext is None:
         mastertext = ""
-      # Create the diff between the view's text and the master text.
-      diffs = mobwrite_core.DMP.diff_main(viewobj.shadow, mastertext)
-      mobwrite_core.DMP.diff_cleanupEfficiency(diffs)
-      text = mobwrite_core.DMP.diff_toDelta(diffs)
+      text = self.computeDelta(viewobj, textobj, mastertext, text_version)
       if force:
         # Client sending 'D' means number, no error.
         # Client sending 'R' means number, client error.
         # Both cases involve numbers, so send back an overwrite delta.
-        viewobj.edit_stack.append((viewobj.shadow_server_version,
-            "D:%d:%s\n" % (viewobj.shadow_server_version, text)))
+        viewobj.edit_stack.push(viewobj.shadow_server_version,
+            "D:%d:%s\n" % (viewobj.shadow_server_version, text))
       else:
         # Client sending 'd' means text, no error.
         # Client sending 'r' means text, client error.
         # Both cases involve text, so send back a merge delta.
-        viewobj.edit_stack.append((viewobj.shadow_server_version,
-            "d:%d:%s\n" % (viewobj.shadow_server_version, text)))
+        viewobj.edit_stack.push(viewobj.shadow_server_version,
+            "d:%d:%s\n" % (viewobj.shadow_server_version, text))
       viewobj.shadow_server_version += 1
       mobwrite_core.LOG.debug("Sent delta for %s@%s",
           viewobj.username, viewobj.filename)
@@ -664,11 +1151,12 @@ class DaemonMobWrite(mobwrite_core.MobWrite):
     else:
       # Error; server could not parse client's delta.
       # Send a raw dump of the text.
-      viewobj.shadow_client_version += 1
+      if not resync:
+        viewobj.shadow_client_version += 1
       if mastertext is None:
         mastertext = ""
-        viewobj.edit_stack.append((viewobj.shadow_server_version,
-            "r:%d:\n" % viewobj.shadow_server_version))
+        viewobj.edit_stack.push(viewobj.shadow_server_version,
+            "r:%d:\n" % viewobj.shadow_server_version)
         mobwrite_core.LOG.info("Sent empty raw text: '%s@%s'" %
             (viewobj.username, viewobj.filename))
       else:
@@ -676,12 +1164,13 @@ class DaemonMobWrite(mobwrite_core.MobWrite):
         text = mastertext
         text = text.encode("utf-8")
         text = urllib.quote(text, "!~*'();/?:@&=+$,# ")
-        viewobj.edit_stack.append((viewobj.shadow_server_version,
-            "R:%d:%s\n" % (viewobj.shadow_server_version, text)))
+        viewobj.edit_stack.push(viewobj.shadow_server_version,
+            "R:%d:%s\n" % (viewobj.shadow_server_version, text))
         mobwrite_core.LOG.info("Sent %db raw text: '%s@%s'" %
             (len(text), viewobj.username, viewobj.filename))
 
     viewobj.shadow = mastertext
+    viewobj.shadow_text_version = text_version
 
     for edit in viewobj.edit_stack:
       output.append(edit[1])
@@ -697,69 +1186,16 @@ class DaemonMobWrite(mobwrite_core.MobWrite):
     return "".join(output)
 
 
+class ThreadingServerDaemonMobWrite(SocketServer.ThreadingTCPServer):
+  # A restarted server must be able to listen again straight away.
+  allow_reuse_address = True
+
+
 class StreamRequestHandlerDaemonMobWrite(SocketServer.StreamRequestHandler, DaemonMobWrite):
   def __init__(self, a, b, c):
     DaemonMobWrite.__init__(self)
     SocketServer.StreamRequestHandler.__init__(self, a, b, c)
 
-  def feedBuffer(self, name, size, index, datum):
-    """Add one block of text to the buffer and return the whole text if the
-      buffer is complete.
-
-    Args:
-      name: Unique name of buffer object.
-      size: Total number of slots in the buffer.
-      index: Which slot to insert this text (note that index is 1-based)
-      datum: The text to insert.
-
-    Returns:
-      String with all the text blocks merged in the correct order.  Or if the
-      buffer is not yet complete returns the empty string.
-    """
-    # Note that 'index' is 1-based.
-    if not 0 < index <= size:
-      mobwrite_core.LOG.error("Invalid buffer: '%s %d %d'" % (name, size, index))
-      text = ""
-    elif size == 1 and index == 1:
-      # A buffer with one slot?  Pointless.
-      text = datum
-      mobwrite_core.LOG.debug("Buffer with only one slot: '%s'" % name)
-    else:
-      # Retrieve the named buffer object.  Create it if it doesn't exist.
-      name += "_%d" % size
-      # Don't let two simultaneous creations happen, or a deletion during a
-      # retrieval.
-      mobwrite_core.LOG.debug("lock_buffers.acquire")
-      lock_buffers.acquire()
-      try:
-        if buffers.has_key(name):
-          bufferobj = buffers[name]
-          bufferobj.lasttime = datetime.datetime.now()
-          mobwrite_core.LOG.debug("Found buffer: '%s'" % name)
-        else:
-          bufferobj = BufferObj(name, size)
-          mobwrite_core.LOG.debug("Creating buffer: '%s'" % name)
-        mobwrite_core.LOG.debug("buffer.lock.acquire on ??")
-        bufferobj.lock.acquire()
-        try:
-          bufferobj.set(index, datum)
-          # Check if Buffer is complete.
-          text = bufferobj.get()
-        finally:
-          mobwrite_core.LOG.debug("buffer.lock.release on ??")
-          bufferobj.lock.release()
-      finally:
-        # Mozilla: This unlock used to come straight after the call to
-        # bufferobj.lock.acquire() above.
-        # We believe that the order lock-a, lock-b, unlock-a, unlock-b is
-        # prone to deadlocks so we've moved 'unlock-a' to here
-        mobwrite_core.LOG.debug("lock_buffers.release")
-        lock_buffers.release()
-      if text == None:
-        text = ""
-    return urllib.unquote(text)
-
-
   def handle(self):
     self.connection.settimeout(TIMEOUT_TELNET)
     if CONNECTION_ORIGIN and self.client_address[0] != CONNECTION_ORIGIN:
@@ -767,31 +1203,51 @@ class StreamRequestHandlerDaemonMobWrite(SocketServer.StreamRequestHandler, Daem
     #mobwrite_core.LOG.info("Connection accepted from " + self.client_address[0])
 
     data = []
+    keepalive = False
     # Read in all the lines.
     while 1:
       try:
         line = self.rfile.readline()
       except:
         # Timeout.
-        mobwrite_core.LOG.warning("Timeout on connection")
+        if not keepalive:
+          mobwrite_core.LOG.warning("Timeout on connection")
         break
+      if keepalive and not line:
+        # The client closed a kept-alive connection.
+        break
+      if not data and not keepalive and \
+          line.rstrip("\r\n") == transport.KEEPALIVE_LINE:
+        # Answer any number of questions on this connection, each answer
+        # prefixed by its length.
+        keepalive = True
+        self.connection.settimeout(TIMEOUT_KEEPALIVE)
+        continue
       data.append(line)
       if not line.rstrip("\r\n"):
         # Terminate and execute on blank line.
         question = "".join(data)
-        answer = self.handleRequest(question)
-        self.wfile.write(answer)
-        break
+        try:
+          answer = self.handleRequest(question)
+        finally:
+          # A kept-alive connection keeps this thread for many requests.
+          release_session()
+        if not keepalive:
+          self.wfile.write(answer)
+          break
+        answer = str(answer)
+        self.wfile.write("%d\n%s" % (len(answer), answer))
+        self.wfile.flush()
+        data = []
 
     # Goodbye
     mobwrite_core.LOG.debug("Disconnecting.")
 
 
 def kill_views_for_user(username):
-  for view in views.values():
-    if view.username == username:
-      mobwrite_core.LOG.info("kill_views_for_user on %s, %s" % (username, view.filename))
-      view.nullify()
+  for view in views_for_user(username):
+    mobwrite_core.LOG.info("kill_views_for_user on %s, %s" % (username, view.filename))
+    view.nullify()
 
 def kill_view(username, filename):
   view = fetch_viewobj(username, filename)
@@ -801,9 +1257,6 @@ def kill_view(username, filename):
 
 def cleanup_thread():
   # Every minute cleanup
-  if STORAGE_MODE == BDB:
-    import bsddb
-
   while True:
     cleanup()
     time.sleep(60)
@@ -826,45 +1279,291 @@ def debugServer():
 # Left at double initial indent to help diff
 def cleanup():
     mobwrite_core.LOG.info("Running cleanup task.")
-    for view in views.values():
-      view.cleanup()
-    for text in texts.values():
-      text.cleanup()
-    for buffer in buffers.values():
-      buffer.cleanup()
-
-    # Persist the remaining texts
-    for text in texts.values():
+    # Only the views, texts and buffers that are due are looked at.
+    now = datetime.datetime.now()
+    view_queue.expire(now)
+    text_queue.expire(now)
+    buffer_queue.expire(now)
+
+    # Persist the remaining changed texts
+    for text in take_changed():
+      if texts.get(text.name) is not text:
+        # Unloading saved it.
+        continue
       mobwrite_core.LOG.debug("text.lock.acquire on %s", text.name)
       text.lock.acquire()
       try:
-        text.save()
+        if text.changed:
+          text.save()
       finally:
         mobwrite_core.LOG.debug("text.lock.release on %s", text.name)
         text.lock.release()
 
-    timeout = datetime.datetime.now() - mobwrite_core.TIMEOUT_TEXT
-    if STORAGE_MODE == FILE:
-      # Delete old files.
-      files = glob.glob("%s/*.txt" % DATA_DIR)
-      for filename in files:
-        if datetime.datetime.fromtimestamp(os.path.getmtime(filename)) < timeout:
-          os.unlink(filename)
-          mobwrite_core.LOG.info("Deleted file: '%s'" % filename)
-
-    if STORAGE_MODE == BDB:
-      # Delete old DB records.
-      # Can't delete an entry in a hash while iterating or else order is lost.
-      expired = []
-      for k, v in lasttime_db.iteritems():
-        if datetime.datetime.fromtimestamp(int(v)) < timeout:
-          expired.append(k)
-      for k in expired:
-        if texts_db.has_key(k):
-          del texts_db[k]
-        if lasttime_db.has_key(k):
-          del lasttime_db[k]
-        mobwrite_core.LOG.info("Deleted from DB: '%s'" % k)
+    # Have the edits to documents that have been left alone for a while
+    # merged into the real files.
+    schedule_merges = getattr(persister, "schedule_merges", None)
+    if schedule_merges is not None and config.c.mobwrite_merge_idle:
+      schedule_merges(config.c.mobwrite_merge_idle)
+
+    # Let the persister drop the texts that nobody has saved for a while.
+    expire = getattr(persister, "expire", None)
+    if expire is not None:
+      expired = expire(time.time() - config.c.mobwrite_storage_expiry)
+      if expired:
+        mobwrite_core.LOG.info("Expired %d stored texts." % expired)
+
+    # Remove the journals of documents that have not been opened again.
+    if get_journal() and config.c.mobwrite_journal_expiry:
+      expired = journal.expire(time.time() - config.c.mobwrite_journal_expiry)
+      if expired:
+        mobwrite_core.LOG.info("Expired %d journals." % expired)
+
+def memory_usage():
+  # Measure the memory held for each document, as a dictionary of text name
+  # to the bytes held by the text and all of its views.
+  usage = {}
+  for textobj in texts.values():
+    usage[textobj.name] = usage.get(textobj.name, 0) + textobj.memory_size()
+  for viewobj in views.values():
+    name = viewobj.textobj.name
+    usage[name] = usage.get(name, 0) + viewobj.memory_size()
+  return usage
+
+
+def govern_memory():
+  # Unload the least recently used idle documents until no more than
+  # c.mobwrite_memory_budget bytes are held, and publish the memory gauges.
+  # Returns the number of documents unloaded.
+  usage = memory_usage()
+  total = sum(usage.values())
+  budget = config.c.mobwrite_memory_budget
+  unloaded = 0
+  if budget and total > budget:
+    idle_since = datetime.datetime.now() - datetime.timedelta(
+        seconds=config.c.mobwrite_memory_min_idle)
+    candidates = []
+    for textobj in texts.values():
+      lasttime = max([viewobj.lasttime for viewobj in textobj.views] +
+                     [textobj.lasttime])
+      if lasttime < idle_since:
+        candidates.append((lasttime, textobj))
+    candidates.sort()
+    for (lasttime, textobj) in candidates:
+      if total <= budget:
+        break
+      if unload_text(textobj, idle_since):
+        total -= usage.get(textobj.name, 0)
+        unloaded += 1
+    if total > budget:
+      mobwrite_core.LOG.warning("Over memory budget: %d of %d bytes held, "
+                                "nothing idle left to unload" % (total, budget))
+
+  stats = config.c.stats
+  stats.set("mobwrite_texts", len(texts))
+  stats.set("mobwrite_views", len(views))
+  stats.set("mobwrite_memory_bytes", total)
+  stats.set("mobwrite_buffers", len(buffers))
+  stats.set("mobwrite_buffer_bytes", buffer_bytes)
+  if unloaded:
+    mobwrite_core.LOG.info("Unloaded %d idle documents, %d bytes held" %
+                           (unloaded, total))
+    stats.incr("mobwrite_unloaded_DATE", unloaded)
+  return unloaded
+
+
+def unload_text(textobj, idle_since):
+  # Save a document and drop it and its views from memory, unless one of the
+  # views has been used since idle_since.  Returns True if it was dropped.
+  for viewobj in list(textobj.views):
+    stripe = view_lock(viewobj.username, viewobj.filename)
+    stripe.acquire()
+    try:
+      # A request may have fetched the view since the candidates were
+      # picked, or still be working on it.
+      if viewobj.lasttime >= idle_since or viewobj.lock.locked():
+        return False
+      viewobj.remove()
+    finally:
+      stripe.release()
+  textobj.cleanup()
+  return texts.get(textobj.name) is not textobj
+
+
+def metrics_snapshot():
+  # Everything the daemon measures, for the stats page of the web server.
+  result = metrics.snapshot()
+  result["texts"] = len(texts)
+  result["views"] = len(views)
+  result["buffers"] = len(buffers)
+  result["buffer_bytes"] = buffer_bytes
+  result["memory_bytes"] = sum(memory_usage().values())
+  return result
+
+
+# Counter values as of the last publish_metrics().
+published_counters = {}
+
+def publish_metrics():
+  # Push the counters and timings through bespin.stats: counters are added
+  # to daily totals, mobwrite_<name>_DATE, and each timing sets its
+  # mobwrite_<name>_count, _p50_ms and _p99_ms gauges.
+  snapshot = metrics.snapshot()
+  stats = config.c.stats
+  for name, value in snapshot["counters"].items():
+    change = value - published_counters.get(name, 0)
+    if change:
+      stats.incr("mobwrite_%s_DATE" % name, change)
+      published_counters[name] = value
+  for name, timing in snapshot["timings"].items():
+    stats.set("mobwrite_%s_count" % name, timing["count"])
+    stats.set("mobwrite_%s_p50_ms" % name, timing["p50_ms"])
+    stats.set("mobwrite_%s_p99_ms" % name, timing["p99_ms"])
+
+
+def memory_thread():
+  while True:
+    time.sleep(MEMORY_CHECK_INTERVAL)
+    try:
+      govern_memory()
+      publish_metrics()
+    except:
+      mobwrite_core.LOG.exception("Memory governor failed")
+
+
+# Version of the files written by save_state.
+STATE_FORMAT = 1
+
+def state_file(port):
+  # Where the server on port keeps its state between restarts, or None if
+  # c.mobwrite_state_dir is not set.
+  if not config.c.mobwrite_state_dir:
+    return None
+  return os.path.join(config.c.mobwrite_state_dir, "state-%d.pickle" % port)
+
+
+def save_state(path):
+  # Write the texts that have views, and the views with their shadows and
+  # edit stacks, to path.  Returns the number of views written.
+  state_texts = {}
+  state_views = []
+  for viewobj in views.values():
+    viewobj.lock.acquire()
+    try:
+      textobj = viewobj.textobj
+      if not textobj.loaded:
+        continue
+      text = textobj.text
+      if textobj.name not in state_texts:
+        state_texts[textobj.name] = (textobj.name, textobj.handle, text,
+                                     textobj.version, textobj.changed)
+      # A shadow that is the text is written once, with the text, and
+      # stands as None.
+      shadow = viewobj.shadow
+      if shadow is text:
+        shadow = None
+      backup_shadow = viewobj.backup_shadow
+      if backup_shadow is text:
+        backup_shadow = None
+      state_views.append((viewobj.username, viewobj.filename, viewobj.handle,
+          viewobj.metadata, shadow, backup_shadow,
+          viewobj.shadow_client_version, viewobj.shadow_server_version,
+          viewobj.backup_shadow_server_version, viewobj.shadow_text_version,
+          list(viewobj.edit_stack)))
+    finally:
+      viewobj.lock.release()
+  state = dict(format=STATE_FORMAT, texts=state_texts.values(),
+               views=state_views)
+  # Write the whole file before it replaces the old one.
+  outfile = open(path + ".tmp", "wb")
+  try:
+    cPickle.dump(state, outfile, cPickle.HIGHEST_PROTOCOL)
+  finally:
+    outfile.close()
+  os.rename(path + ".tmp", path)
+  mobwrite_core.LOG.info("Saved %d texts and %d views to %s" %
+                         (len(state_texts), len(state_views), path))
+  return len(state_views)
+
+
+def restore_state(path, persister):
+  # Load the texts and views written by save_state, unless they are already
+  # loaded.  The file is removed, so that it is only used once.  Returns
+  # the number of views restored.
+  try:
+    infile = open(path, "rb")
+  except IOError:
+    return 0
+  try:
+    try:
+      state = cPickle.load(infile)
+    except Exception:
+      mobwrite_core.LOG.exception("Can't read state from %s" % path)
+      return 0
+  finally:
+    infile.close()
+    os.remove(path)
+  if state.get("format") != STATE_FORMAT:
+    mobwrite_core.LOG.warning("Ignoring state of format %s in %s" %
+                              (state.get("format"), path))
+    return 0
+
+  text_values = {}
+  for (name, handle, text, version, changed) in state["texts"]:
+    stripe = text_lock(name)
+    stripe.acquire()
+    try:
+      if name in texts:
+        continue
+      textobj = TextObj(name=name, persister=persister, handle=handle)
+      textobj.text = text
+      textobj.version = version
+      textobj.changed = changed
+      textobj.loaded = True
+      if changed:
+        mark_changed(textobj)
+      text_values[name] = text
+    finally:
+      stripe.release()
+
+  restored = 0
+  for (username, filename, handle, metadata, shadow, backup_shadow,
+       shadow_client_version, shadow_server_version,
+       backup_shadow_server_version, shadow_text_version,
+       edits) in state["views"]:
+    if filename not in text_values:
+      continue
+    text = text_values[filename]
+    if shadow is None:
+      shadow = text
+    if backup_shadow is None:
+      backup_shadow = text
+    key = (username, filename)
+    stripe = view_lock(username, filename)
+    stripe.acquire()
+    try:
+      if key in views:
+        continue
+      viewobj = ViewObj(username=username, filename=filename, handle=handle,
+          metadata=metadata, persister=persister,
+          shadow=shadow, backup_shadow=backup_shadow,
+          shadow_client_version=shadow_client_version,
+          shadow_server_version=shadow_server_version,
+          backup_shadow_server_version=backup_shadow_server_version)
+      viewobj.shadow_text_version = shadow_text_version
+      for (version, edit) in edits:
+        viewobj.edit_stack.push(version, edit)
+      restored += 1
+    finally:
+      stripe.release()
+  mobwrite_core.LOG.info("Restored %d texts and %d views from %s" %
+                         (len(text_values), restored, path))
+  return restored
+
+
+def stop_on_signal(signum, frame):
+  # Stop the server as if Ctrl-C had been pressed.
+  raise KeyboardInterrupt("Signal %d" % signum)
+
 
 last_cleanup = time.time()
 
@@ -878,26 +1577,41 @@ def maybe_cleanup():
     last_cleanup = now
 
 
-def main():
-  if STORAGE_MODE == BDB:
-    import bsddb
-    global texts_db, lasttime_db
-    texts_db = bsddb.hashopen(DATA_DIR + "/texts.db")
-    lasttime_db = bsddb.hashopen(DATA_DIR + "/lasttime.db")
+def main(port=LOCAL_PORT):
+  mobwrite_core.LOG.info("Listening on port %d..." % port)
+  if config.c.mobwrite_server_mode == "async":
+    # One thread for all the connections; see mobwrite_async.
+    from bespin.mobwrite.mobwrite_async import AsyncServer
+    s = AsyncServer(("", port), workers=config.c.mobwrite_async_workers,
+                    max_pending=config.c.mobwrite_async_max_pending)
+  else:
+    s = ThreadingServerDaemonMobWrite(("", port), StreamRequestHandlerDaemonMobWrite)
+
+  # Pick up where the last server on this port left off.  This is only done
+  # once the port is ours, as the state file is used up.
+  saved_state = state_file(port)
+  if saved_state:
+    restore_state(saved_state, get_persister())
 
   # Start up a thread that does timeouts and cleanup
   thread.start_new_thread(cleanup_thread, ())
+  # and one that keeps memory use within budget
+  thread.start_new_thread(memory_thread, ())
 
-  mobwrite_core.LOG.info("Listening on port %d..." % LOCAL_PORT)
-  s = SocketServer.ThreadingTCPServer(("", LOCAL_PORT), StreamRequestHandlerDaemonMobWrite)
+  signal.signal(signal.SIGTERM, stop_on_signal)
   try:
     s.serve_forever()
   except KeyboardInterrupt:
     mobwrite_core.LOG.info("Shutting down.")
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
     s.socket.close()
-    if STORAGE_MODE == BDB:
-      texts_db.close()
-      lasttime_db.close()
+    if saved_state:
+      save_state(saved_state)
+    if isinstance(persister, WriteBehindPersister):
+      persister.stop()
+    close = getattr(persister, "close", None)
+    if close is not None:
+      close()
 
 
 from bespin import config
@@ -920,5 +1634,41 @@ def process_mobwrite(args=None):
   config.activate_profile()
 
   mobwrite_core.logging.basicConfig()
-  main()
+  if args:
+    # Run as one (or, given "all", every local) shard of
+    # c.mobwrite_shards.
+    main_shards(args.pop(0))
+  else:
+    main()
   mobwrite_core.logging.shutdown()
+
+def main_shards(which):
+  shards = config.c.mobwrite_shards
+  if which != "all":
+    main(shards[int(which)][1])
+    return
+
+  local_ports = [port for host, port in shards
+                 if host in ("localhost", "127.0.0.1", socket.gethostname())]
+  children = []
+  for port in local_ports:
+    pid = os.fork()
+    if pid == 0:
+      try:
+        main(port)
+      finally:
+        os._exit(0)
+    children.append(pid)
+  signal.signal(signal.SIGTERM, stop_on_signal)
+  try:
+    for pid in children:
+      os.waitpid(pid, 0)
+  except KeyboardInterrupt:
+    mobwrite_core.LOG.info("Shutting down shards.")
+    # Let every shard save its state before it goes.
+    for pid in children:
+      try:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+      except OSError:
+        pass
@@ -35,21 +35,31 @@
 # ***** END LICENSE BLOCK *****
 
 import sys
+import thread
 import logging
 
+import simplejson
 from paste.httpserver import serve
 from webob import Request, Response
 
-from bespin.mobwrite.mobwrite_daemon import DaemonMobWrite
+from bespin.mobwrite.mobwrite_daemon import DaemonMobWrite, metrics_snapshot, \
+    memory_thread
 from bespin import config
 from bespin.controllers import db_middleware
 
 log = logging.getLogger("mw_web")
 
 class WSGIMobWrite(DaemonMobWrite):
+    # GET this path for the daemon's collaboration metrics as JSON
+    stats_path = "/stats"
+
     def __call__(self, environ, start_response):
         request = Request(environ)
         response = Response()
+        if request.method == "GET" and request.path_info == self.stats_path:
+            response.body = simplejson.dumps(metrics_snapshot())
+            response.content_type = "application/json"
+            return response(environ, start_response)
         try:
             answer = self.handleRequest(request.body)
             response.body = answer
@@ -83,4 +93,9 @@ def start_server(args=None):
     app = WSGIMobWrite()
     app = db_middleware(app)
 
-    serve(app, config.c.mobwrite_server_address, config.c.mobwrite_server_port, use_threadpool=True)
+    # publishes the gauges and metrics through bespin.stats
+    thread.start_new_thread(memory_thread, ())
+
+    # HTTP/1.1 so that the web nodes can keep their connections open
+    serve(app, config.c.mobwrite_server_address, config.c.mobwrite_server_port,
+          use_threadpool=True, protocol_version="HTTP/1.1")
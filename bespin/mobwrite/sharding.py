@@ -0,0 +1,226 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""Spreads mobwrite documents over several daemon processes.
+
+Each daemon (a shard) owns the documents whose names hash to it on a
+consistent hash ring, so adding a shard only moves a small share of the
+documents. The web tier splits every mobwrite request into one request
+per shard, with each file block going to the shard that owns the file,
+and joins the answers.
+
+Fragmented requests (b: lines) are put back together here before they
+are split up, so when there is more than one web node, all of the
+fragments of one request need to reach the same node.
+"""
+
+import bisect
+import datetime
+import threading
+import urllib
+from hashlib import md5
+import logging
+
+log = logging.getLogger("mobwrite.sharding")
+
+# Incomplete fragmented requests are dropped after this long.
+TIMEOUT_BUFFER = datetime.timedelta(minutes=15)
+
+class HashRing(object):
+    """Maps keys onto nodes. Every node is placed on the ring
+    replicas times so that keys are spread evenly."""
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(nodes)
+        ring = []
+        for node in self.nodes:
+            for i in xrange(replicas):
+                ring.append((self._hash("%s-%s" % (node, i)), node))
+        ring.sort()
+        self.points = [point for point, node in ring]
+        self.ring_nodes = [node for point, node in ring]
+
+    def _hash(self, key):
+        return long(md5(key).hexdigest()[:16], 16)
+
+    def get_node(self, key):
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        index = bisect.bisect(self.points, self._hash(key))
+        if index == len(self.points):
+            index = 0
+        return self.ring_nodes[index]
+
+class BufferStore(object):
+    """Puts the fragments sent in b: lines back together."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffers = {}
+
+    def feed(self, name, size, index, datum):
+        """Stores a fragment and returns the whole text once all of the
+        fragments have arrived, otherwise None. index is 1-based."""
+        if not 0 < index <= size:
+            log.error("Invalid buffer: '%s %d %d'", name, size, index)
+            return None
+        if size == 1:
+            return urllib.unquote(datum)
+        key = (name, size)
+        now = datetime.datetime.now()
+        self.lock.acquire()
+        try:
+            for old_key, (slots, lasttime) in self.buffers.items():
+                if lasttime < now - TIMEOUT_BUFFER:
+                    del self.buffers[old_key]
+            slots = self.buffers.get(key, (None, None))[0]
+            if slots is None:
+                slots = [None] * size
+            slots[index - 1] = datum
+            if None in slots:
+                self.buffers[key] = (slots, now)
+                return None
+            self.buffers.pop(key, None)
+        finally:
+            self.lock.release()
+        return urllib.unquote("".join(slots))
+
+class ShardRouter(object):
+    """Sends each part of a mobwrite request to the shard that owns it.
+
+    shards is a list of connection pools (see bespin.mobwrite.transport),
+    one for each daemon, in the same order on every web node."""
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.ring = HashRing(range(len(shards)))
+        self.buffers = BufferStore()
+
+    def shard_for(self, filename):
+        return self.ring.get_node(filename)
+
+    def split(self, question):
+        """Returns a list of (shard, question) pairs. The username, handle
+        and metadata lines in effect are repeated in front of every file
+        block, and closing all of a user's views goes to every shard."""
+        headers = {}
+        parts = {}
+        order = []
+        current = None
+
+        def add(shard, lines):
+            if shard not in parts:
+                parts[shard] = []
+                order.append(shard)
+            parts[shard].extend(headers[key] for key in "hum"
+                                if key in headers)
+            parts[shard].extend(lines)
+            return parts[shard]
+
+        for line in question.splitlines():
+            if not line:
+                break
+            if line.find(":") != 1:
+                continue
+            name, value = line[0], line[2:]
+            lower = name.lower()
+            if lower == "b":
+                try:
+                    buffer_name, size, index, text = value.split(" ", 3)
+                    size = int(size)
+                    index = int(index)
+                except ValueError:
+                    log.warning("Invalid buffer format: %s", value)
+                    continue
+                text = self.buffers.feed(buffer_name, size, index, text)
+                if text:
+                    # a complete buffer is a request of its own
+                    return self.split(text + text[-1])
+            elif lower in "uhm":
+                headers[lower] = line
+                current = None
+            elif lower == "f":
+                filename = value.split(":", 1)[-1]
+                current = add(self.shard_for(filename), [line])
+            elif lower == "n":
+                add(self.shard_for(value), [line])
+                current = None
+            elif name == "x":
+                if value == "all":
+                    for shard in xrange(len(self.shards)):
+                        add(shard, [line])
+                else:
+                    add(self.shard_for(value), [line])
+            elif current is not None:
+                current.append(line)
+
+        return [(shard, "\n".join(parts[shard]) + "\n\n") for shard in order]
+
+    def request(self, question):
+        """Asks every shard involved its part of question at the same
+        time and joins the answers in order. If a shard fails, the error
+        is raised once all of them have finished."""
+        requests = self.split(question)
+        answers = [None] * len(requests)
+        errors = []
+
+        def ask(i):
+            shard, shard_question = requests[i]
+            try:
+                answer = self.shards[shard].request(shard_question)
+            except Exception, e:
+                errors.append(e)
+                return
+            # error answers are not always newline terminated, and
+            # joined without one they would run into the next answer
+            if answer and not answer.endswith("\n"):
+                answer += "\n"
+            answers[i] = answer
+
+        threads = []
+        for i in xrange(1, len(requests)):
+            thread = threading.Thread(target=ask, args=(i,))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        if requests:
+            ask(0)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return "".join(answers)
@@ -0,0 +1,239 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""Where the mobwrite daemon keeps its texts.
+
+A persister has load(name, handle), save(name, contents, handle) and
+check_access(name, handle) methods. It may also have expire(before),
+which drops the texts that have not been saved since before (seconds
+since the epoch) and returns how many went, and close(). Saving None
+removes a text, and loading a text that is not there gives None.
+
+The daemon uses the persister named by c.mobwrite_storage. storages maps
+the names to factories that are called with the config to make one, so
+other stores can be added by putting them in it:
+
+    bespin  - Bespin project temp files (integrate.Persister)
+    sqlite  - a sqlite database at c.mobwrite_storage_file
+    redis   - the redis server at c.redis_host and c.redis_port
+    memory  - a dictionary, for tests and demos
+
+The stores other than bespin keep the texts themselves, but still check
+access against the sharing settings of Bespin projects. Their texts
+expire once they have not been saved for c.mobwrite_storage_expiry
+seconds.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from bespin.mobwrite.integrate import Persister
+
+class Store(object):
+    """Base class for the persisters that keep the texts themselves."""
+
+    def __init__(self):
+        self.access = Persister()
+
+    def check_access(self, name, handle):
+        return self.access.check_access(name, handle)
+
+    def check_access_many(self, names, handle):
+        return self.access.check_access_many(names, handle)
+
+    def close(self):
+        pass
+
+class MemoryStore(Store):
+    """Keeps the texts in a dictionary, which is lost when the daemon
+    stops."""
+
+    def __init__(self):
+        Store.__init__(self)
+        self.lock = threading.Lock()
+        # name -> (contents, time of the last save)
+        self.texts = {}
+
+    def load(self, name, handle):
+        entry = self.texts.get(name)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def save(self, name, contents, handle):
+        self.lock.acquire()
+        try:
+            if contents is None:
+                self.texts.pop(name, None)
+            else:
+                self.texts[name] = (contents, time.time())
+        finally:
+            self.lock.release()
+
+    def expire(self, before):
+        self.lock.acquire()
+        try:
+            expired = [name for name, (contents, saved) in self.texts.items()
+                       if saved < before]
+            for name in expired:
+                del self.texts[name]
+        finally:
+            self.lock.release()
+        return len(expired)
+
+class SqliteStore(Store):
+    """Keeps the texts in a sqlite database. Each row has the time it was
+    saved, and that column is indexed, so expiring old texts is a single
+    DELETE rather than a look at every text."""
+
+    def __init__(self, filename):
+        Store.__init__(self)
+        self.filename = filename
+        self.lock = threading.Lock()
+        # One connection is shared by the daemon's threads, taking turns.
+        self.db = sqlite3.connect(filename, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("CREATE TABLE IF NOT EXISTS texts ("
+                        "name TEXT PRIMARY KEY, contents TEXT, saved REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS texts_saved "
+                        "ON texts (saved)")
+
+    def load(self, name, handle):
+        self.lock.acquire()
+        try:
+            row = self.db.execute("SELECT contents FROM texts WHERE name = ?",
+                                  (name,)).fetchone()
+        finally:
+            self.lock.release()
+        if row is None:
+            return None
+        return row[0]
+
+    def save(self, name, contents, handle):
+        self.lock.acquire()
+        try:
+            if contents is None:
+                self.db.execute("DELETE FROM texts WHERE name = ?", (name,))
+            else:
+                self.db.execute("INSERT OR REPLACE INTO texts "
+                                "(name, contents, saved) VALUES (?, ?, ?)",
+                                (name, contents, time.time()))
+        finally:
+            self.lock.release()
+
+    def expire(self, before):
+        self.lock.acquire()
+        try:
+            return self.db.execute("DELETE FROM texts WHERE saved < ?",
+                                   (before,)).rowcount
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.db.close()
+        finally:
+            self.lock.release()
+
+class RedisStore(Store):
+    """Keeps the texts in redis, each under prefix + name. Redis expires
+    the texts itself, so there is nothing for the daemon to clean up."""
+
+    def __init__(self, redis_client, prefix="mobwrite:", expiry=86400):
+        Store.__init__(self)
+        self.redis = redis_client
+        self.prefix = prefix
+        self.expiry = int(expiry)
+        # The client has one connection, which the daemon's threads share.
+        self.lock = threading.Lock()
+
+    def load(self, name, handle):
+        self.lock.acquire()
+        try:
+            contents = self.redis.get(self.prefix + name)
+        finally:
+            self.lock.release()
+        if contents is None:
+            return None
+        return contents.decode("utf-8")
+
+    def save(self, name, contents, handle):
+        key = self.prefix + name
+        self.lock.acquire()
+        try:
+            if contents is None:
+                self.redis.delete(key)
+            else:
+                self.redis.set(key, contents.encode("utf-8"))
+                if self.expiry:
+                    self.redis.expire(key, self.expiry)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.redis.disconnect()
+
+def _sqlite_store(c):
+    directory = os.path.dirname(c.mobwrite_storage_file)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    return SqliteStore(c.mobwrite_storage_file)
+
+def _redis_store(c):
+    from bespin import redis
+    return RedisStore(redis.Redis(c.redis_host, c.redis_port),
+                      prefix=c.mobwrite_storage_prefix,
+                      expiry=c.mobwrite_storage_expiry)
+
+storages = dict(
+    bespin=lambda c: Persister(),
+    sqlite=_sqlite_store,
+    redis=_redis_store,
+    memory=lambda c: MemoryStore(),
+)
+
+def make_persister(c):
+    """Returns a new persister of the kind named by c.mobwrite_storage.
+    Unknown names raise ValueError."""
+    try:
+        factory = storages[c.mobwrite_storage]
+    except KeyError:
+        raise ValueError("Unknown mobwrite storage: %s" % (c.mobwrite_storage,))
+    return factory(c)
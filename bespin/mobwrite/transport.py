@@ -0,0 +1,267 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""Persistent connections from the web nodes to the mobwrite daemon.
+
+Opening a socket (or an HTTP connection) for every sync means paying for
+the TCP handshake and slow start on every keystroke. The classes here
+keep connections to the daemon open and reuse them between requests.
+
+Over the telnet port, a connection that starts with the KEEPALIVE_LINE
+stays open after each answer, and every answer is framed as its length
+in bytes on a line of its own followed by the answer itself. Questions
+are still terminated by a blank line, so several of them can be written
+before reading the answers back in order.
+"""
+
+import errno
+import select
+import socket
+import httplib
+import threading
+import time
+import logging
+
+log = logging.getLogger("mobwrite.transport")
+
+# First line sent on a telnet connection that should be kept open.
+KEEPALIVE_LINE = "K:keepalive"
+
+class TransportError(Exception):
+    """sent is False when the question certainly never reached the
+    daemon, in which case it is safe to ask again."""
+    def __init__(self, message, sent=True):
+        Exception.__init__(self, message)
+        self.sent = sent
+
+# errors from writing to a connection the daemon has already closed
+_CLOSED_ERRNOS = (errno.EPIPE, errno.ECONNRESET, errno.EBADF)
+
+def _send_error(e):
+    sent = getattr(e, "errno", None) not in _CLOSED_ERRNOS
+    return TransportError("Error talking to mobwrite: %s" % e, sent)
+
+def _is_stale(sock):
+    """Checks whether an idle connection has been closed (or has sent
+    something unexpected) without blocking."""
+    if sock is None:
+        return True
+    try:
+        readable = select.select([sock], [], [], 0)[0]
+        if not readable:
+            return False
+        sock.recv(1, socket.MSG_PEEK)
+    except (socket.error, select.error, ValueError):
+        pass
+    # a live idle connection has nothing to read: either the daemon
+    # closed it or there is stray data we would mistake for an answer
+    return True
+
+def frame_question(question):
+    """Returns question cut off at its first blank line (where the daemon
+    stops reading) and terminated by exactly one blank line."""
+    lines = []
+    for line in question.splitlines():
+        if not line.strip("\r"):
+            break
+        lines.append(line)
+    return "\n".join(lines) + "\n\n"
+
+class TelnetConnection(object):
+    """A keep-alive connection to the daemon's telnet port."""
+
+    def __init__(self, address, port, timeout):
+        try:
+            self.sock = socket.create_connection((address, port), timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.rfile = self.sock.makefile("rb")
+            self.sock.sendall(KEEPALIVE_LINE + "\n")
+        except socket.error, e:
+            raise TransportError("Unable to connect to mobwrite: %s" % e)
+
+    def request(self, question):
+        return self.request_many([question])[0]
+
+    def request_many(self, questions):
+        """Sends all of the questions in one write and then reads the
+        answers, which come back in the same order."""
+        try:
+            self.sock.sendall("".join(frame_question(question)
+                                      for question in questions))
+        except socket.error, e:
+            raise _send_error(e)
+        try:
+            answers = []
+            for i in xrange(len(questions)):
+                header = self.rfile.readline()
+                if not header:
+                    raise TransportError("Connection closed by mobwrite")
+                length = int(header)
+                answer = self.rfile.read(length)
+                if len(answer) != length:
+                    raise TransportError("Connection closed by mobwrite")
+                answers.append(answer)
+            return answers
+        except (socket.error, ValueError), e:
+            raise TransportError("Error talking to mobwrite: %s" % e)
+
+    def is_stale(self):
+        return _is_stale(self.sock)
+
+    def close(self):
+        try:
+            self.rfile.close()
+            self.sock.close()
+        except socket.error:
+            pass
+
+class HttpConnection(object):
+    """A keep-alive HTTP/1.1 connection to the daemon's web server."""
+
+    def __init__(self, address, port, timeout):
+        self.conn = httplib.HTTPConnection(address, port, timeout=timeout)
+
+    def request(self, question):
+        try:
+            self.conn.request("POST", "/", question,
+                              {"Content-Type": "application/mobwrite"})
+        except socket.error, e:
+            self.conn.close()
+            raise _send_error(e)
+        except httplib.HTTPException, e:
+            raise TransportError("Error talking to mobwrite: %s" % e)
+        try:
+            response = self.conn.getresponse()
+            answer = response.read()
+        except (socket.error, httplib.HTTPException), e:
+            raise TransportError("Error talking to mobwrite: %s" % e)
+        if response.will_close:
+            self.conn.close()
+        if response.status != 200:
+            raise TransportError("HTTP Error %s: %s" % (response.status,
+                                                        response.reason))
+        return answer
+
+    def is_stale(self):
+        # httplib connects lazily and drops the socket when the server
+        # asks it to, so a missing socket just means a fresh connect
+        return self.conn.sock is not None and _is_stale(self.conn.sock)
+
+    def close(self):
+        self.conn.close()
+
+class ConnectionPool(object):
+    """Keeps up to size idle connections created by factory around for
+    reuse. Connections that have been idle for longer than idle_timeout
+    seconds are closed instead of being reused, so that the pool does not
+    hand out connections that the daemon has already given up on."""
+
+    def __init__(self, factory, size=8, idle_timeout=30):
+        self.factory = factory
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def get(self):
+        """Returns a (connection, reused) tuple. Idle connections that
+        the daemon has closed are thrown away rather than handed out."""
+        now = time.time()
+        stale = []
+        self.lock.acquire()
+        try:
+            while self.idle:
+                conn, last_used = self.idle.pop()
+                if now - last_used < self.idle_timeout:
+                    break
+                stale.append(conn)
+            else:
+                conn = None
+        finally:
+            self.lock.release()
+        for old_conn in stale:
+            old_conn.close()
+        if conn is not None and conn.is_stale():
+            conn.close()
+            conn = None
+        if conn is None:
+            return self.factory(), False
+        return conn, True
+
+    def put(self, conn):
+        self.lock.acquire()
+        try:
+            if len(self.idle) < self.size:
+                self.idle.append((conn, time.time()))
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def request(self, question):
+        """Sends question over a pooled connection and returns the
+        answer. The daemon may have dropped a connection that was sitting
+        in the pool, so a reused connection that could not even take the
+        question is replaced by a new one and the question sent again.
+        Once any of the question may have reached the daemon it is not
+        repeated, because deltas are not idempotent."""
+        conn, reused = self.get()
+        try:
+            answer = conn.request(question)
+        except TransportError, e:
+            conn.close()
+            if not reused or e.sent:
+                raise
+            log.debug("Retrying mobwrite request on a new connection")
+            conn = self.factory()
+            try:
+                answer = conn.request(question)
+            except TransportError:
+                conn.close()
+                raise
+        self.put(conn)
+        return answer
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = []
+        finally:
+            self.lock.release()
+        for conn, last_used in idle:
+            conn.close()
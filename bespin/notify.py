@@ -0,0 +1,175 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""Delivers messages to many users at once.
+
+Recipients are resolved with a single set-based query against the
+sharing tables and the messages are handed to the inbox in one
+operation, so notifying a user's followers costs a constant number of queries no
+matter how many followers there are."""
+import logging
+
+from sqlalchemy import select, exists, and_, or_
+
+from bespin import config, queue
+from bespin.database import (User, Connection, GroupMembership,
+                    UserSharing, GroupSharing, EveryoneSharing,
+                    _get_session)
+
+log = logging.getLogger("bespin.notify")
+
+def _can_see_project(owner, project_name):
+    """Builds the clause that is true for rows of the users table that
+    are allowed to see owner's project_name. This mirrors
+    User.is_project_shared, but can be evaluated for many users in one
+    statement."""
+    users = User.__table__
+    everyone = EveryoneSharing.__table__
+    user_sharing = UserSharing.__table__
+    group_sharing = GroupSharing.__table__
+    memberships = GroupMembership.__table__
+
+    return or_(
+        users.c.id == owner.id,
+        exists([everyone.c.id], and_(
+            everyone.c.owner_id == owner.id,
+            everyone.c.project_name == project_name)),
+        exists([user_sharing.c.id], and_(
+            user_sharing.c.owner_id == owner.id,
+            user_sharing.c.project_name == project_name,
+            user_sharing.c.invited_user_id == users.c.id)),
+        exists([group_sharing.c.id], and_(
+            group_sharing.c.owner_id == owner.id,
+            group_sharing.c.project_name == project_name,
+            group_sharing.c.invited_group_id == memberships.c.group_id,
+            memberships.c.user_id == users.c.id)))
+
+def eligible_recipients(owner, project_name, usernames=None,
+                        followers_of=None):
+    """Returns (id, username) pairs for the users that can see the given
+    project. The candidates are either the given usernames or the
+    followers of a user (or both)."""
+    users = User.__table__
+    connections = Connection.__table__
+
+    criteria = [_can_see_project(owner, project_name)]
+    if usernames is not None:
+        if not usernames:
+            return []
+        criteria.append(users.c.username.in_(list(usernames)))
+    if followers_of is not None:
+        criteria.append(users.c.id.in_(
+            select([connections.c.following_id],
+                   connections.c.followed_id == followers_of.id)))
+
+    query = select([users.c.id, users.c.username], and_(*criteria))
+    session = _get_session()
+    # the query goes around the session, so it has to see the sharing
+    # and following changes made earlier in this request
+    session.flush()
+    result = session.connection().execute(query)
+    return [(row[0], row[1]) for row in result.fetchall()]
+
+def deliver(user_ids, message_obj):
+    """Adds the message to the inbox of every user in user_ids in
+    one operation."""
+    if not user_ids:
+        return 0
+    return config.c.inbox.publish_many(user_ids, message_obj)
+
+def tell_file_event(user, project, path, event):
+    """Lets the followers of user who can see project know about a
+    file event. If c.async_notifications is set and there is a job queue,
+    the fan-out happens on the queue and this returns immediately."""
+    job_body = dict(user=user.username, owner=project.owner.username,
+                    project=project.name, path=path, event=event)
+    if config.c.async_notifications and config.c.queue:
+        return queue.enqueue("notify", job_body,
+                        execute="bespin.notify:tell_file_event_run",
+                        error_handler="bespin.notify:notify_error",
+                        use_db=True)
+    return _tell_file_event(user, project.owner, project.name, path, event)
+
+def tell_file_event_run(qi):
+    """Executed via the worker queue to fan out a file event."""
+    message = qi.message
+    user = User.find_user(message['user'])
+    owner = User.find_user(message['owner'])
+    if user is None or owner is None:
+        return
+    _tell_file_event(user, owner, message['project'], message['path'],
+                     message['event'])
+
+def _tell_file_event(user, owner, project_name, path, event):
+    if not _is_recipient(user, owner, project_name):
+        return 0
+    recipients = eligible_recipients(owner, project_name, followers_of=user)
+    return deliver([user_id for user_id, username in recipients], {
+        'msgtargetid': 'file_event',
+        'from':    user.username,
+        'event':   event,
+        'project': project_name,
+        'owner':   owner.username,
+        'path':    path,
+    })
+
+def share_tell(user, project, recipients, text):
+    """Sends text to those recipients (a list of usernames) that can
+    see the project. Returns the usernames that were notified, in the
+    order they were given."""
+    owner = project.owner
+    if not _is_recipient(user, owner, project.name):
+        return []
+    found = eligible_recipients(owner, project.name, usernames=recipients)
+    ids = dict((username, user_id) for user_id, username in found)
+    notified = [recipient for recipient in recipients if recipient in ids]
+    deliver([ids[recipient] for recipient in notified], {
+        'msgtargetid': 'share_tell',
+        'from': user.username,
+        'text': text
+    })
+    return notified
+
+def _is_recipient(user, owner, project_name):
+    if user.id == owner.id:
+        return True
+    return bool(eligible_recipients(owner, project_name,
+                                    usernames=[user.username]))
+
+def notify_error(qi, e):
+    """Fan-out failures are not worth bothering the user about."""
+    log.error("Unable to deliver notification %s: %s", qi.message, e)
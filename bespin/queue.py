@@ -35,18 +35,33 @@
 # ***** END LICENSE BLOCK *****
 #
 
-"""Functions for managing asynchronous operations."""
+"""Functions for managing asynchronous operations.
+
+Jobs are put on named queues. Each queue has a priority that its jobs get
+unless they are given one of their own, and lower numbers are taken first,
+so quick jobs that someone is waiting on are not stuck behind a long
+clone. The worker (process_queue) runs a pool of threads for each queue,
+as set by c.queue_workers, and runs no more than c.queue_user_slots jobs
+for any one user on any one queue at a time. A job from a user who already
+has that many running is put back for the other workers to skip past.
+Quick jobs (those given a priority ahead of their queue's) take no slot.
+"""
 import sqlite3
 import simplejson
 import time
 import logging
+import os
 import sys
+import signal
+import select
+import tempfile
+import threading
 
 import urllib
 import urllib2
 import time
 
-from bespin import config
+from bespin import config, database
 
 try:
     import beanstalkc
@@ -55,11 +70,48 @@ except ImportError:
 
 log = logging.getLogger("bespin.queue")
 
+# The queues and the priorities of their jobs.
+QUEUES = dict(
+    notify=100,
+    files=200,
+    vcs=500,
+    deploy=1000,
+    clone=1000,
+)
+
+# Priority for jobs that should go ahead of the rest of their queue.
+PRIORITY_QUICK = 50
+
+# Seconds before a job that was put back (see UserSlots) is tried again.
+DEFER_DELAY = 1
+
+# Seconds beanstalk gives a job on top of c.queue_job_timeout before it
+# hands the job to another worker, and the time it gives a job when there
+# is no such limit.
+TTR_MARGIN = 60
+TTR_UNLIMITED = 24 * 3600
+
+def job_ttr():
+    """Returns how long beanstalk should let a job run."""
+    job_timeout = config.c.queue_job_timeout
+    if not job_timeout:
+        return TTR_UNLIMITED
+    return int(job_timeout) + TTR_MARGIN
+
+def queue_names(names=None):
+    """Returns the named queues, or all of them, most urgent first."""
+    if names is None:
+        names = QUEUES.keys()
+    elif isinstance(names, basestring):
+        names = [names]
+    return sorted(names, key=lambda name: (QUEUES.get(name, 0), name))
+
 class QueueItem(object):
     next_jobid = 0
 
     def __init__(self, id, queue, message, execute, error_handler=None,
-                job=None, use_db=True, origin=None):
+                job=None, use_db=True, origin=None, user=None,
+                priority=None, source=None):
         if id == None:
             self.id = QueueItem.next_jobid
             QueueItem.next_jobid = QueueItem.next_jobid + 1
@@ -72,7 +124,19 @@ class QueueItem(object):
         self.job = job
         self.use_db = use_db
         self.origin = origin
+        self.user = user
+        self.priority = priority
+        self.source = source
         self.session = None
+        self.failed = False
+
+    @property
+    def quick(self):
+        """True for a job that was sent ahead of the rest of its queue."""
+        if self.source is not None and self.source.endswith("-quick"):
+            return True
+        return self.priority is not None \
+            and self.priority < QUEUES.get(self.queue, 0)
 
     def run(self):
         execute = self.execute
@@ -82,11 +146,13 @@ class QueueItem(object):
         if use_db:
             session = config.c.session_factory()
             self.session = session
+            database.begin_identity_map()
         try:
             execute(self)
             if use_db:
                 session.commit()
         except Exception, e:
+            self.failed = True
             if use_db:
                 session.rollback()
                 session.close()
@@ -105,6 +171,7 @@ class QueueItem(object):
                 log.exception("Error in error handler for message %s. Original error was %s", self.message, e)
         finally:
             if use_db:
+                database.end_identity_map()
                 session.close()
         return self.id
 
@@ -119,7 +186,111 @@ class QueueItem(object):
                 self.job.delete()
         elif self.origin == "restmq":
             if self.job:
-                self.job.delete(self.queue, self.id)
+                self.job.delete(self.source, self.id)
+
+    def defer(self):
+        """Puts the job back on its queue, to be run later."""
+        if self.origin == "beanstalk":
+            if self.job:
+                self.job.release(priority=self.priority, delay=DEFER_DELAY)
+        elif self.origin == "restmq":
+            if self.job:
+                self.job.requeue(self)
+
+class UserSlots(object):
+    """Counts the jobs running for each user on each queue, so that no user
+    has more than slots of them running at once on any one queue. 0 slots
+    means no limit."""
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.lock = threading.Lock()
+        self.running = {}
+
+    def acquire(self, user, queue=None):
+        """Takes a slot for user on queue, if one is free. Returns True if
+        it did."""
+        key = (user, queue)
+        self.lock.acquire()
+        try:
+            count = self.running.get(key, 0)
+            if user is not None and self.slots and count >= self.slots:
+                return False
+            self.running[key] = count + 1
+            return True
+        finally:
+            self.lock.release()
+
+    def release(self, user, queue=None):
+        key = (user, queue)
+        self.lock.acquire()
+        try:
+            count = self.running.get(key, 0) - 1
+            if count > 0:
+                self.running[key] = count
+            else:
+                self.running.pop(key, None)
+        finally:
+            self.lock.release()
+
+class SharedUserSlots(object):
+    """UserSlots shared by the worker processes of a Supervisor, kept in
+    the sqlite database filename. Each slot records the process holding
+    it, so that the slots of a process that dies can be freed."""
+
+    def __init__(self, filename, slots):
+        self.filename = filename
+        self.slots = slots
+        conn = self._connect()
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS slots "
+                         "(user TEXT, queue TEXT, pid INTEGER)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # a connection per call, as they can't be shared across forks
+        return sqlite3.connect(self.filename, timeout=30,
+                               isolation_level=None)
+
+    def acquire(self, user, queue=None):
+        if user is None or not self.slots:
+            return True
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            count = conn.execute("SELECT COUNT(*) FROM slots "
+                                 "WHERE user = ? AND queue IS ?",
+                                 (user, queue)).fetchone()[0]
+            if count >= self.slots:
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute("INSERT INTO slots (user, queue, pid) "
+                         "VALUES (?, ?, ?)", (user, queue, os.getpid()))
+            conn.execute("COMMIT")
+            return True
+        finally:
+            conn.close()
+
+    def release(self, user, queue=None):
+        if user is None or not self.slots:
+            return
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM slots WHERE rowid IN "
+                         "(SELECT rowid FROM slots WHERE user = ? "
+                         "AND queue IS ? AND pid = ? LIMIT 1)",
+                         (user, queue, os.getpid()))
+        finally:
+            conn.close()
+
+    def release_process(self, pid):
+        """Frees the slots held by the process pid."""
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM slots WHERE pid = ?", (pid,))
+        finally:
+            conn.close()
 
 class BeanstalkQueue(object):
     """Manages Bespin jobs within a beanstalkd server.
@@ -132,37 +303,65 @@ class BeanstalkQueue(object):
     """
 
     def __init__(self, host, port):
+        self.host = host
+        self.port = port
         if host is None or port is None:
             self.conn = beanstalkc.Connection()
         else:
             self.conn = beanstalkc.Connection(host=host, port=port)
 
-    def enqueue(self, name, message, execute, error_handler, use_db):
+    def clone(self):
+        """Returns a queue with a connection of its own, for another
+        worker thread."""
+        return BeanstalkQueue(self.host, self.port)
+
+    def enqueue(self, name, message, execute, error_handler, use_db,
+                priority=None, user=None):
+        if priority is None:
+            priority = QUEUES.get(name)
+        if priority is None:
+            priority = beanstalkc.DEFAULT_PRIORITY
         message['__execute'] = execute
         message['__error_handler'] = error_handler
         message['__use_db'] = use_db
+        message['__user'] = user
         c = self.conn
         c.use(name)
-        id = c.put(simplejson.dumps(message))
+        id = c.put(simplejson.dumps(message), priority=priority,
+                   ttr=job_ttr())
         return id
 
-    def read_queue(self, name):
+    def read_queue(self, names, timeout=None):
+        """Yields the jobs from the named queues. Beanstalk hands out the
+        job with the lowest priority number across all of them. If
+        timeout is given, None is yielded whenever there has been no job
+        for that many seconds."""
+        names = queue_names(names)
         c = self.conn
-        log.debug("Starting to read %s on %s", name, c)
-        c.watch(name)
+        log.debug("Starting to read %s on %s", names, c)
+        for name in names:
+            c.watch(name)
+        if "default" not in names:
+            c.ignore("default")
 
         while True:
             log.debug("Reserving next job")
-            item = c.reserve()
-            if item is not None:
+            item = c.reserve(timeout=timeout)
+            if item is None:
+                if timeout is not None:
+                    yield None
+            else:
                 log.debug("Job received (%s)", item.jid)
                 message = simplejson.loads(item.body)
                 execute = message.pop('__execute')
                 error_handler = message.pop('__error_handler')
                 use_db = message.pop('__use_db')
-                qi = QueueItem(item.jid, name, message,
+                user = message.pop('__user', None)
+                stats = item.stats()
+                qi = QueueItem(item.jid, stats['tube'], message,
                                 execute, error_handler=error_handler,
-                                job=item, use_db=use_db, origin="beanstalk")
+                                job=item, use_db=use_db, origin="beanstalk",
+                                user=user, priority=stats['pri'])
                 yield qi
 
     def close(self):
@@ -179,7 +378,11 @@ class RestMqQueue(object):
         self.host = host or "localhost"
         self.port = port or 8888
         self.timeout = timeout
-        self.url = "http://" + self.host + ":" + self.port + "/queue"
+        self.url = "http://" + self.host + ":" + str(self.port) + "/queue"
+
+    def clone(self):
+        """RestMQ is spoken over HTTP, so worker threads can share this."""
+        return self
         
     def _do_cmd(self, **kwargs):
         # special treatment of 'value'
@@ -195,32 +398,67 @@ class RestMqQueue(object):
         obj = simplejson.loads(rsp.read())
         return obj
 
-    def enqueue(self, name, message, execute, error_handler, use_db):
+    def enqueue(self, name, message, execute, error_handler, use_db,
+                priority=None, user=None):
         message['__execute'] = execute
         message['__error_handler'] = error_handler
         message['__use_db'] = use_db
-        obj = self._do_cmd(cmd="add", queue=name, value=message)
+        message['__user'] = user
+        obj = self._do_cmd(cmd="add", queue=self._queue_for(name, priority),
+                           value=message)
         return obj and obj['key'] or None
 
-    def delete(name, id):
+    def _queue_for(self, name, priority):
+        # RestMQ queues are first in, first out, so jobs that go ahead of
+        # the rest of their queue are kept on a queue of their own.
+        if priority is not None and priority < QUEUES.get(name, 0):
+            return name + "-quick"
+        return name
+
+    def delete(self, name, id):
         return self._do_cmd(cmd="del", queue=name, key=id)
 
-    def read_queue(self, name):
-        log.debug("Starting to read %s on %s", name, self.url)
+    def requeue(self, qi):
+        # RestMQ has no delayed jobs, so wait here rather than have the
+        # workers pass the job straight back and forth.
+        time.sleep(DEFER_DELAY)
+        message = dict(qi.message)
+        message['__execute'] = qi.execute
+        message['__error_handler'] = qi.error_handler
+        message['__use_db'] = qi.use_db
+        message['__user'] = qi.user
+        self._do_cmd(cmd="add", queue=qi.source, value=message)
+        self.delete(qi.source, qi.id)
+
+    def read_queue(self, names, timeout=None):
+        """Yields the jobs from the named queues, taking them from the most
+        urgent queue that has any. If timeout is given, None is yielded
+        whenever the queues are found empty."""
+        sources = []
+        for name in queue_names(names):
+            sources.extend([(name + "-quick", name), (name, name)])
+        log.debug("Starting to read %s on %s", names, self.url)
         while True:
             log.debug("Reserving next job")
-            item = self._do_cmd(cmd="get", queue=name)
-            if item is None or ('error' in item):
+            for source, name in sources:
+                item = self._do_cmd(cmd="get", queue=source)
+                if item is not None and 'error' not in item:
+                    break
+            else:
                 time.sleep(self.timeout)
+                if timeout is not None:
+                    yield None
                 continue
             log.debug("Job received (%s)", item['key'])
             message = simplejson.loads(item['value'])
             execute = message.pop('__execute')
             error_handler = message.pop('__error_handler')
             use_db = message.pop('__use_db')
+            user = message.pop('__user', None)
             qi = QueueItem(item['key'], name, message,
                             execute, error_handler=error_handler,
-                            job=self, use_db=use_db, origin="restmq")
+                            job=self, use_db=use_db, origin="restmq",
+                            user=user, source=source)
             yield qi
 
     def close(self):
@@ -232,10 +470,19 @@ def _resolve_function(namestring):
     module = __import__(modulename, fromlist=[funcname])
     return getattr(module, funcname)
 
-def enqueue(queue_name, message, execute, error_handler=None, use_db=True):
+def enqueue(queue_name, message, execute, error_handler=None, use_db=True,
+            priority=None, user=None):
+    """Puts a job on the named queue (one of QUEUES), or runs it straight
+    away if there is no job queue. priority overrides the queue's own, and
+    user (by default message['user']) is who the job counts against."""
+    if user is None:
+        user = message.get('user')
+        if not isinstance(user, basestring):
+            user = None
     if config.c.queue:
         id = config.c.queue.enqueue(queue_name, message, execute,
-                                    error_handler, use_db)
+                                    error_handler, use_db,
+                                    priority=priority, user=user)
         log.debug("Running job asynchronously (%s)", id)
         return id
     else:
@@ -244,6 +491,344 @@ def enqueue(queue_name, message, execute, error_handler=None, use_db=True):
         log.debug("Running job synchronously (%s)", qi.id)
         return qi.run()
 
+# Seconds before a worker thread whose job queue failed reconnects.
+RECONNECT_DELAY = 1
+
+class Worker(object):
+    """The worker threads of one process. They stop once stop() is called
+    or, if max_jobs is set, after that many jobs, finishing the jobs they
+    are running first. health() reports how they are doing."""
+
+    def __init__(self, slots, max_jobs=0):
+        self.slots = slots
+        self.max_jobs = max_jobs
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.started = time.time()
+        self.jobs = 0
+        self.failures = 0
+        self.last_job = None
+        # thread name -> (job id, queue, when it started)
+        self.running = {}
+        self.threads = []
+
+    def start(self, bq, queue_workers):
+        """Starts count threads for each (queue name, count), each with a
+        connection of its own."""
+        for name, count in queue_workers:
+            for i in range(count):
+                thread = threading.Thread(target=self.work,
+                                          args=(bq.clone(), name),
+                                          name="%s-worker-%s" % (name, i))
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self):
+        self.stopping = True
+
+    def wait(self):
+        """Waits for the threads to finish."""
+        while self.threads:
+            # join with a timeout, so that signals are noticed
+            self.threads[0].join(1)
+            self.threads = [thread for thread in self.threads
+                            if thread.isAlive()]
+
+    def work(self, bq, names):
+        """Runs the jobs from the named queues, one at a time. If the job
+        queue fails, the thread reconnects after RECONNECT_DELAY seconds
+        and carries on."""
+        while True:
+            try:
+                self._work(bq, names)
+                return
+            except Exception:
+                log.exception("Error reading jobs from %s", names)
+            if self.stopping:
+                return
+            time.sleep(RECONNECT_DELAY)
+            try:
+                bq.close()
+            except Exception:
+                pass
+            try:
+                bq = bq.clone()
+            except Exception:
+                log.exception("Error reconnecting to the job queue")
+
+    def _work(self, bq, names):
+        name = threading.currentThread().getName()
+        for qi in bq.read_queue(names, timeout=1):
+            if self.stopping:
+                if qi is not None:
+                    self._finish(qi, qi.defer)
+                break
+            if qi is None:
+                continue
+            # quick jobs are not held up by the user's slow ones
+            slotted = not qi.quick
+            if slotted and not self.slots.acquire(qi.user, qi.queue):
+                log.debug("Putting back job %s, %s has no free slots on %s",
+                          qi.id, qi.user, qi.queue)
+                self._finish(qi, qi.defer)
+                continue
+            self.lock.acquire()
+            self.running[name] = (qi.id, qi.queue, time.time())
+            self.lock.release()
+            try:
+                log.info("Processing job %s", qi.id)
+                log.debug("Message: %s", qi.message)
+                qi.run()
+                self._finish(qi, qi.done)
+            finally:
+                if slotted:
+                    self.slots.release(qi.user, qi.queue)
+                self.lock.acquire()
+                try:
+                    del self.running[name]
+                    self.jobs += 1
+                    if qi.failed:
+                        self.failures += 1
+                    self.last_job = time.time()
+                    if self.max_jobs and self.jobs >= self.max_jobs:
+                        self.stopping = True
+                finally:
+                    self.lock.release()
+
+    def _finish(self, qi, action):
+        """Deletes or puts back a job (action is qi.done or qi.defer). If
+        the job queue won't have it, the job is left for the queue to hand
+        out again."""
+        try:
+            action()
+        except Exception:
+            log.exception("Error in %s for job %s", action.__name__, qi.id)
+
+    def health(self):
+        now = time.time()
+        self.lock.acquire()
+        try:
+            return dict(pid=os.getpid(), started=self.started,
+                        jobs=self.jobs, failures=self.failures,
+                        last_job=self.last_job, stopping=self.stopping,
+                        threads=len([thread for thread in self.threads
+                                     if thread.isAlive()]),
+                        running=[dict(thread=name, job=job, queue=queue,
+                                      started=started, age=now - started)
+                                 for name, (job, queue, started)
+                                 in sorted(self.running.items())])
+        finally:
+            self.lock.release()
+
+# Seconds between the health reports of worker processes.
+HEALTH_INTERVAL = 5
+
+def _run_child(bq, report, slots):
+    """Runs a worker process, which reports its health on the report
+    file descriptor until its threads have finished."""
+    c = config.c
+    # The connections in the pool belong to the supervisor.
+    c.dbengine.dispose()
+    worker = Worker(slots, c.queue_max_jobs)
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker.start(bq, c.queue_workers)
+
+    def send_health():
+        os.write(report, simplejson.dumps(worker.health()) + "\n")
+
+    last_report = 0
+    while worker.threads:
+        if time.time() - last_report >= HEALTH_INTERVAL:
+            send_health()
+            last_report = time.time()
+        worker.threads[0].join(min(1, HEALTH_INTERVAL))
+        worker.threads = [thread for thread in worker.threads
+                          if thread.isAlive()]
+    send_health()
+
+class Supervisor(object):
+    """Keeps the given number of worker processes running. Each one runs
+    the threads of c.queue_workers and is replaced when it exits (after
+    c.queue_max_jobs jobs, for example), stops reporting its health for
+    c.queue_health_timeout seconds or has had a job running for more than
+    c.queue_job_timeout seconds. The processes share c.queue_user_slots.
+    The latest reports are written to c.queue_health_file, if it is set."""
+
+    def __init__(self, bq, processes):
+        self.bq = bq
+        self.processes = processes
+        self.stopping = False
+        self.deadline = None
+        fd, filename = tempfile.mkstemp(prefix="bespin-slots-",
+                                        suffix=".sqlite")
+        os.close(fd)
+        self.slots = SharedUserSlots(filename, config.c.queue_user_slots)
+        # pid -> file descriptor its reports come in on
+        self.reports = {}
+        # pid -> partial line read from it
+        self.partial = {}
+        # pid -> latest report, with the time it came in
+        self.health = {}
+
+    def spawn(self):
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_end)
+            for fd in self.reports.values():
+                os.close(fd)
+            status = 0
+            try:
+                try:
+                    _run_child(self.bq.clone(), write_end, self.slots)
+                except:
+                    log.exception("Worker process %s failed", os.getpid())
+                    status = 1
+            finally:
+                os._exit(status)
+        os.close(write_end)
+        self.reports[pid] = read_end
+        self.partial[pid] = ""
+        self.health[pid] = dict(pid=pid, started=time.time(),
+                                reported=time.time())
+        log.info("Started worker process %s", pid)
+        return pid
+
+    def stop(self):
+        self.stopping = True
+        for pid in self.reports:
+            self._signal(pid, signal.SIGTERM)
+
+    def _signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+    def read_reports(self, timeout):
+        fds = dict((fd, pid) for pid, fd in self.reports.items())
+        if not fds:
+            time.sleep(timeout)
+            return
+        try:
+            ready = select.select(fds.keys(), [], [], timeout)[0]
+        except select.error:
+            # interrupted by a signal
+            return
+        for fd in ready:
+            pid = fds[fd]
+            data = os.read(fd, 65536)
+            if not data:
+                continue
+            lines = (self.partial[pid] + data).split("\n")
+            self.partial[pid] = lines.pop()
+            for line in lines:
+                report = simplejson.loads(line)
+                report['reported'] = time.time()
+                self.health[pid] = report
+
+    def reap(self):
+        """Forgets the worker processes that have exited, and returns how
+        many did."""
+        exited = 0
+        while self.reports:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if not pid:
+                break
+            if pid not in self.reports:
+                continue
+            os.close(self.reports.pop(pid))
+            del self.partial[pid]
+            self.slots.release_process(pid)
+            report = self.health.pop(pid)
+            log.info("Worker process %s exited (status %s) after %s jobs",
+                     pid, status, report.get('jobs', 0))
+            exited += 1
+        return exited
+
+    def check_health(self, now):
+        """Kills the worker processes that have not reported in time, or
+        that have a job that has been running for too long."""
+        timeout = config.c.queue_health_timeout
+        job_timeout = config.c.queue_job_timeout
+        for pid, report in self.health.items():
+            if 'killed' in report:
+                continue
+            if timeout and now - report['reported'] > timeout:
+                log.error("Worker process %s has not reported for %s "
+                          "seconds, killing it", pid, timeout)
+                self._kill(pid, now)
+                continue
+            if not job_timeout:
+                continue
+            for job in report.get('running', []):
+                if now - job['started'] > job_timeout:
+                    log.error("Job %s on %s has been running for more "
+                              "than %s seconds, killing worker process %s",
+                              job['job'], job['queue'], job_timeout, pid)
+                    self._kill(pid, now)
+                    break
+
+    def _kill(self, pid, now):
+        self._signal(pid, signal.SIGKILL)
+        self.health[pid]['killed'] = now
+
+    def write_health(self):
+        filename = config.c.queue_health_file
+        if not filename:
+            return
+        partial = filename + ".partial"
+        f = open(partial, "w")
+        try:
+            f.write(simplejson.dumps(dict(supervisor=os.getpid(),
+                                          stopping=self.stopping,
+                                          workers=self.health.values())))
+        finally:
+            f.close()
+        os.rename(partial, filename)
+
+    def step(self, timeout=1):
+        """Starts, waits for and checks on the worker processes for up to
+        timeout seconds. Returns False once stop() has been called and
+        they have all exited."""
+        if self.stopping:
+            if not self.reports:
+                return False
+            if self.deadline is None:
+                self.deadline = time.time() + config.c.queue_shutdown_timeout
+            elif time.time() > self.deadline:
+                log.warning("Killing the worker processes that are "
+                            "still running")
+                for pid in self.reports:
+                    self._signal(pid, signal.SIGKILL)
+                self.deadline = time.time() + config.c.queue_shutdown_timeout
+        else:
+            while len(self.reports) < self.processes:
+                self.spawn()
+        self.read_reports(timeout)
+        self.reap()
+        self.check_health(time.time())
+        self.write_health()
+        return True
+
+    def close(self):
+        os.remove(self.slots.filename)
+
+    def run(self):
+        """Runs until stop() is called and the worker processes have
+        finished their jobs, or until c.queue_shutdown_timeout seconds
+        after that."""
+        try:
+            while self.step():
+                pass
+        finally:
+            self.close()
+
 def process_queue(args=None):
     log.info("Bespin queue worker")
     if args is None:
@@ -262,8 +847,17 @@ def process_queue(args=None):
 
     bq = config.c.queue
     log.debug("Queue: %s", bq)
-    for qi in bq.read_queue("vcs"):
-        log.info("Processing job %s", qi.id)
-        log.debug("Message: %s", qi.message)
-        qi.run()
-        qi.done()
+    if config.c.queue_processes:
+        supervisor = Supervisor(bq, config.c.queue_processes)
+        signal.signal(signal.SIGTERM, lambda signum, frame: supervisor.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: supervisor.stop())
+        supervisor.run()
+    else:
+        worker = Worker(UserSlots(config.c.queue_user_slots))
+        signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+        worker.start(bq, config.c.queue_workers)
+        try:
+            worker.wait()
+        except KeyboardInterrupt:
+            worker.stop()
+            worker.wait()
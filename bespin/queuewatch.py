@@ -40,6 +40,8 @@ import sys
 import beanstalkc
 import redis
 
+from bespin.queue import QUEUES
+
 def command():
     if len(sys.argv) < 5:
         print "Usage: beanstalk host, beanstalk port, redis host, redis port"
@@ -49,10 +51,12 @@ def command():
     rport = int(rport)
     beanstalk = beanstalkc.Connection(host=bhost, port=bport)
     redis_conn = redis.Redis(rhost, rport)
-    try:
-        queue_size = beanstalk.stats_tube('vcs')['current-jobs-ready']
-    except beanstalkc.CommandFailed:
-        queue_size = 0
+    queue_size = 0
+    for name in QUEUES:
+        try:
+            queue_size += beanstalk.stats_tube(name)['current-jobs-ready']
+        except beanstalkc.CommandFailed:
+            pass
     
     today = date.today().strftime("%Y%m%d")
     redis_conn.push("queue_" + today, queue_size, tail=False)
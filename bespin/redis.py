@@ -482,6 +482,28 @@ class Redis(object):
         self._write('%s %s\r\n' % ('RPOP' if tail else 'LPOP', name))
         return self.get_response()
     
+    def blpop(self, names, timeout=0):
+        """Blocks until one of the lists in names has an element or
+        timeout seconds pass (0 blocks forever). Returns a (name, value)
+        pair, or None on timeout.
+        
+        >>> r = Redis(db=9)
+        >>> r.delete('l')
+        1
+        >>> r.push('l', 'aaa')
+        'OK'
+        >>> r.blpop(['l'], 1)
+        ('l', 'aaa')
+        >>> r.blpop(['l'], 1)
+        >>> 
+        """
+        self.connect()
+        self._write('BLPOP %s %s\r\n' % (' '.join(names), int(timeout)))
+        result = self.get_response()
+        if not result:
+            return None
+        return tuple(result)
+    
     def lset(self, name, index, value):
         """
         >>> r = Redis(db=9)
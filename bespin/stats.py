@@ -48,6 +48,9 @@ class DoNothingStats(object):
     def decr(self, key, by=1):
         return 0
     
+    def set(self, key, value):
+        pass
+    
     def multiget(self, keys):
         return dict()
         
@@ -73,6 +76,10 @@ class MemoryStats(object):
     def decr(self, key, by=1):
         return self.incr(key, -1*by)
     
+    def set(self, key, value):
+        """Sets a gauge, a stat that is overwritten instead of counted."""
+        self.storage[_get_key(key)] = value
+    
     def multiget(self, keys):
         return dict((key, self.storage.get(key)) for key in keys)
         
@@ -96,6 +103,13 @@ class RedisStats(object):
             return self.redis.decr(key, by)
         except:
             log.exception("Problem decrementing stat %s", key)
+    
+    def set(self, key, value):
+        key = _get_key(key)
+        try:
+            self.redis.set(key, value)
+        except:
+            log.exception("Problem setting stat %s", key)
         
     def multiget(self, keys):
         return dict(zip(keys, self.redis.mget(*keys)))
@@ -39,9 +39,9 @@
 #import simplejson
 
 import simplejson
-from bespin import config, controllers
+from bespin import config, controllers, notify
 from bespin.filesystem import get_project
-from bespin.database import User, Base, ConflictError
+from bespin.database import User, Base, ConflictError, get_shared_access
 
 from nose.tools import assert_equals
 from __init__ import BespinTestApp
@@ -290,6 +290,30 @@ def test_sharing():
 
     joes_project.delete()
 
+def test_shared_access_matches_is_project_shared():
+    _reset()
+    projects = {}
+    for name in ["private", "read", "write", "homies", "public"]:
+        projects[name] = get_project(joe, joe, name, create=True)
+    joe.add_sharing(projects["read"], ev, False, False)
+    joe.add_sharing(projects["write"], ev, True, False)
+    homies = joe.get_group("homies", create_on_not_found=True)
+    homies.add_member(ev)
+    joe.add_sharing(projects["homies"], homies, True, False)
+    joe.add_sharing(projects["public"], 'everyone', False, False)
+
+    pairs = [(joe, name) for name in projects]
+    for user in [ev, tom]:
+        shared = get_shared_access(user, pairs)
+        for name in projects:
+            if joe.is_project_shared(name, user, require_write=True):
+                assert_equals(shared.get((joe.id, name)), True)
+            elif joe.is_project_shared(name, user):
+                assert_equals(shared.get((joe.id, name)), False)
+            else:
+                assert (joe.id, name) not in shared
+    assert_equals(get_shared_access(ev, []), {})
+
 # Sharing tests
 def test_sharing_with_app():
     _reset()
@@ -593,3 +617,62 @@ def test_follow():
         assert False, "Missing ConflictError"
     except ConflictError:
         session.rollback()
+
+# Notification tests
+def _message_targets(user):
+    return [simplejson.loads(message)['msgtargetid']
+            for message in user.pop_messages()]
+
+def test_file_event_fan_out():
+    _reset()
+
+    joes_project = get_project(joe, joe, "joes_project", create=True)
+    joe.add_sharing(joes_project, ev, False, False)
+    homies = joe.get_group("homies", create_on_not_found=True)
+    homies.add_member(mattb)
+    joe.add_sharing(joes_project, homies, False, False)
+
+    ev.follow(joe)
+    mattb.follow(joe)
+    tom.follow(joe)
+    session.commit()
+
+    recipients = notify.eligible_recipients(joe, "joes_project",
+                                            followers_of=joe)
+    assert_equals(set(username for id, username in recipients),
+                  set([ "ev", "mattb" ]))
+
+    notify.tell_file_event(joe, joes_project, "foo.js", "open")
+    session.commit()
+    session.expire_all()
+    assert_equals(_message_targets(ev), [ "file_event" ])
+    assert_equals(_message_targets(mattb), [ "file_event" ])
+    assert_equals(_message_targets(tom), [])
+    assert_equals(_message_targets(zuck), [])
+
+def test_recipients_include_sharing_added_in_the_same_request():
+    _reset()
+
+    joes_project = get_project(joe, joe, "joes_project", create=True)
+    session.commit()
+    # not yet committed, or even flushed
+    joe.add_sharing(joes_project, ev, False, False)
+    recipients = notify.eligible_recipients(joe, "joes_project",
+                                            usernames=["ev", "tom"])
+    assert_equals([username for id, username in recipients], ["ev"])
+    session.rollback()
+
+def test_share_tell_only_reaches_members():
+    _reset()
+
+    joes_project = get_project(joe, joe, "joes_project", create=True)
+    joe.add_sharing(joes_project, ev, False, False)
+    session.commit()
+
+    notified = notify.share_tell(joe, joes_project,
+                                 [ "tom", "ev", "nobody" ], "hello")
+    assert_equals(notified, [ "ev" ])
+    session.commit()
+    session.expire_all()
+    assert_equals(_message_targets(ev), [ "share_tell" ])
+    assert_equals(_message_targets(tom), [])
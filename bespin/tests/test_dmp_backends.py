@@ -0,0 +1,188 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+#
+# Every diff_match_patch backend runs through the same checks, and the
+# others are compared with the pure Python one.
+
+import random
+import time
+
+from nose.tools import assert_equals, assert_raises
+
+from bespin.mobwrite import dmp_backends
+from bespin.mobwrite.diff_match_patch import diff_match_patch
+
+ALPHABET = u"abcde \n\xe9\u4e2d"
+
+def _random_text(rnd, length):
+    return u"".join(rnd.choice(ALPHABET) for i in xrange(length))
+
+def _mutate(rnd, text):
+    chars = list(text)
+    for i in xrange(rnd.randint(0, 6)):
+        pos = rnd.randint(0, len(chars))
+        op = rnd.randint(0, 2)
+        if op == 0:
+            chars.insert(pos, rnd.choice(ALPHABET))
+        elif pos < len(chars):
+            if op == 1:
+                del chars[pos]
+            else:
+                chars[pos] = rnd.choice(ALPHABET)
+    return u"".join(chars)
+
+def _text_pairs(count):
+    rnd = random.Random(count)
+    pairs = [(u"", u""), (u"", u"abc"), (u"abc", u""), (u"abc", u"abc"),
+             (u"abc", u"xyz"), (u"The cat", u"The big cat"),
+             (u"line one\nline two\n" * 20, u"line one\nline 2\n" * 20),
+             ("plain str", "plain string")]
+    for i in xrange(count):
+        text1 = _random_text(rnd, rnd.randint(0, 300))
+        pairs.append((text1, _mutate(rnd, _mutate(rnd, text1))))
+    return pairs
+
+def test_backend_selection():
+    assert dmp_backends.get_backend("python") is diff_match_patch
+    if "c" in dmp_backends.backends:
+        assert dmp_backends.get_backend("auto") is \
+            dmp_backends.c_diff_match_patch
+    else:
+        assert dmp_backends.get_backend("auto") is diff_match_patch
+        assert dmp_backends.get_backend("c") is diff_match_patch
+    assert_raises(ValueError, dmp_backends.get_backend, "fortran")
+    template = diff_match_patch()
+    template.Diff_Timeout = 0.25
+    assert_equals(dmp_backends.make_dmp("python", template).Diff_Timeout,
+                  0.25)
+
+def test_diffs_rebuild_both_texts():
+    reference = diff_match_patch()
+    def run_one(name):
+        dmp = dmp_backends.make_dmp(name)
+        dmp.Diff_Timeout = 0
+        for (text1, text2) in _text_pairs(300):
+            for checklines in (True, False):
+                diffs = dmp.diff_main(text1, text2, checklines)
+                assert_equals(dmp.diff_text1(diffs), text1)
+                assert_equals(dmp.diff_text2(diffs), text2)
+                # deltas are read the same way by every backend
+                delta = dmp.diff_toDelta(diffs)
+                assert_equals(reference.diff_fromDelta(text1, delta), diffs)
+    for name in sorted(dmp_backends.backends):
+        yield run_one, name
+
+def test_diffs_are_no_longer_than_python():
+    reference = diff_match_patch()
+    reference.Diff_Timeout = 0
+    def run_one(name):
+        dmp = dmp_backends.make_dmp(name)
+        dmp.Diff_Timeout = 0
+        expected = actual = 0
+        for (text1, text2) in _text_pairs(300):
+            expected += reference.diff_levenshtein(
+                reference.diff_main(text1, text2, False))
+            actual += dmp.diff_levenshtein(dmp.diff_main(text1, text2, False))
+        assert actual <= expected, (actual, expected)
+    for name in sorted(dmp_backends.backends):
+        if name != "python":
+            yield run_one, name
+
+def test_match_agrees_with_python():
+    reference = diff_match_patch()
+    def run_one(name):
+        dmp = dmp_backends.make_dmp(name)
+        rnd = random.Random(5)
+        for i in xrange(1000):
+            text = _random_text(rnd, rnd.randint(0, 200))
+            if len(text) > 10 and rnd.random() < 0.5:
+                start = rnd.randint(0, len(text) - 5)
+                pattern = _mutate(rnd, text[start:start + rnd.randint(1, 40)])
+            else:
+                pattern = _random_text(rnd, rnd.randint(1, 40))
+            loc = rnd.randint(0, len(text))
+            for distance in (1000, 10, 0):
+                reference.Match_Distance = dmp.Match_Distance = distance
+                assert_equals(dmp.match_main(text, pattern, loc),
+                              reference.match_main(text, pattern, loc))
+    for name in sorted(dmp_backends.backends):
+        if name != "python":
+            yield run_one, name
+
+def test_patches_apply_like_python():
+    reference = diff_match_patch()
+    def run_one(name):
+        dmp = dmp_backends.make_dmp(name)
+        for (text1, text2) in _text_pairs(100):
+            # the backend's own patches, applied to the original by Python
+            patches = dmp.patch_make(text1, text2)
+            patches = reference.patch_fromText(dmp.patch_toText(patches))
+            assert_equals(reference.patch_apply(patches, text1)[0], text2)
+            # Python's patches, applied by the backend
+            patches = reference.patch_make(text1, text2)
+            assert_equals(dmp.patch_apply(patches, text1),
+                          reference.patch_apply(patches, text1))
+    for name in sorted(dmp_backends.backends):
+        yield run_one, name
+
+def test_diff_timeout_is_respected():
+    rnd = random.Random(7)
+    text1 = _random_text(rnd, 20000)
+    text2 = _random_text(rnd, 20000)
+    def run_one(name):
+        dmp = dmp_backends.make_dmp(name)
+        dmp.Diff_Timeout = 0.1
+        start = time.time()
+        diffs = dmp.diff_main(text1, text2, False)
+        assert time.time() - start < 1
+        assert_equals(dmp.diff_text1(diffs), text1)
+        assert_equals(dmp.diff_text2(diffs), text2)
+    for name in sorted(dmp_backends.backends):
+        yield run_one, name
+
+def test_diff_map_without_timeout_runs_to_completion():
+    # diff_map expects the common prefix and suffix to be gone already
+    text1 = u"<" + u"The quick brown fox jumps over the lazy dog." * 20
+    text2 = u">" + u"That quick brown fox jumped over a lazy dog!" * 20
+    def run_one(name):
+        dmp = dmp_backends.make_dmp(name)
+        dmp.Diff_Timeout = 0
+        diffs = dmp.diff_map(text1, text2)
+        assert diffs is not None
+        assert_equals(dmp.diff_text1(diffs), text1)
+        assert_equals(dmp.diff_text2(diffs), text2)
+    for name in sorted(dmp_backends.backends):
+        yield run_one, name
@@ -38,6 +38,9 @@
 # 
 
 import os
+import shutil
+import tempfile
+import time
 from datetime import datetime, timedelta
 from urllib import urlencode
 
@@ -52,6 +55,8 @@ from bespin import config, controllers, filesystem
 from bespin.filesystem import File, get_project, ProjectView
 from bespin.filesystem import FSException, FileNotFound, OverQuota, FileConflict, BadValue
 from bespin.database import User, Base, _get_session, EventLog
+from bespin.mobwrite.integrate import Persister, WriteBehindPersister
+from bespin.mobwrite.journal import DeltaJournal
 
 tarfilename = os.path.join(os.path.dirname(__file__), "ut.tgz")
 zipfilename = os.path.join(os.path.dirname(__file__), "ut.zip")
@@ -163,6 +168,87 @@ def test_amount_used_can_be_recomputed():
     macgyver.recompute_files()
     assert macgyver.amount_used == starting_point
     
+def test_mobwrite_temp_files_are_merged_into_real_files():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("reqs", "Chewing gum")
+    starting_point = macgyver.amount_used
+    bigmac.save_temp_file("reqs", "Chewing gum wrapper")
+    bigmac.save_temp_file("plans/new", "Paper clip")
+    assert bigmac.get_temp_file("reqs") == "Chewing gum wrapper"
+    assert File(bigmac, "reqs").data == "Chewing gum"
+    
+    # the edits have only just been made
+    assert bigmac.merge_temp_files(idle=60) == 0
+    
+    File(bigmac, "reqs").statusfile.write_bytes(simplejson.dumps(
+        {"open": {"reqs": {"MacGyver": "rw"}}}))
+    assert bigmac.merge_temp_files() == 2
+    assert File(bigmac, "reqs").data == "Chewing gum wrapper"
+    assert File(bigmac, "plans/new").data == "Paper clip"
+    assert macgyver.amount_used == starting_point + 18
+    assert bigmac.search_files("new") == ["plans/new"]
+    
+    # the temp copy of the file that MacGyver still has open is kept
+    temp_dir = bigmac.location.parent / ".bigmac-mobwrite"
+    assert [temp_dir.relpathto(f) for f in temp_dir.walkfiles()] == ["reqs"]
+    assert bigmac.merge_temp_files() == 0
+    bigmac.close("reqs")
+    assert bigmac.merge_temp_files() == 0
+    assert not temp_dir.exists()
+    
+def test_mobwrite_temp_files_do_not_overwrite_newer_real_files():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("reqs", "Chewing gum")
+    bigmac.save_temp_file("reqs", "Chewing gum wrapper")
+    temp_loc = bigmac.location.parent / ".bigmac-mobwrite" / "reqs"
+    an_hour_ago = time.time() - 3600
+    os.utime(temp_loc, (an_hour_ago, an_hour_ago))
+    # saved without mobwrite after the temp copy
+    bigmac.save_file("reqs", "Duct tape")
+    assert bigmac.merge_temp_files() == 0
+    assert File(bigmac, "reqs").data == "Duct tape"
+    assert temp_loc.exists()
+    
+def test_mobwrite_temp_files_from_before_a_restart_are_merged():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_temp_file("plans", "Paper clip")
+    persister = Persister()
+    assert persister.find_unmerged() == 1
+    assert persister.unmerged.keys() == [("MacGyver", "bigmac")]
+    
+def test_failed_mobwrite_saves_stay_pending_and_journaled():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    directory = tempfile.mkdtemp()
+    save_temp_file = filesystem.Project.save_temp_file
+    def over_quota(self, destpath, contents=None):
+        raise OverQuota("Over quota")
+    filesystem.Project.save_temp_file = over_quota
+    try:
+        journal = DeltaJournal(directory)
+        persister = WriteBehindPersister(Persister(), interval=60)
+        persister.on_flush = journal.discard
+        seq = journal.append("bigmac/reqs", None, u"Chewing gum")
+        persister.save("bigmac/reqs", u"Chewing gum", "MacGyver:127.0.0.1",
+                       journal_seq=seq)
+        assert persister.flush(everything=True) == 0
+        assert persister.pending.keys() == ["bigmac/reqs"]
+        assert DeltaJournal(directory).load("bigmac/reqs") == \
+            (True, u"Chewing gum")
+        
+        filesystem.Project.save_temp_file = save_temp_file
+        assert persister.flush(everything=True) == 1
+        assert persister.pending == {}
+        assert DeltaJournal(directory).load("bigmac/reqs") == (False, None)
+        temp_loc = bigmac.location.parent / ".bigmac-mobwrite" / "reqs"
+        assert temp_loc.bytes() == "Chewing gum"
+    finally:
+        filesystem.Project.save_temp_file = save_temp_file
+        shutil.rmtree(directory)
+    
 def test_retrieve_file_obj():
     _init_data()
     bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
@@ -0,0 +1,1045 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+#
+
+import datetime
+import os
+import shutil
+import socket
+import SocketServer
+import tempfile
+import threading
+import time
+import urllib
+
+from bespin import config, stats
+from bespin.mobwrite import mobwrite_daemon, mobwrite_core, transport, sharding, \
+    metrics, storage
+from bespin.mobwrite.mobwrite_async import AsyncServer
+from bespin.mobwrite.journal import DeltaJournal
+from bespin.mobwrite.benchmarks import MemoryPersister, BenchmarkMobWrite, \
+    make_source_text, scatter_edits
+from bespin.mobwrite.diff_match_patch import diff_match_patch
+from bespin.mobwrite.integrate import Access, WriteBehindPersister
+
+from nose.tools import assert_equals
+
+def setup_module(module):
+    config.set_profile("test")
+    config.activate_profile()
+    
+def teardown_module(module):
+    if isinstance(mobwrite_daemon.persister, WriteBehindPersister):
+        mobwrite_daemon.persister.stop()
+        mobwrite_daemon.persister = None
+
+class EchoHandler(mobwrite_daemon.StreamRequestHandlerDaemonMobWrite):
+    def handleRequest(self, question):
+        return "answer to " + question.splitlines()[0] + "\n"
+
+def _start_server(handler):
+    server = SocketServer.ThreadingTCPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+# Transport tests
+
+def test_keepalive_connection_answers_pipelined_questions():
+    server = _start_server(EchoHandler)
+    try:
+        address, port = server.server_address
+        conn = transport.TelnetConnection(address, port, 5)
+        assert_equals(conn.request("H:one\nu:a\n\n"), "answer to H:one\n")
+        answers = conn.request_many(["H:two\n", "H:three\n\nignored\n"])
+        assert_equals(answers, ["answer to H:two\n", "answer to H:three\n"])
+        conn.close()
+    finally:
+        server.shutdown()
+
+class SessionHandler(mobwrite_daemon.StreamRequestHandlerDaemonMobWrite):
+    sessions = []
+    def handleRequest(self, question):
+        self.sessions.append(config.c.session_factory())
+        return "ok\n"
+
+def test_keepalive_connection_gets_a_fresh_session_per_question():
+    server = _start_server(SessionHandler)
+    try:
+        address, port = server.server_address
+        conn = transport.TelnetConnection(address, port, 5)
+        conn.request_many(["H:one\n", "H:two\n"])
+        conn.close()
+    finally:
+        server.shutdown()
+    first, second = SessionHandler.sessions
+    assert first is not second
+
+def test_pool_reuses_and_replaces_connections():
+    server = _start_server(EchoHandler)
+    created = []
+    def factory():
+        conn = transport.TelnetConnection(address, port, 5)
+        created.append(conn)
+        return conn
+    try:
+        address, port = server.server_address
+        pool = transport.ConnectionPool(factory, size=1)
+        pool.request("H:one\n\n")
+        pool.request("H:two\n\n")
+        assert_equals(len(created), 1)
+        
+        # a connection dropped while idle is replaced transparently
+        created[0].sock.close()
+        assert_equals(pool.request("H:three\n\n"), "answer to H:three\n")
+        assert_equals(len(created), 2)
+        pool.close()
+    finally:
+        server.shutdown()
+
+class HangUpHandler(mobwrite_daemon.StreamRequestHandlerDaemonMobWrite):
+    questions = []
+    def handleRequest(self, question):
+        self.questions.append(question)
+        self.connection.shutdown(socket.SHUT_RDWR)
+        return ""
+
+def test_pool_does_not_repeat_questions_the_daemon_received():
+    server = _start_server(HangUpHandler)
+    try:
+        address, port = server.server_address
+        pool = transport.ConnectionPool(
+            lambda: transport.TelnetConnection(address, port, 5), size=1)
+        pool.put(transport.TelnetConnection(address, port, 5))
+        try:
+            pool.request("H:one\n\n")
+        except transport.TransportError, e:
+            assert e.sent
+        else:
+            assert False, "expected TransportError"
+        assert_equals(len(HangUpHandler.questions), 1)
+    finally:
+        server.shutdown()
+
+# Async server tests
+
+class EchoMobWrite(object):
+    def handleRequest(self, question):
+        return "answer to " + question.splitlines()[0] + "\n"
+
+def _start_async_server(**kw):
+    server = AsyncServer(("127.0.0.1", 0), worker_factory=EchoMobWrite, **kw)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+def test_async_server_speaks_the_telnet_protocol():
+    server = _start_async_server(workers=2)
+    try:
+        # one question, answered before the connection is closed
+        sock = socket.create_connection(server.address, 5)
+        sock.sendall("H:one\nu:a\n\n")
+        answer = ""
+        while True:
+            data = sock.recv(1024)
+            if not data:
+                break
+            answer += data
+        sock.close()
+        assert_equals(answer, "answer to H:one\n")
+        
+        conn = transport.TelnetConnection(server.address[0],
+                                          server.address[1], 5)
+        answers = conn.request_many(["H:two\n", "H:three\n\nignored\n"])
+        assert_equals(answers, ["answer to H:two\n", "answer to H:three\n"])
+        conn.close()
+    finally:
+        server.shutdown()
+
+class SessionMobWrite(object):
+    sessions = []
+    def handleRequest(self, question):
+        self.sessions.append(config.c.session_factory())
+        return "ok\n"
+
+def test_async_server_workers_get_a_fresh_session_per_question():
+    server = AsyncServer(("127.0.0.1", 0), worker_factory=SessionMobWrite,
+                         workers=1)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    try:
+        conn = transport.TelnetConnection(server.address[0],
+                                          server.address[1], 5)
+        conn.request_many(["H:one\n", "H:two\n"])
+        conn.close()
+    finally:
+        server.shutdown()
+    first, second = SessionMobWrite.sessions
+    assert first is not second
+
+def test_async_server_answers_many_connections_with_few_threads():
+    server = _start_async_server(workers=2, max_pending=1)
+    connections = [transport.TelnetConnection(server.address[0],
+                                              server.address[1], 5)
+                   for i in range(100)]
+    try:
+        threads_before = threading.activeCount()
+        results = {}
+        def sync(i):
+            questions = ["H:%s-%s\n" % (i, j) for j in range(5)]
+            results[i] = connections[i].request_many(questions)
+        clients = [threading.Thread(target=sync, args=(i,))
+                   for i in range(len(connections))]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        for i in range(len(connections)):
+            assert_equals(results[i], ["answer to H:%s-%s\n" % (i, j)
+                                       for j in range(5)])
+        # the 100 client threads have finished; the server added none
+        assert_equals(threading.activeCount(), threads_before)
+    finally:
+        for conn in connections:
+            conn.close()
+        server.shutdown()
+
+# Sharding tests
+
+class RecordingShard(object):
+    def __init__(self, number):
+        self.number = number
+        self.questions = []
+        
+    def request(self, question):
+        self.questions.append(question)
+        return "F:0:shard%s\n" % self.number
+
+def test_hash_ring_moves_few_keys_when_a_shard_is_added():
+    keys = ["bob+project/file%s.js" % i for i in range(1000)]
+    three = sharding.HashRing(range(3))
+    four = sharding.HashRing(range(4))
+    moved = [key for key in keys if three.get_node(key) != four.get_node(key)]
+    assert len(moved) < 400
+    for key in moved:
+        assert_equals(four.get_node(key), 3)
+
+def test_router_splits_file_blocks_by_shard():
+    shards = [RecordingShard(i) for i in range(4)]
+    router = sharding.ShardRouter(shards)
+    names = ["bob+p/a%s" % i for i in range(20)]
+    by_shard = {}
+    for name in names:
+        by_shard.setdefault(router.shard_for(name), []).append(name)
+    assert len(by_shard) > 1
+    
+    question = "H:bob:1.2.3.4\nu:bob\n" + "".join(
+        "F:3:%s\nd:4:=10\n" % name for name in names) + "x:all\n\n"
+    answer = router.request(question)
+    
+    for shard in shards:
+        assert_equals(len(shard.questions), 1)
+        sent = shard.questions[0]
+        assert sent.endswith("\nx:all\n\n")
+        for name in names:
+            if name in by_shard.get(shard.number, []):
+                assert ("H:bob:1.2.3.4\nu:bob\nF:3:%s\nd:4:=10\n" % name) in sent
+            else:
+                assert ("F:3:%s\n" % name) not in sent
+        assert ("F:0:shard%s" % shard.number) in answer
+
+class SlowShard(object):
+    def __init__(self, answer, delay=0.2):
+        self.answer = answer
+        self.delay = delay
+        
+    def request(self, question):
+        time.sleep(self.delay)
+        return self.answer
+
+def test_router_asks_shards_in_parallel_and_terminates_answers():
+    shards = [SlowShard("F:0:a\n"), SlowShard("E:bad"), SlowShard("")]
+    router = sharding.ShardRouter(shards)
+    names = ["bob+p/a%s" % i for i in range(20)]
+    question = "u:bob\n" + "".join("F:3:%s\nd:4:=10\n" % name
+                                   for name in names) + "x:all\n\n"
+    start = time.time()
+    answer = router.request(question)
+    assert time.time() - start < 0.4
+    assert_equals(sorted(answer.splitlines(True)), ["E:bad\n", "F:0:a\n"])
+
+def test_router_reassembles_buffers():
+    shards = [RecordingShard(i) for i in range(2)]
+    router = sharding.ShardRouter(shards)
+    text = urllib.quote("u:bob\nF:1:bob+p/a\nd:1:=10\n\n")
+    middle = len(text) // 2
+    assert_equals(router.request("b:buf 2 1 %s\n\n" % text[:middle]), "")
+    router.request("b:buf 2 2 %s\n\n" % text[middle:])
+    owner = shards[router.shard_for("bob+p/a")]
+    assert_equals(owner.questions, ["u:bob\nF:1:bob+p/a\nd:1:=10\n\n"])
+
+# Daemon concurrency tests
+
+class BlockingPersister(object):
+    """Holds up the loading of the document named blocked until release is
+    set, like a persister stuck on the database or the filesystem."""
+    def __init__(self, blocked):
+        self.blocked = blocked
+        self.loading = threading.Event()
+        self.release = threading.Event()
+        
+    def load(self, name, handle):
+        if name == self.blocked:
+            self.loading.set()
+            self.release.wait(10)
+        return u"contents of " + name
+        
+    def save(self, name, contents, handle):
+        pass
+
+    def check_access(self, name, handle):
+        return Access.ReadWrite
+
+def _clear_daemon():
+    mobwrite_daemon.texts.clear()
+    mobwrite_daemon.views.clear()
+    mobwrite_daemon.user_views.clear()
+    mobwrite_daemon.view_queue.clear()
+    mobwrite_daemon.text_queue.clear()
+    mobwrite_daemon.buffers.clear()
+    mobwrite_daemon.buffer_queue.clear()
+    mobwrite_daemon.buffer_bytes = 0
+
+def test_slow_loads_do_not_block_other_documents():
+    _clear_daemon()
+    worker = mobwrite_daemon.DaemonMobWrite()
+    persister = BlockingPersister("slow")
+    worker.persister = persister
+    question = "H:%s:1\nu:%s\nF:0:%s\nd:0:\n\n"
+    answers = {}
+    
+    def sync_slow():
+        answers["slow"] = worker.handleRequest(
+            question % ("fred", "fred", "slow"))
+    
+    thread = threading.Thread(target=sync_slow)
+    thread.start()
+    try:
+        persister.loading.wait(10)
+        assert persister.loading.isSet()
+        # while the slow document is still loading, another one loads
+        answers["other"] = worker.handleRequest(
+            question % ("jim", "jim", "other"))
+        assert "slow" not in answers
+        assert answers["other"].startswith("F:1:other\n"), answers["other"]
+        assert_equals(mobwrite_daemon.texts["other"].text,
+                      "contents of other")
+    finally:
+        persister.release.set()
+        thread.join()
+    assert answers["slow"].startswith("F:1:slow\n"), answers["slow"]
+    assert_equals(mobwrite_daemon.texts["slow"].text, "contents of slow")
+    _clear_daemon()
+
+class SharingPersister(MemoryPersister):
+    """Lets the requester edit their own files and read bob's."""
+    def __init__(self):
+        MemoryPersister.__init__(self)
+        self.checks = []
+
+    def check_access_many(self, names, handle):
+        self.checks.append((sorted(names), handle))
+        result = {}
+        for name in names:
+            if name.startswith("bob+"):
+                result[name] = Access.ReadOnly
+            elif "+" in name:
+                result[name] = Access.Denied
+            else:
+                result[name] = Access.ReadWrite
+        return result
+
+def test_access_is_checked_once_per_request():
+    _clear_daemon()
+    persister = SharingPersister()
+    worker = BenchmarkMobWrite(persister)
+    answer = worker.handleRequest("H:sue:1\nu:sue\n"
+                                  "F:0:mine\nd:0:\n"
+                                  "n:bob+p/a\n"
+                                  "F:0:eve+p/b\nd:0:\n\n")
+    assert_equals(persister.checks,
+                  [(["bob+p/a", "eve+p/b", "mine"], "sue:1")])
+    assert "O:bob+p/a\n" in answer, answer
+    assert "E:eve+p/b:sue does not have access to eve+p/b\n" in answer, answer
+    assert "F:1:mine\n" in answer, answer
+    _clear_daemon()
+
+# Write-behind tests
+
+class RecordingPersister(object):
+    def __init__(self):
+        self.saved = []
+        
+    def load(self, name, handle):
+        return u"stored " + name
+        
+    def save(self, name, contents, handle):
+        self.saved.append((name, contents))
+
+def test_write_behind_coalesces_saves():
+    backend = RecordingPersister()
+    persister = WriteBehindPersister(backend, interval=60)
+    for i in range(100):
+        persister.save("doc", u"version %s" % i, "bob")
+    persister.save("other", u"x", "bob")
+    assert_equals(backend.saved, [])
+    assert_equals(persister.load("doc", "bob"), u"version 99")
+    assert_equals(persister.load("new", "bob"), u"stored new")
+    
+    assert_equals(persister.flush(), 0)
+    assert_equals(persister.flush(everything=True), 2)
+    assert_equals(sorted(backend.saved), [("doc", u"version 99"), ("other", u"x")])
+    
+def test_write_behind_flushes_when_over_budget():
+    backend = RecordingPersister()
+    persister = WriteBehindPersister(backend, interval=60, max_pending_bytes=10)
+    persister.save("doc", u"12345678901", "bob")
+    assert_equals(persister.flush(), 1)
+
+class FlakyPersister(RecordingPersister):
+    """Fails to save until it is fixed, and can run a callback in the
+    middle of a save."""
+    def __init__(self):
+        RecordingPersister.__init__(self)
+        self.broken = True
+        self.during_save = None
+        
+    def save(self, name, contents, handle):
+        if self.broken:
+            raise IOError("disk full")
+        if self.during_save:
+            self.during_save()
+        RecordingPersister.save(self, name, contents, handle)
+
+def test_write_behind_keeps_saves_until_they_are_written():
+    backend = FlakyPersister()
+    persister = WriteBehindPersister(backend, interval=60)
+    persister.save("doc", u"one", "bob")
+    assert_equals(persister.flush(everything=True), 0)
+    assert_equals(persister.load("doc", "bob"), u"one")
+    
+    # a save made while "one" is being written is not lost
+    backend.broken = False
+    backend.during_save = lambda: persister.save("doc", u"two", "bob")
+    assert_equals(persister.flush(everything=True), 1)
+    assert_equals(backend.saved, [("doc", u"one")])
+    assert_equals(persister.load("doc", "bob"), u"two")
+    
+    backend.during_save = None
+    assert_equals(persister.flush(everything=True), 1)
+    assert_equals(backend.saved, [("doc", u"one"), ("doc", u"two")])
+    assert_equals(persister.pending, {})
+    assert_equals(persister.pending_bytes, 0)
+
+# Delta journal tests
+
+def test_journal_replays_deltas_and_compacts():
+    directory = tempfile.mkdtemp()
+    try:
+        journal = DeltaJournal(directory, compact_every=3)
+        text = None
+        for i in range(5):
+            new_text = u"line %s\n" % i + (text or u"")
+            journal.append("bob+p/doc", text, new_text)
+            text = new_text
+        # 5 changes with a snapshot every 3 leaves one record in the log
+        snap, logname = journal._paths("bob+p/doc")
+        assert_equals(len(open(logname).readlines()), 1)
+        
+        # a record cut off by a crash is ignored
+        open(logname, "ab").write("6:=3\t+abc")
+        assert_equals(DeltaJournal(directory).load("bob+p/doc"), (True, text))
+        assert_equals(DeltaJournal(directory).load("bob+p/other"),
+                      (False, None))
+    finally:
+        shutil.rmtree(directory)
+
+def test_journal_records_the_diffs_it_is_given():
+    directory = tempfile.mkdtemp()
+    try:
+        journal = DeltaJournal(directory)
+        first = journal.append("doc", None, u"aa")
+        # diff_main would put the insertion at the end
+        second = journal.append("doc", u"aa", u"aaa", [(1, u"a"), (0, u"aa")])
+        # without diffs, the change is worked out
+        third = journal.append("doc", u"aaa", u"aaab")
+        assert first < second < third
+        logname = journal._paths("doc")[1]
+        assert_equals(open(logname).read(),
+                      "%d:+a\t=2\n%d:=3\t+b\n" % (second, third))
+        assert_equals(DeltaJournal(directory).load("doc"), (True, u"aaab"))
+    finally:
+        shutil.rmtree(directory)
+
+def test_journal_is_discarded_only_for_latest_record():
+    directory = tempfile.mkdtemp()
+    try:
+        journal = DeltaJournal(directory)
+        first = journal.append("doc", None, u"one")
+        second = journal.append("doc", u"one", u"caf\xe9")
+        assert_equals(journal.sequence("doc"), second)
+        journal.discard("doc", first)
+        assert_equals(DeltaJournal(directory).load("doc"), (True, u"caf\xe9"))
+        journal.discard("doc", second)
+        assert_equals(DeltaJournal(directory).load("doc"), (False, None))
+        assert_equals(journal.sequence("doc"), None)
+    finally:
+        shutil.rmtree(directory)
+
+def test_journal_expires_documents_that_are_not_loaded_again():
+    directory = tempfile.mkdtemp()
+    try:
+        journal = DeltaJournal(directory)
+        journal.append("old", None, u"old")
+        journal.append("kept", None, u"kept")
+        journal.append("recent", None, u"recent")
+        an_hour_ago = time.time() - 3600
+        for name in ["old", "kept"]:
+            for path in journal._paths(name):
+                if os.path.exists(path):
+                    os.utime(path, (an_hour_ago, an_hour_ago))
+        
+        journal = DeltaJournal(directory)
+        journal.load("kept")
+        assert_equals(journal.expire(time.time() - 60), 1)
+        assert_equals(journal.load("old"), (False, None))
+        assert_equals(journal.load("kept"), (True, u"kept"))
+        assert_equals(journal.load("recent"), (True, u"recent"))
+    finally:
+        shutil.rmtree(directory)
+
+def test_journal_outlives_write_behind_saves_until_they_are_flushed():
+    directory = tempfile.mkdtemp()
+    try:
+        journal = DeltaJournal(directory)
+        backend = RecordingPersister()
+        persister = WriteBehindPersister(backend, interval=60)
+        persister.on_flush = journal.discard
+        journal.append("doc", None, u"one")
+        seq = journal.append("doc", u"one", u"two")
+        persister.save("doc", u"two", "bob", journal_seq=seq)
+        # a crash now would still leave the edits in the journal
+        assert_equals(DeltaJournal(directory).load("doc"), (True, u"two"))
+        persister.flush(everything=True)
+        assert_equals(DeltaJournal(directory).load("doc"), (False, None))
+    finally:
+        shutil.rmtree(directory)
+
+def test_daemon_journals_client_edits():
+    _clear_daemon()
+    directory = tempfile.mkdtemp()
+    old_journal = mobwrite_daemon.journal
+    mobwrite_daemon.journal = DeltaJournal(directory)
+    try:
+        persister = WriteBehindPersister(MemoryPersister({"doc": u"hello"}),
+                                         interval=60)
+        worker = BenchmarkMobWrite(persister)
+        question = "H:fred:1\nu:fred\nF:%d:doc\nd:%d:%s\n\n"
+        worker.handleRequest(question % (0, 0, "=0"))
+        worker.handleRequest(question % (1, 1, "=5\t+ world"))
+        assert_equals(DeltaJournal(directory).load("doc"),
+                      (True, u"hello world"))
+        # once the text is written out, the journal goes
+        persister.on_flush = mobwrite_daemon.journal.discard
+        textobj = mobwrite_daemon.texts["doc"]
+        textobj.lock.acquire()
+        try:
+            assert textobj.save()
+        finally:
+            textobj.lock.release()
+        persister.flush(everything=True)
+        assert_equals(DeltaJournal(directory).load("doc"), (False, None))
+    finally:
+        mobwrite_daemon.journal = old_journal
+        shutil.rmtree(directory)
+    _clear_daemon()
+
+def test_daemon_journals_edits_made_on_top_of_others():
+    _clear_daemon()
+    directory = tempfile.mkdtemp()
+    old_journal = mobwrite_daemon.journal
+    mobwrite_daemon.journal = DeltaJournal(directory)
+    try:
+        persister = WriteBehindPersister(MemoryPersister({"doc": u"hello"}),
+                                         interval=60)
+        worker = BenchmarkMobWrite(persister)
+        question = "H:%s:1\nu:%s\nF:%d:doc\nd:%d:%s\n\n"
+        worker.handleRequest(question % ("fred", "fred", 0, 0, "=0"))
+        worker.handleRequest(question % ("jim", "jim", 0, 0, "=0"))
+        worker.handleRequest(question % ("fred", "fred", 1, 1, "=5\t+ world"))
+        # jim's delta is against the text from before fred's edit
+        worker.handleRequest(question % ("jim", "jim", 1, 1, "+Oh, \t=5"))
+        assert_equals(mobwrite_daemon.texts["doc"].text, u"Oh, hello world")
+        assert_equals(DeltaJournal(directory).load("doc"),
+                      (True, u"Oh, hello world"))
+    finally:
+        mobwrite_daemon.journal = old_journal
+        shutil.rmtree(directory)
+    _clear_daemon()
+
+# Request parsing tests
+
+def test_parse_request_reads_commands_into_actions():
+    worker = BenchmarkMobWrite(MemoryPersister())
+    actions = worker.parseRequest("H:fred:1\r\nu:fred\r\nm:{\"id\": \"f\"}\r\n"
+                                  "junk\r\nF:3:doc\r\nd:4:=10+Hello\r\n"
+                                  "F:x:other\r\nR:5:abc\r\n\r\n"
+                                  "d:6:=1\r\n\r\n")
+    assert_equals([action.mode for action in actions], ["delta", "raw"])
+    delta = actions[0]
+    assert_equals((delta.username, delta.filename, delta.handle),
+                  ("fred", "doc", "fred:1"))
+    assert_equals((delta.server_version, delta.client_version),
+                  (3, 4))
+    assert_equals(delta.data, "=10+Hello")
+    assert_equals(delta.metadata, {"id": "f"})
+    assert not delta.force
+    # a file line with a bad version is skipped, the file stays the same
+    assert_equals(actions[1]["filename"], "doc")
+    assert actions[1].force
+    
+    assert_equals(worker.parseRequest("u:fred\nF:3:doc\nd:4:=1\n"), [])
+
+def test_buffers_reassemble_fragments_in_any_order():
+    _clear_daemon()
+    worker = BenchmarkMobWrite(MemoryPersister())
+    delta = u"=3+100% caf\u00e9 %41\t-2".encode("utf-8")
+    text = urllib.quote("u:fred\nF:3:doc\nd:4:%s\n\n" % delta)
+    # cut through the middle of escapes
+    fragments = [text[i:i + 5] for i in range(0, len(text), 5)]
+    size = len(fragments)
+    order = range(1, size + 1)
+    order = order[1::2] + order[::2]
+    for index in order[:-1]:
+        assert_equals(worker.parseRequest("b:buf %d %d %s\n\n" % (
+            size, index, fragments[index - 1])), [])
+        # a repeated fragment is ignored
+        assert_equals(worker.parseRequest("b:buf %d %d %s\n\n" % (
+            size, index, fragments[index - 1])), [])
+    actions = worker.parseRequest("b:buf %d %d %s\n\n" % (
+        size, order[-1], fragments[order[-1] - 1]))
+    assert_equals([action.data for action in actions], [delta])
+    assert_equals(mobwrite_daemon.buffers, {})
+    assert_equals(mobwrite_daemon.buffer_bytes, 0)
+
+def test_buffers_over_budget_drop_the_least_recently_written():
+    _clear_daemon()
+    worker = BenchmarkMobWrite(MemoryPersister())
+    config.c.mobwrite_buffer_budget = 2500
+    try:
+        for name in ["old", "new"]:
+            worker.feedBuffer(name, 3, 1, "x" * 1000)
+        assert_equals(sorted(mobwrite_daemon.buffers), ["new_3", "old_3"])
+        worker.feedBuffer("new", 3, 2, "x" * 1000)
+        assert_equals(sorted(mobwrite_daemon.buffers), ["new_3"])
+        assert_equals(mobwrite_daemon.buffer_bytes, 2000)
+        assert_equals(worker.feedBuffer("new", 3, 3, "x"), "x" * 2001)
+        assert_equals(mobwrite_daemon.buffer_bytes, 0)
+    finally:
+        config.c.mobwrite_buffer_budget = 16 * 1024 * 1024
+        _clear_daemon()
+
+# Incremental diff tests
+
+def test_viewers_share_deltas_between_text_versions():
+    _clear_daemon()
+    persister = MemoryPersister({"doc": u"hello world"})
+    worker = BenchmarkMobWrite(persister)
+    views = [mobwrite_daemon.fetch_viewobj("user%s" % i, "doc",
+                handle="user%s:1" % i, metadata={}, persister=persister)
+             for i in range(3)]
+    for view in views:
+        worker.generateDiffs(view, None, None, False, False, True, False)
+        view.edit_stack.clear()
+    
+    diff_calls = []
+    real_diff_main = mobwrite_core.DMP.diff_main
+    def counting_diff_main(*args, **kw):
+        diff_calls.append(args)
+        return real_diff_main(*args, **kw)
+    mobwrite_core.DMP.diff_main = counting_diff_main
+    try:
+        # nothing changed: no diff at all
+        answers = [worker.generateDiffs(view, None, None, False, False,
+                                        True, False) for view in views]
+        assert_equals(diff_calls, [])
+        assert answers[0].endswith("d:1:=11\n")
+        
+        textobj = views[0].textobj
+        textobj.lock.acquire()
+        textobj.setText(u"hello there world")
+        textobj.lock.release()
+        for view in views:
+            view.edit_stack.clear()
+        answers = [worker.generateDiffs(view, None, None, False, False,
+                                        True, False) for view in views]
+        assert_equals(len(diff_calls), 1)
+        assert_equals(answers[0], answers[1])
+        assert answers[0].endswith("d:2:=6\t+there \t=5\n"), answers[0]
+    finally:
+        mobwrite_core.DMP.diff_main = real_diff_main
+    _clear_daemon()
+
+def test_edit_stack_over_budget_resyncs_with_the_whole_text():
+    _clear_daemon()
+    persister = MemoryPersister({"doc": u"hello"})
+    worker = BenchmarkMobWrite(persister)
+    view = mobwrite_daemon.fetch_viewobj("user", "doc", handle="user:1",
+                                         metadata={}, persister=persister)
+    textobj = view.textobj
+    config.c.mobwrite_edit_stack_budget = 50
+    try:
+        # the client never acknowledges anything
+        for i in range(10):
+            textobj.lock.acquire()
+            textobj.setText(textobj.text + u" %d" % i)
+            textobj.lock.release()
+            answer = worker.generateDiffs(view, "user", "doc", False, False,
+                                          True, False)
+            if answer.startswith("R:"):
+                break
+        assert i > 1
+        assert_equals(answer, "R:%d:%s\n" % (view.shadow_server_version,
+                                             textobj.text))
+        assert_equals(len(view.edit_stack), 1)
+        
+        answer = worker.generateDiffs(view, "user", "doc", False, False,
+                                      True, False)
+        assert answer.startswith("R:"), answer
+        assert_equals(len(view.edit_stack), 2)
+        assert_equals(view.edit_stack.bytes, len(answer))
+        view.edit_stack.acknowledge(view.shadow_server_version - 1)
+        assert_equals((len(view.edit_stack), view.edit_stack.bytes), (0, 0))
+    finally:
+        config.c.mobwrite_edit_stack_budget = 256 * 1024
+    _clear_daemon()
+
+# Line mode diff tests
+
+def test_line_mode_diff_refines_changed_lines():
+    dmp = diff_match_patch()
+    dmp.Diff_Timeout = 0
+    text1 = make_source_text(20000)
+    text2 = scatter_edits(text1, every=10)
+    diffs = dmp.diff_main(text1, text2)
+    assert_equals(dmp.diff_text1(diffs), text1)
+    assert_equals(dmp.diff_text2(diffs), text2)
+    # the changed lines are rediffed character by character, so the result
+    # is about as small as a pure character diff
+    exact = dmp.diff_main(text1, text2, False)
+    assert dmp.diff_levenshtein(diffs) <= dmp.diff_levenshtein(exact) * 1.2
+
+def test_line_mode_diff_stops_refining_at_the_deadline():
+    dmp = diff_match_patch()
+    dmp.Diff_Timeout = 0.05
+    text1 = make_source_text(100000)
+    text2 = u"".join("  " + line for line in text1.splitlines(True))
+    start = time.time()
+    diffs = dmp.diff_main(text1, text2)
+    assert time.time() - start < 1
+    assert_equals(dmp.diff_text1(diffs), text1)
+    assert_equals(dmp.diff_text2(diffs), text2)
+
+# Memory governor tests
+
+def test_memory_governor_unloads_least_recently_used_idle_documents():
+    _clear_daemon()
+    persister = MemoryPersister(dict(("doc%s" % i, make_source_text(10000))
+                                     for i in range(3)))
+    now = datetime.datetime.now()
+    for i in range(3):
+        view = mobwrite_daemon.fetch_viewobj("user", "doc%s" % i,
+                handle="user:1", metadata={}, persister=persister)
+        # doc0 was used longest ago; doc2 is in use
+        view.lasttime = view.textobj.lasttime = now - datetime.timedelta(
+            minutes=5 - i * 2.5)
+    doc_size = mobwrite_daemon.memory_usage()["doc0"]
+    assert doc_size > 10000
+    
+    old_stats = config.c.stats
+    config.c.stats = stats.MemoryStats()
+    config.c.mobwrite_memory_budget = doc_size * 2
+    try:
+        # over budget by one document: only doc0 goes
+        assert_equals(mobwrite_daemon.govern_memory(), 1)
+        assert_equals(sorted(mobwrite_daemon.texts), ["doc1", "doc2"])
+        assert_equals(sorted(mobwrite_daemon.views),
+                      [("user", "doc1"), ("user", "doc2")])
+        gauges = config.c.stats.multiget(["mobwrite_texts",
+                                          "mobwrite_memory_bytes"])
+        assert_equals(gauges["mobwrite_texts"], 2)
+        assert_equals(gauges["mobwrite_memory_bytes"], doc_size * 2)
+        
+        # doc2 is not idle, so it stays even when nothing fits
+        config.c.mobwrite_memory_budget = 1
+        assert_equals(mobwrite_daemon.govern_memory(), 1)
+        assert_equals(mobwrite_daemon.texts.keys(), ["doc2"])
+        
+        # unloaded documents come back from the persister
+        view = mobwrite_daemon.fetch_viewobj("user", "doc0",
+                handle="user:1", metadata={}, persister=persister)
+        assert_equals(view.textobj.text, persister.texts["doc0"])
+    finally:
+        config.c.stats = old_stats
+        config.c.mobwrite_memory_budget = 0
+    _clear_daemon()
+
+def test_memory_governor_skips_views_in_use():
+    _clear_daemon()
+    persister = MemoryPersister({"doc": u"text"})
+    view = mobwrite_daemon.fetch_viewobj("user", "doc", handle="user:1",
+            metadata={}, persister=persister)
+    idle_since = datetime.datetime.now()
+    view.lasttime = view.textobj.lasttime = idle_since - \
+        datetime.timedelta(minutes=5)
+    # a request is still working on the view
+    view.lock.acquire()
+    try:
+        assert not mobwrite_daemon.unload_text(view.textobj, idle_since)
+    finally:
+        view.lock.release()
+    assert_equals(mobwrite_daemon.views.keys(), [("user", "doc")])
+    assert mobwrite_daemon.unload_text(view.textobj, idle_since)
+    assert_equals(mobwrite_daemon.views, {})
+    assert_equals(mobwrite_daemon.texts, {})
+    _clear_daemon()
+
+# Metrics tests
+
+def test_metrics_count_failures_and_time_the_work():
+    _clear_daemon()
+    worker = BenchmarkMobWrite(MemoryPersister({"doc": u"hello"}))
+    before = metrics.snapshot()
+    def counted(name):
+        return (metrics.snapshot()["counters"].get(name, 0) -
+                before["counters"].get(name, 0))
+    def timed(name):
+        timings = metrics.snapshot()["timings"]
+        return (timings.get(name, {}).get("count", 0) -
+                before["timings"].get(name, {}).get("count", 0))
+    question = "H:fred:1\nu:fred\nF:%d:doc\nd:%d:%s\n\n"
+    worker.handleRequest(question % (0, 0, "=0"))
+    worker.handleRequest(question % (1, 1, "=5\t+!"))
+    # the client didn't get that answer and sends its delta again
+    worker.handleRequest(question % (1, 1, "=5\t+!"))
+    # a delta that doesn't fit the shadow
+    worker.handleRequest(question % (2, 2, "=50"))
+    assert_equals(counted("rollbacks"), 1)
+    assert_equals(counted("delta_failures"), 1)
+    assert_equals(timed("persister_load"), 1)
+    assert_equals(timed("view_lock_wait"), 4)
+    assert timed("patch") >= 1
+    assert timed("diff") >= 1
+    
+    snapshot = mobwrite_daemon.metrics_snapshot()
+    assert_equals((snapshot["texts"], snapshot["views"]), (1, 1))
+    
+    old_stats = config.c.stats
+    config.c.stats = stats.MemoryStats()
+    try:
+        mobwrite_daemon.publish_metrics()
+        today = datetime.date.today().strftime("%Y%m%d")
+        published = config.c.stats.multiget([
+            "mobwrite_delta_failures_" + today,
+            "mobwrite_persister_load_count"])
+        assert published["mobwrite_delta_failures_" + today] >= 1
+        assert published["mobwrite_persister_load_count"] >= 1
+    finally:
+        config.c.stats = old_stats
+    _clear_daemon()
+
+# Restart tests
+
+def test_views_carry_on_after_a_restart():
+    _clear_daemon()
+    persister = MemoryPersister({"doc": u"hello"})
+    worker = BenchmarkMobWrite(persister)
+    question = "H:%s:1\nu:%s\nF:%d:doc\nd:%d:%s\n\n"
+    worker.handleRequest(question % ("fred", "fred", 0, 0, "=0"))
+    worker.handleRequest(question % ("bob", "bob", 0, 0, "=0"))
+    # fred doesn't get this answer before the restart
+    worker.handleRequest(question % ("fred", "fred", 1, 1, "=5\t+!"))
+    textobj = mobwrite_daemon.texts["doc"]
+    
+    state_file = str(config.c.fsroot / "state.pickle")
+    assert_equals(mobwrite_daemon.save_state(state_file), 2)
+    _clear_daemon()
+    assert_equals(mobwrite_daemon.restore_state(state_file, persister), 2)
+    # the state is only used once
+    assert_equals(mobwrite_daemon.restore_state(state_file, persister), 0)
+    
+    restored = mobwrite_daemon.texts["doc"]
+    assert_equals((restored.text, restored.version),
+                  (textobj.text, textobj.version))
+    fred = mobwrite_daemon.views[("fred", "doc")]
+    assert fred.shadow is restored.text
+    assert_equals(len(fred.edit_stack), 1)
+    
+    # neither client needs its text again
+    answer = worker.handleRequest(question % ("bob", "bob", 1, 1, "=5"))
+    assert_equals(answer.splitlines()[:2], ["F:2:doc", "d:1:=5\t+!"])
+    answer = worker.handleRequest(question % ("fred", "fred", 1, 1,
+                                              "=5\t+!"))
+    assert_equals(answer.splitlines()[:2], ["F:2:doc", "d:1:=6"])
+    assert_equals(mobwrite_daemon.texts["doc"].text, u"hello!")
+    _clear_daemon()
+
+# Storage tests
+
+def test_sqlite_store_expires_texts_with_one_delete():
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "mobwrite.sqlite")
+        store = storage.SqliteStore(filename)
+        store.save("old", u"old text", "bob:1")
+        store.save("gone", u"nullified", "bob:1")
+        store.save("gone", None, "bob:1")
+        time.sleep(0.01)
+        cutoff = time.time()
+        store.save("new", u"new text \u263a", "bob:1")
+        assert_equals(store.load("old", "bob:1"), u"old text")
+        assert_equals(store.load("gone", "bob:1"), None)
+        
+        assert_equals(store.expire(cutoff), 1)
+        assert_equals(store.load("old", "bob:1"), None)
+        assert_equals(store.load("new", "bob:1"), u"new text \u263a")
+        plan = store.db.execute("EXPLAIN QUERY PLAN DELETE FROM texts "
+                                "WHERE saved < ?", (cutoff,)).fetchall()
+        assert "texts_saved" in str(plan), plan
+        store.close()
+        
+        # the texts outlive the store
+        store = storage.SqliteStore(filename)
+        assert_equals(store.load("new", "bob:1"), u"new text \u263a")
+        store.close()
+    finally:
+        shutil.rmtree(directory)
+
+def test_storage_comes_from_config():
+    old_storage = config.c.mobwrite_storage
+    old_file = config.c.mobwrite_storage_file
+    directory = tempfile.mkdtemp()
+    try:
+        config.c.mobwrite_storage = "memory"
+        persister = storage.make_persister(config.c)
+        assert isinstance(persister, storage.MemoryStore)
+        config.c.mobwrite_storage = "sqlite"
+        config.c.mobwrite_storage_file = os.path.join(directory, "new",
+                                                      "texts.sqlite")
+        persister = storage.make_persister(config.c)
+        persister.save("doc", u"text", "bob:1")
+        persister.close()
+        assert os.path.exists(config.c.mobwrite_storage_file)
+        config.c.mobwrite_storage = "nowhere"
+        try:
+            storage.make_persister(config.c)
+            assert False, "Expected ValueError"
+        except ValueError:
+            pass
+    finally:
+        config.c.mobwrite_storage = old_storage
+        config.c.mobwrite_storage_file = old_file
+        shutil.rmtree(directory)
+
+def test_cleanup_expires_stored_texts():
+    _clear_daemon()
+    old_persister = mobwrite_daemon.persister
+    store = storage.MemoryStore()
+    mobwrite_daemon.persister = WriteBehindPersister(store, interval=60)
+    try:
+        store.save("stale", u"text", "bob:1")
+        store.texts["stale"] = (u"text", time.time() -
+                                config.c.mobwrite_storage_expiry - 1)
+        store.save("fresh", u"text", "bob:1")
+        mobwrite_daemon.cleanup()
+        assert_equals(sorted(store.texts), ["fresh"])
+    finally:
+        mobwrite_daemon.persister = old_persister
+    _clear_daemon()
+
+# Cleanup tests
+
+def test_cleanup_only_visits_expired_views():
+    _clear_daemon()
+    persister = MemoryPersister()
+    old_timeout = mobwrite_core.TIMEOUT_VIEW
+    mobwrite_core.TIMEOUT_VIEW = datetime.timedelta(seconds=1)
+    try:
+        for i in range(10):
+            mobwrite_daemon.fetch_viewobj("user%s" % (i % 2), "doc%s" % i,
+                    handle="user:1", metadata={}, persister=persister)
+        time.sleep(0.5)
+        for i in range(0, 10, 3):
+            mobwrite_daemon.fetch_viewobj("user%s" % (i % 2), "doc%s" % i)
+        time.sleep(0.75)
+        mobwrite_daemon.views["user0", "doc0"].textobj.setText(u"changed")
+        
+        mobwrite_daemon.cleanup()
+        assert_equals(sorted(mobwrite_daemon.views), [
+            ("user0", "doc0"), ("user0", "doc6"),
+            ("user1", "doc3"), ("user1", "doc9")])
+        assert_equals(sorted(mobwrite_daemon.texts),
+                      ["doc0", "doc3", "doc6", "doc9"])
+        assert_equals(persister.texts["doc0"], u"changed")
+        # nothing else is due, so the next pass visits nothing
+        assert_equals(mobwrite_daemon.view_queue.expire(
+            datetime.datetime.now()), 0)
+        assert_equals(len(mobwrite_daemon.view_queue), 4)
+        
+        assert_equals(sorted(view.filename for view in
+                             mobwrite_daemon.views_for_user("user1")),
+                      ["doc3", "doc9"])
+        mobwrite_daemon.kill_views_for_user("user1")
+        assert_equals(sorted(mobwrite_daemon.views),
+                      [("user0", "doc0"), ("user0", "doc6")])
+        assert_equals(mobwrite_daemon.views_for_user("user1"), [])
+    finally:
+        mobwrite_core.TIMEOUT_VIEW = old_timeout
+    _clear_daemon()
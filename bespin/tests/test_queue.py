@@ -0,0 +1,473 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+#
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from bespin import config, queue
+
+from nose.tools import assert_equals
+
+tempdir = None
+
+def setup_module(module):
+    global tempdir
+    config.set_profile("test")
+    config.activate_profile()
+    tempdir = tempfile.mkdtemp()
+
+def teardown_module(module):
+    shutil.rmtree(tempdir)
+
+class RecordingQueue(object):
+    def __init__(self):
+        self.enqueued = []
+
+    def enqueue(self, name, message, execute, error_handler, use_db,
+                priority=None, user=None):
+        self.enqueued.append((name, priority, user))
+        return len(self.enqueued)
+
+def test_enqueue_passes_priority_and_user_to_the_queue():
+    bq = RecordingQueue()
+    config.c.queue = bq
+    try:
+        queue.enqueue("vcs", dict(user="bill"), "bespin.vcs:run_command_run",
+                      priority=queue.PRIORITY_QUICK)
+        queue.enqueue("clone", dict(user=None), "bespin.vcs:run_command_run",
+                      user="jim")
+    finally:
+        config.c.queue = None
+    assert_equals([("vcs", queue.PRIORITY_QUICK, "bill"),
+                   ("clone", None, "jim")], bq.enqueued)
+
+class FakeBeanstalk(object):
+    def __init__(self):
+        self.put_jobs = []
+
+    def use(self, name):
+        self.tube = name
+
+    def put(self, body, priority, ttr):
+        self.put_jobs.append((self.tube, priority, ttr))
+        return len(self.put_jobs)
+
+def test_beanstalk_jobs_get_their_queue_priority_and_time_to_run():
+    bq = queue.BeanstalkQueue.__new__(queue.BeanstalkQueue)
+    bq.conn = FakeBeanstalk()
+    c = config.c
+    job_timeout = c.queue_job_timeout
+    try:
+        c.queue_job_timeout = 600
+        bq.enqueue("clone", dict(user="bill"), "bespin.vcs:clone_run", None,
+                   True)
+        bq.enqueue("vcs", dict(user="bill"), "bespin.vcs:run_command_run",
+                   None, True, priority=queue.PRIORITY_QUICK)
+        c.queue_job_timeout = 0
+        bq.enqueue("files", {}, "bespin.queue:nothing", None, True)
+    finally:
+        c.queue_job_timeout = job_timeout
+    assert_equals([("clone", queue.QUEUES["clone"], 600 + queue.TTR_MARGIN),
+                   ("vcs", queue.PRIORITY_QUICK, 600 + queue.TTR_MARGIN),
+                   ("files", queue.QUEUES["files"], queue.TTR_UNLIMITED)],
+                  bq.conn.put_jobs)
+
+def test_queue_names_are_most_urgent_first():
+    assert_equals(["notify", "files", "vcs", "clone", "deploy"],
+                  queue.queue_names())
+    assert_equals(["vcs", "clone"], queue.queue_names(["clone", "vcs"]))
+    assert_equals(["files"], queue.queue_names("files"))
+
+def _restmq():
+    bq = queue.RestMqQueue("localhost", 8888)
+    bq.commands = []
+    def do_cmd(**kwargs):
+        bq.commands.append(kwargs)
+        return dict(key=len(bq.commands))
+    bq._do_cmd = do_cmd
+    return bq
+
+def test_restmq_puts_jobs_ahead_of_their_queue_on_a_quick_queue():
+    bq = _restmq()
+    assert_equals("vcs-quick", bq._queue_for("vcs", queue.PRIORITY_QUICK))
+    assert_equals("vcs", bq._queue_for("vcs", None))
+    assert_equals("vcs", bq._queue_for("vcs", queue.QUEUES["vcs"]))
+    assert_equals("vcs", bq._queue_for("vcs", 2000))
+
+    bq.enqueue("vcs", dict(command="pull"), "bespin.vcs:run_command_run",
+               None, True, priority=queue.PRIORITY_QUICK, user="bill")
+    command = bq.commands[-1]
+    assert_equals("add", command['cmd'])
+    assert_equals("vcs-quick", command['queue'])
+    assert_equals("bill", command['value']['__user'])
+
+def test_restmq_requeue_puts_the_job_back_where_it_came_from():
+    bq = _restmq()
+    qi = queue.QueueItem(7, "vcs", dict(command="pull"),
+                         "bespin.vcs:run_command_run", job=bq, use_db=True,
+                         origin="restmq", user="bill", source="vcs-quick")
+    assert qi.quick
+    defer_delay = queue.DEFER_DELAY
+    queue.DEFER_DELAY = 0.2
+    try:
+        start = time.time()
+        qi.defer()
+        assert time.time() - start >= 0.2
+    finally:
+        queue.DEFER_DELAY = defer_delay
+    add, delete = bq.commands
+    assert_equals("add", add['cmd'])
+    assert_equals("vcs-quick", add['queue'])
+    assert_equals(dict(command="pull",
+                       __execute="bespin.vcs:run_command_run",
+                       __error_handler=None, __use_db=True, __user="bill"),
+                  add['value'])
+    assert_equals(dict(cmd="del", queue="vcs-quick", key=7), delete)
+    # the job that was put back is unchanged
+    assert_equals(dict(command="pull"), qi.message)
+
+def test_quick_jobs_are_those_ahead_of_their_queue():
+    def item(priority=None, source=None):
+        return queue.QueueItem(1, "vcs", {}, "", priority=priority,
+                               source=source)
+    assert item(priority=queue.PRIORITY_QUICK).quick
+    assert not item(priority=queue.QUEUES["vcs"]).quick
+    assert not item().quick
+    assert item(source="vcs-quick").quick
+    assert not item(source="vcs").quick
+
+def test_user_slots_are_counted_per_user_and_queue():
+    slots = queue.UserSlots(1)
+    assert slots.acquire("bill", "clone")
+    assert not slots.acquire("bill", "clone")
+    # a clone doesn't hold up the same user's other queues
+    assert slots.acquire("bill", "vcs")
+    assert slots.acquire("jim", "clone")
+    # jobs from no one in particular are never held up
+    assert slots.acquire(None, "clone")
+    assert slots.acquire(None, "clone")
+    slots.release("bill", "clone")
+    assert slots.acquire("bill", "clone")
+    for key in [("bill", "clone"), ("bill", "vcs"), ("jim", "clone"),
+                (None, "clone"), (None, "clone")]:
+        slots.release(*key)
+    assert_equals({}, slots.running)
+
+def test_user_slots_without_a_limit():
+    slots = queue.UserSlots(0)
+    for i in range(5):
+        assert slots.acquire("bill", "clone")
+    assert_equals({("bill", "clone"): 5}, slots.running)
+
+def test_shared_user_slots_are_shared_between_processes():
+    filename = os.path.join(tempdir, "slots.sqlite")
+    first = queue.SharedUserSlots(filename, 1)
+    second = queue.SharedUserSlots(filename, 1)
+    assert first.acquire("bill", "clone")
+    assert not second.acquire("bill", "clone")
+    assert second.acquire("bill", "vcs")
+    assert second.acquire(None, "clone")
+    first.release("bill", "clone")
+    assert second.acquire("bill", "clone")
+    # the slots of a process that died are freed by the supervisor
+    second.release_process(os.getpid())
+    assert first.acquire("bill", "clone")
+    assert first.acquire("bill", "vcs")
+
+class FakeItem(queue.QueueItem):
+    def __init__(self, id, call, user=None, queue_name="files",
+                 priority=None):
+        queue.QueueItem.__init__(self, id, queue_name, dict(call=call),
+                                 "bespin.tests.test_queue:_call_job",
+                                 use_db=False, user=user, priority=priority)
+        self.finished = False
+        self.deferred = False
+
+    def done(self):
+        self.finished = True
+
+    def defer(self):
+        self.deferred = True
+
+def _call_job(qi):
+    qi.message['call'](qi)
+
+class FakeQueue(object):
+    """Hands out the given jobs, then nothing."""
+    def __init__(self, items):
+        self.items = list(items)
+
+    def clone(self):
+        return self
+
+    def read_queue(self, names, timeout=None):
+        while True:
+            if self.items:
+                yield self.items.pop(0)
+            else:
+                time.sleep(0.01)
+                yield None
+
+def _nothing(qi):
+    pass
+
+def _fail(qi):
+    raise Exception("job failed")
+
+def _wait_until(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+def test_worker_runs_jobs_and_stops_after_max_jobs():
+    items = [FakeItem(1, _nothing), FakeItem(2, _fail),
+             FakeItem(3, _nothing), FakeItem(4, _nothing)]
+    worker = queue.Worker(queue.UserSlots(1), max_jobs=3)
+    worker.start(FakeQueue(items), [("files", 1)])
+    worker.wait()
+    assert_equals([True, True, True, False],
+                  [item.finished for item in items])
+    # the job read after the last one is put back for another worker
+    assert items[3].deferred
+    health = worker.health()
+    assert_equals(3, health['jobs'])
+    assert_equals(1, health['failures'])
+    assert health['stopping']
+    assert_equals([], health['running'])
+
+def test_worker_puts_back_jobs_from_users_without_free_slots():
+    release = threading.Event()
+    def wait(qi):
+        release.wait(10)
+    items = [FakeItem(1, wait, user="bill", queue_name="clone"),
+             FakeItem(2, _nothing, user="bill", queue_name="clone"),
+             FakeItem(3, _nothing, user="bill", queue_name="clone",
+                      priority=queue.PRIORITY_QUICK),
+             FakeItem(4, _nothing, user="jim", queue_name="clone")]
+    worker = queue.Worker(queue.UserSlots(1))
+    bq = FakeQueue(items)
+    worker.start(bq, [("clone", 2)])
+    try:
+        _wait_until(lambda: not bq.items and worker.jobs == 2)
+        running = worker.health()['running']
+        assert_equals([1], [job['job'] for job in running])
+        assert running[0]['age'] >= 0
+        assert items[1].deferred
+        assert not items[1].finished
+        assert items[2].finished
+        assert items[3].finished
+    finally:
+        release.set()
+        worker.stop()
+        worker.wait()
+    assert items[0].finished
+    assert_equals({}, worker.slots.running)
+
+def test_worker_finishes_running_jobs_when_stopped():
+    started = threading.Event()
+    release = threading.Event()
+    def wait(qi):
+        started.set()
+        release.wait(10)
+    items = [FakeItem(1, wait), FakeItem(2, _nothing)]
+    bq = FakeQueue(items)
+    worker = queue.Worker(queue.UserSlots(1))
+    worker.start(bq, [("files", 1)])
+    started.wait(10)
+    worker.stop()
+    release.set()
+    worker.wait()
+    assert items[0].finished
+    assert not items[1].finished
+    assert items[1].deferred
+
+class DoneFails(FakeItem):
+    def done(self):
+        raise IOError("connection reset")
+
+class FlakyQueue(FakeQueue):
+    """Fails the first time it is read, and counts reconnections."""
+    def __init__(self, items):
+        FakeQueue.__init__(self, items)
+        self.broken = True
+        self.clones = 0
+
+    def clone(self):
+        self.clones += 1
+        return self
+
+    def read_queue(self, names, timeout=None):
+        if self.broken:
+            self.broken = False
+            raise IOError("connection refused")
+        return FakeQueue.read_queue(self, names, timeout)
+
+    def close(self):
+        pass
+
+def test_worker_survives_job_queue_errors():
+    reconnect_delay = queue.RECONNECT_DELAY
+    queue.RECONNECT_DELAY = 0.01
+    try:
+        items = [DoneFails(1, _nothing), FakeItem(2, _nothing)]
+        bq = FlakyQueue(items)
+        worker = queue.Worker(queue.UserSlots(1), max_jobs=2)
+        worker.start(bq, [("files", 1)])
+        worker.wait()
+    finally:
+        queue.RECONNECT_DELAY = reconnect_delay
+    # the thread reconnected (once for start, once after the error) and
+    # took the next job after the first one could not be deleted
+    assert_equals(2, bq.clones)
+    assert items[1].finished
+    assert_equals(2, worker.jobs)
+    assert_equals(0, worker.failures)
+
+class EndlessQueue(FakeQueue):
+    """Hands out jobs that record the process that ran them in filename
+    and then call call."""
+    def __init__(self, filename, call=_nothing):
+        self.filename = filename
+        self.call = call
+
+    def read_queue(self, names, timeout=None):
+        i = 0
+        while True:
+            i += 1
+            yield FakeItem(i, self.record_and_call, user="bill")
+
+    def record_and_call(self, qi):
+        f = open(self.filename, "a")
+        f.write("%s\n" % os.getpid())
+        f.close()
+        self.call(qi)
+
+def _sleep(qi):
+    time.sleep(60)
+
+def _slow(qi):
+    time.sleep(1)
+
+def _recorded(filename):
+    if not os.path.exists(filename):
+        return []
+    return [int(line) for line in open(filename).read().split()]
+
+def _supervise(bq, processes=1, **settings):
+    c = config.c
+    saved = dict((name, getattr(c, name)) for name in settings)
+    saved_interval = queue.HEALTH_INTERVAL
+    for name, value in settings.items():
+        setattr(c, name, value)
+    queue.HEALTH_INTERVAL = 0.1
+    supervisor = queue.Supervisor(bq, processes)
+    def restore():
+        for name, value in saved.items():
+            setattr(c, name, value)
+        queue.HEALTH_INTERVAL = saved_interval
+    return supervisor, restore
+
+def _stop(supervisor, timeout=10):
+    supervisor.stop()
+    deadline = time.time() + timeout
+    while supervisor.step(0.1):
+        assert time.time() < deadline, "worker processes did not stop"
+
+def test_supervisor_replaces_worker_processes_after_max_jobs():
+    filename = os.path.join(tempdir, "recycled")
+    bq = EndlessQueue(filename)
+    supervisor, restore = _supervise(bq, queue_max_jobs=2,
+                                     queue_workers=[("files", 1)],
+                                     queue_job_timeout=0)
+    try:
+        deadline = time.time() + 10
+        while len(set(_recorded(filename))) < 3:
+            assert time.time() < deadline, "worker processes not replaced"
+            supervisor.step(0.1)
+        _stop(supervisor)
+    finally:
+        supervisor.close()
+        restore()
+    pids = _recorded(filename)
+    counts = dict((pid, pids.count(pid)) for pid in pids)
+    # every process but the last ran its two jobs and no more
+    assert_equals([2, 2], [counts[pid] for pid in pids[:4:2]])
+    assert_equals({}, supervisor.reports)
+    assert not os.path.exists(supervisor.slots.filename)
+
+def test_supervisor_kills_worker_processes_with_stuck_jobs():
+    filename = os.path.join(tempdir, "stuck")
+    bq = EndlessQueue(filename, _sleep)
+    supervisor, restore = _supervise(bq, queue_workers=[("files", 1)],
+                                     queue_job_timeout=0.5,
+                                     queue_shutdown_timeout=0.5)
+    try:
+        deadline = time.time() + 10
+        while len(set(_recorded(filename))) < 2:
+            assert time.time() < deadline, "stuck job was not killed"
+            supervisor.step(0.1)
+        first = _recorded(filename)[0]
+        assert first not in supervisor.reports
+        # the killed process's slot was freed for the job's replacement
+        assert supervisor.slots.acquire("bill", "files") is False
+        _stop(supervisor)
+        assert supervisor.slots.acquire("bill", "files")
+    finally:
+        supervisor.close()
+        restore()
+
+def test_supervisor_lets_jobs_finish_when_stopped():
+    filename = os.path.join(tempdir, "stopped")
+    bq = EndlessQueue(filename, _slow)
+    supervisor, restore = _supervise(bq, queue_workers=[("files", 1)],
+                                     queue_job_timeout=0,
+                                     queue_shutdown_timeout=10)
+    try:
+        while not _recorded(filename):
+            supervisor.step(0.1)
+        start = time.time()
+        _stop(supervisor)
+    finally:
+        supervisor.close()
+        restore()
+    # the process finished its job rather than being killed
+    assert time.time() - start < 5
+    assert_equals(1, len(_recorded(filename)))
@@ -55,4 +55,7 @@ def test_stats_operations():
     
     result = ms.multiget(['foo', datekey])
     assert result == {'foo':100, datekey:100}
-    
\ No newline at end of file
+        
+    ms.set("gauge", 5)
+    ms.set("gauge", 3)
+    assert ms.multiget(["gauge"]) == {"gauge": 3}
@@ -35,9 +35,11 @@
 # ***** END LICENSE BLOCK *****
 # 
 
+import time
+
 import simplejson
 
-from bespin import config, controllers, auth
+from bespin import config, controllers, auth, database
 from bespin.database import User, Base, ConflictError, EventLog
 from bespin.filesystem import get_project
 
@@ -100,7 +102,59 @@ def test_get_user_returns_none_for_nonexistent():
     s = _get_session(True)
     user = User.find_user("NOT THERE. NO REALLY!")
     assert user is None
-    
+
+def test_identity_map_returns_same_user_within_request():
+    s = _get_session(True)
+    User.create_user("BillBixby", "hulkrulez", "bill@bixby.com")
+    s.commit()
+    database.begin_identity_map()
+    try:
+        user = User.find_user("BillBixby")
+        assert User.find_user("BillBixby") is user
+    finally:
+        database.end_identity_map()
+
+def test_user_info_comes_from_cache():
+    s = _get_session(True)
+    cache = config.c.user_cache
+    cache.clear()
+    user = User.create_user("BillBixby", "hulkrulez", "bill@bixby.com")
+    s.commit()
+    info = User.find_info("BillBixby")
+    assert info.id == user.id
+    assert info.uuid == user.uuid
+    assert info.file_location == user.file_location
+    assert cache.get("BillBixby") is info
+    assert User.find_info("BillBixby") is info
+    assert User.find_info("NOT THERE") is None
+
+def test_user_cache_evicts_least_recently_used():
+    cache = database.UserCache(2)
+    for name in ["a", "b"]:
+        cache.put(database.UserInfo(name, name, name, name))
+    cache.get("a")
+    cache.put(database.UserInfo("c", "c", "c", "c"))
+    assert cache.get("b") is None
+    assert cache.get("a").id == "a"
+    assert cache.get("c").id == "c"
+
+def test_user_cache_is_invalidated_on_update():
+    s = _get_session(True)
+    cache = config.c.user_cache
+    cache.clear()
+    user = User.create_user("BillBixby", "hulkrulez", "bill@bixby.com")
+    s.commit()
+    User.find_info("BillBixby")
+    assert cache.get("BillBixby") is not None
+
+    user.password = User.generate_password("gamma")
+    s.commit()
+    assert cache.get("BillBixby") is None
+
+    user = User.find_user("BillBixby", "gamma")
+    assert user is not None
+    assert User.find_info("BillBixby").id == user.id
+
 
 # Controller Tests
 
@@ -237,6 +291,114 @@ def test_messages_sent_from_server_to_user():
     data = simplejson.loads(resp.body)
     assert len(data) == 0
     
+def test_channel_streams_messages():
+    _clear_db()
+    app = controllers.make_app()
+    app = BespinTestApp(app)
+    resp = app.post("/register/new/macgyver",
+        dict(password="foo", email="macgyver@ducttape.macgyver"))
+    s = _get_session()
+    macgyver = User.find_user("macgyver")
+    macgyver.publish(dict(my="message"))
+    s.commit()
+    
+    old_lifetime = config.c.channel_lifetime
+    config.c.channel_lifetime = 0.2
+    try:
+        resp = app.post("/channel/")
+    finally:
+        config.c.channel_lifetime = old_lifetime
+    assert resp.content_type == "application/json"
+    frames = [simplejson.loads(line) for line in resp.body.splitlines()]
+    assert frames[0] == [dict(my="message")]
+    assert frames[1:] == [[]]
+    assert controllers._open_channels == {}
+    
+def test_channel_count_is_limited_per_user():
+    _clear_db()
+    app = controllers.make_app()
+    app = BespinTestApp(app)
+    resp = app.post("/register/new/macgyver",
+        dict(password="foo", email="macgyver@ducttape.macgyver"))
+    macgyver = User.find_user("macgyver")
+    controllers._open_channels[macgyver.id] = config.c.channel_max_per_user
+    try:
+        resp = app.post("/channel/", status=409)
+    finally:
+        controllers._open_channels.clear()
+    
+def test_channel_count_is_limited_per_process():
+    _clear_db()
+    app = controllers.make_app()
+    app = BespinTestApp(app)
+    resp = app.post("/register/new/macgyver",
+        dict(password="foo", email="macgyver@ducttape.macgyver"))
+    # channels held by other users
+    controllers._open_channels["someone"] = config.c.channel_max_open
+    try:
+        resp = app.post("/channel/", status=503)
+        assert resp.headers['Retry-After'] == \
+            str(int(config.c.channel_lifetime))
+        assert "/messages/" in resp.body
+        assert controllers._open_channels == \
+            {"someone": config.c.channel_max_open}
+    finally:
+        controllers._open_channels.clear()
+    
+def test_channel_puts_undelivered_messages_back():
+    _clear_db()
+    s = _get_session()
+    user = User.create_user("macgyver", "foo", "macgyver@ducttape.macgyver")
+    s.commit()
+    controllers._open_channel(user.id)
+    frames = controllers.ChannelFrames(user.id, [])
+    assert frames.next() == "[]\n"
+    user.publish(dict(n=1))
+    s.commit()
+    assert simplejson.loads(frames.next()) == [dict(n=1)]
+    # the client goes away before asking for another frame
+    frames.close()
+    assert controllers._open_channels == {}
+    data = [simplejson.loads(msg) for msg in user.pop_messages()]
+    assert data == [dict(n=1)]
+    
+def test_inbox_pops_messages_in_order():
+    _clear_db()
+    s = _get_session()
+    user = User.create_user("macgyver", "foo", "macgyver@ducttape.macgyver")
+    s.commit()
+    user.publish(dict(n=1))
+    config.c.inbox.publish_many([user.id], dict(n=2))
+    s.commit()
+    data = [simplejson.loads(msg) for msg in user.pop_messages()]
+    assert data == [dict(n=1), dict(n=2)]
+    assert user.pop_messages() == []
+    
+    start = time.time()
+    assert user.pop_messages(wait=0.2) == []
+    assert time.time() - start >= 0.2
+    
+def test_inbox_wakes_waiters_after_commit():
+    _clear_db()
+    s = _get_session()
+    user = User.create_user("macgyver", "foo", "macgyver@ducttape.macgyver")
+    s.commit()
+    inbox = config.c.inbox
+    notified = []
+    inbox._notify = lambda: notified.append(True)
+    try:
+        user.publish(dict(n=1))
+        assert notified == []
+        s.commit()
+        assert notified == [True]
+        
+        user.publish(dict(n=2))
+        s.rollback()
+        s.commit()
+        assert notified == [True]
+    finally:
+        del inbox._notify
+    
 def test_get_users_settings():
     _clear_db()
     app = controllers.make_app()
@@ -60,7 +60,7 @@ from uvc.commands import GetValueFromEditor, inserted_value
 from Crypto.Cipher import AES
 
 from bespin import config, queue, database, filesystem
-from bespin.database import User, Message
+from bespin.database import User
 from bespin.filesystem import FSException, NotAuthorized, get_project
 
 log = logging.getLogger("bespin.vcs")
@@ -111,7 +111,7 @@ def clone(user, source, dest=None, push=None, remoteauth="write",
         remoteauth=remoteauth,
         authtype=authtype, username=username, password=password,
         kcpass=kcpass, vcs=vcs, vcsuser=vcsuser)
-    return queue.enqueue("vcs", job_body, execute="bespin.vcs:clone_run",
+    return queue.enqueue("clone", job_body, execute="bespin.vcs:clone_run",
                         error_handler="bespin.vcs:vcs_error",
                         use_db=True)
 
@@ -141,8 +141,7 @@ def vcs_error(qi, e):
             tb = format_exc()
         message = dict(jobid=qi.id, output=tb, error=True)
         message['asyncDone'] = True
-        retval = Message(user_id=user.id, message=simplejson.dumps(message))
-        s.add(retval)
+        config.c.inbox.publish(user.id, message)
 
 def clone_run(qi):
     """Runs the queued up clone job."""
@@ -155,8 +154,7 @@ def clone_run(qi):
     # the client will peel off one layer from this.
     result = dict(output=_clone_impl(qid=qi.id, **message))
     result.update(dict(jobid=qi.id, asyncDone=True))
-    retvalue = Message(user_id=user.id, message=simplejson.dumps(result))
-    s.add(retvalue)
+    config.c.inbox.publish(user.id, result)
     config.c.stats.incr('vcs_DATE')
     
 class LineCounterOutput(object):
@@ -184,9 +182,7 @@ class LineCounterOutput(object):
         s = database._get_session()
         message_body = dict(jobid=self.qid, asyncDone=False, 
             output="%s %s" % (self.line_count, self.label))
-        message = Message(user_id = self.user_id,
-            message=simplejson.dumps(message_body))
-        s.add(message)
+        config.c.inbox.publish(self.user_id, message_body)
         s.commit()
 
 def _clone_impl(user, source, qid, dest=None, push=None, remoteauth="write",
@@ -265,14 +261,22 @@ def _clone_impl(user, source, qid, dest=None, push=None, remoteauth="write",
                   command="clone", project=command.dest)
     return result
 
+# Commands that only look at the working copy, which someone is usually
+# waiting on. They go ahead of the other VCS jobs.
+_quick_commands = set(["status", "diff", "log", "resolved"])
+
 def run_command(user, project, args, kcpass=None):
     """Run any VCS command through UVC."""
     user = user.username
     project = project.name
     job_body = dict(user=user, project=project, args=args, kcpass=kcpass)
+    if args and args[0] in _quick_commands:
+        priority = queue.PRIORITY_QUICK
+    else:
+        priority = None
     return queue.enqueue("vcs", job_body, execute="bespin.vcs:run_command_run",
                         error_handler="bespin.vcs:vcs_error",
-                        use_db=True)
+                        use_db=True, priority=priority)
 
 def run_command_run(qi):
     """Runs the queued up run_command job."""
@@ -287,8 +291,7 @@ def run_command_run(qi):
     result = dict(output=_run_command_impl(**message))
     
     result.update(dict(jobid=qi.id, asyncDone=True))
-    retvalue = Message(user_id=user.id, message=simplejson.dumps(result))
-    s.add(retvalue)
+    config.c.inbox.publish(user.id, result)
     config.c.stats.incr('vcs_DATE')
 
 def _run_command_impl(user, project, args, kcpass):
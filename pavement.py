@@ -30,7 +30,7 @@ import re
 import os
 import sys
 
-from setuptools import find_packages
+from setuptools import find_packages, Extension
 from paver.setuputils import find_package_data
 
 from paver.easy import *
@@ -49,6 +49,10 @@ options(
         packages=find_packages(),
         package_data=find_package_data('bespin', 'bespin', 
                                 only_in_packages=False),
+        # Speeds up mobwrite; it works without this if it can't be built.
+        ext_modules=[Extension("bespin.mobwrite._speedups",
+                               ["bespin/mobwrite/_speedups.c"],
+                               optional=True)],
         entry_points="""
 [console_scripts]
 bespin_worker=bespin.queue:process_queue
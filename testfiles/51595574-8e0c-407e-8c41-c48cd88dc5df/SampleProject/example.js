@@ -0,0 +1,8 @@
+/*
+ * This sample code
+ * is really lame
+ * but we're tired
+ */
+function welcome() {
+    return "to Bespin";
+}